@@ -22,6 +22,31 @@ echo "⚠️  警告: この処理には時間とコストがかかります"
 echo "   - 推定実行時間: 2-4時間"
 echo "   - BigQueryのクエリ料金が発生します"
 echo ""
+
+# 実行前の見積もり（dry run で各SQLのスキャン量を求め、オンデマンド料金で換算）
+# 前のステップの出力テーブルがまだない場合、そのSQLは見積もれないので合計に含まれない
+# BQ_MAX_COST_USD を設定すると、見積もりが上限を超えたときに実行前に中断する
+USD_PER_TIB=${BQ_USD_PER_TIB:-6.25}
+TOTAL_BYTES=0
+echo "💰 BigQuery 料金の見積もり（dry run, \$${USD_PER_TIB}/TiB）"
+for sql in 01_create_base_features_no_leakage.sql add_jockey_win_rate_no_leakage.sql \
+           add_trainer_win_rate_no_leakage.sql add_missing_features_no_leakage.sql; do
+    bytes=$(bq query --use_legacy_sql=false --dry_run --format=json < "$sql" 2>/dev/null \
+        | python3 -c 'import json, sys; print(json.load(sys.stdin)["statistics"]["totalBytesProcessed"])' 2>/dev/null) || bytes=""
+    if [ -n "$bytes" ]; then
+        TOTAL_BYTES=$((TOTAL_BYTES + bytes))
+        echo "   - $sql: $(awk -v b="$bytes" 'BEGIN { printf "%.1f GB", b / 1024 ^ 3 }')"
+    else
+        echo "   - $sql: 見積もり不可（前のステップの出力テーブルが必要）"
+    fi
+done
+ESTIMATED_USD=$(awk -v b="$TOTAL_BYTES" -v p="$USD_PER_TIB" 'BEGIN { printf "%.2f", b / 1024 ^ 4 * p }')
+echo "   合計: $(awk -v b="$TOTAL_BYTES" 'BEGIN { printf "%.3f TiB", b / 1024 ^ 4 }') → \$${ESTIMATED_USD}"
+if [ -n "$BQ_MAX_COST_USD" ] && awk -v e="$ESTIMATED_USD" -v m="$BQ_MAX_COST_USD" 'BEGIN { exit !(e > m) }'; then
+    echo "❌ 見積もり \$${ESTIMATED_USD} が上限 \$${BQ_MAX_COST_USD} (BQ_MAX_COST_USD) を超えるため中断しました"
+    exit 1
+fi
+echo ""
 read -p "続行しますか？ (y/N): " -n 1 -r
 echo
 if [[ ! $REPLY =~ ^[Yy]$ ]]
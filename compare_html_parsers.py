@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTML パースの速さとメモリを比較する（html_parse.py）
+
+http_cache.py が保存したページ（血統ページと JRA の開催カレンダー）を記録済みのページとして読み込み、
+- これまでの実装（html.parser でページ全体をパース）
+- html_parse.parse_tables（対象のテーブルだけを lxml でパース。lxml がなければ html.parser）
+の両方で scrape_siblings.parse_siblings / generate_race_schedule.parse_race_schedule を実行して
+- 1秒あたりのページ数（--repeat 回のうち最も速い回）
+- 1ページあたりのメモリ（パース中に確保したメモリのピーク。tracemalloc で計測するので時間とは別に実行する）
+- 両方の結果が同じか（違うページがあれば URL を表示して終了コード 1）
+を表示する。
+
+--fixtures-dir ではキャッシュの代わりに、リポジトリに置いた記録済みのページ（tests/fixtures）で比較する。
+記録済みのページは --export-fixtures でキャッシュから書き出す（種類ごとに --export-limit 件まで）。
+ファイルは {種類}/{URL の最後の部分}.html に置き、URL は pages.json に記録する。
+tests/test_html_parse.py は同じページで両方の結果が同じことを確かめる。
+
+Usage:
+    python3 scrape_siblings.py                                 # 比較用のページを .http_cache に保存
+    python3 compare_html_parsers.py
+    python3 compare_html_parsers.py --cache-dir /path/to/.http_cache --repeat 5
+    python3 compare_html_parsers.py --fixtures-dir tests/fixtures
+    python3 compare_html_parsers.py --export-fixtures tests/fixtures --export-limit 3
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+
+from html_parse import FAST_BACKEND, FULL_BACKEND
+from http_cache import DEFAULT_CACHE_DIR
+from scrape_siblings import parse_siblings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gcs'))
+from generate_race_schedule import parse_race_schedule
+
+# 計測の繰り返し回数（最も速い回を使う）
+DEFAULT_REPEAT = 3
+
+# --export-fixtures で書き出すページ数（種類ごと）
+DEFAULT_EXPORT_LIMIT = 3
+
+# 記録済みのページの索引（{ファイルの相対パス: URL}）
+FIXTURE_INDEX = 'pages.json'
+
+
+def parse_pedigree_page(url, content, fast):
+    return parse_siblings(content, fast=fast)
+
+
+def parse_schedule_page(url, content, fast):
+    # scrape_race_schedule と同じく Shift_JIS でデコードしてから渡す（進捗の表示は捨てる）
+    with contextlib.redirect_stdout(io.StringIO()):
+        return parse_race_schedule(content.decode('shift_jis', errors='replace'), url, fast=fast)
+
+
+# ページの種類: (名前, URL のパターン, パース関数, 残すテーブル)
+PAGE_KINDS = [
+    ('pedigree', re.compile(r'/horse/ped/\d+'), parse_pedigree_page, 'sibling table'),
+    ('schedule', re.compile(r'/keiba/calendar\d*/'), parse_schedule_page, 'table.basic'),
+]
+
+
+def page_kind(url):
+    """URL のページの種類（PAGE_KINDS の名前。比較しないページは None）"""
+    return next((name for name, pattern, _, _ in PAGE_KINDS if pattern.search(url)), None)
+
+
+def load_pages(cache_dir):
+    """キャッシュの索引から比較に使うページを読み込んで {種類: [(URL, 本文)]} で返す"""
+    pages = {name: [] for name, _, _, _ in PAGE_KINDS}
+    index_dir = os.path.join(cache_dir, 'urls')
+    if not os.path.isdir(index_dir):
+        raise RuntimeError(f"No HTTP cache found in {cache_dir}")
+
+    for filename in sorted(os.listdir(index_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(index_dir, filename), 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        kind = page_kind(entry['url'])
+        if kind is None:
+            continue
+        with open(os.path.join(cache_dir, 'objects', entry['sha256'][:2], entry['sha256']), 'rb') as f:
+            pages[kind].append((entry['url'], f.read()))
+    return pages
+
+
+def load_fixture_pages(fixtures_dir):
+    """記録済みのページ（FIXTURE_INDEX に載っているファイル）を {種類: [(URL, 本文)]} で返す"""
+    index_path = os.path.join(fixtures_dir, FIXTURE_INDEX)
+    if not os.path.exists(index_path):
+        raise RuntimeError(f"No {FIXTURE_INDEX} found in {fixtures_dir}")
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+
+    pages = {name: [] for name, _, _, _ in PAGE_KINDS}
+    for path, url in sorted(index.items()):
+        kind = page_kind(url)
+        if kind is None:
+            continue
+        with open(os.path.join(fixtures_dir, path), 'rb') as f:
+            pages[kind].append((url, f.read()))
+    return pages
+
+
+def export_fixtures(pages, fixtures_dir, limit=DEFAULT_EXPORT_LIMIT):
+    """キャッシュのページを種類ごとに limit 件まで fixtures_dir に書き出し、FIXTURE_INDEX に追記する（書き出した件数を返す）"""
+    index_path = os.path.join(fixtures_dir, FIXTURE_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+    written = 0
+    for kind, kind_pages in pages.items():
+        os.makedirs(os.path.join(fixtures_dir, kind), exist_ok=True)
+        for url, content in kind_pages[:limit]:
+            # 血統ページは horse_id、開催カレンダーは日付（0214.html）がファイル名になる
+            name = urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+            path = f"{kind}/{name if name.endswith('.html') else name + '.html'}"
+            with open(os.path.join(fixtures_dir, path), 'wb') as f:
+                f.write(content)
+            index[path] = url
+            written += 1
+
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+    return written
+
+
+def measure_speed(parse, pages, fast, repeat):
+    """全ページをパースした結果と、1秒あたりのページ数（repeat 回のうち最も速い回）"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parse(url, content, fast) for url, content in pages]
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return results, len(pages) / best if best else 0.0
+
+
+def measure_memory(parse, pages, fast):
+    """1ページごとのパース中のメモリのピーク（バイト）"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for url, content in pages:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            parse(url, content, fast)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def compare(kind, parse, tables, pages, repeat):
+    """1種類のページを両方の実装でパースして表示し、結果が違ったページの URL を返す"""
+    total_bytes = sum(len(content) for _, content in pages)
+    print(f"\n📊 {kind}: {len(pages)} pages ({total_bytes / 1024 ** 2:,.1f} MB)")
+    print(f"{'parser':<36}{'pages/s':>10}{'KiB/page':>10}{'max KiB':>10}")
+
+    rows = {}
+    for fast, label in ((False, f"{FULL_BACKEND} (full page)"), (True, f"{FAST_BACKEND} ({tables} only)")):
+        results, pages_per_second = measure_speed(parse, pages, fast, repeat)
+        peaks = measure_memory(parse, pages, fast)
+        rows[fast] = (results, pages_per_second, sum(peaks) / len(peaks))
+        print(f"{label:<36}{pages_per_second:>10,.1f}{sum(peaks) / len(peaks) / 1024:>10,.0f}{max(peaks) / 1024:>10,.0f}")
+
+    (full_results, full_speed, full_memory), (fast_results, fast_speed, fast_memory) = rows[False], rows[True]
+    mismatches = [url for (url, _), full, fast in zip(pages, full_results, fast_results) if full != fast]
+    print(f"   Speedup: ×{fast_speed / full_speed:.1f}, memory: ×{fast_memory / full_memory:.2f}, "
+          f"identical output: {len(pages) - len(mismatches)}/{len(pages)}")
+    for url in mismatches:
+        print(f"     - {url}")
+    return mismatches
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='Compare full-page html.parser parsing with the table-only fast path on cached pages')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help=f'HTTP cache to read saved pages from (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help=f'Timed passes over the pages; the fastest is reported (default: {DEFAULT_REPEAT})')
+    parser.add_argument('--fixtures-dir', help=f'Compare the recorded pages listed in {FIXTURE_INDEX} in this directory (e.g. tests/fixtures) instead of the HTTP cache')
+    parser.add_argument('--export-fixtures', metavar='DIR', help=f'Copy cached pages into DIR as recorded pages (listed in {FIXTURE_INDEX}) and exit')
+    parser.add_argument('--export-limit', type=int, default=DEFAULT_EXPORT_LIMIT, help=f'Pages of each kind to copy with --export-fixtures (default: {DEFAULT_EXPORT_LIMIT})')
+    args = parser.parse_args()
+
+    try:
+        if args.export_fixtures:
+            written = export_fixtures(load_pages(args.cache_dir), args.export_fixtures, args.export_limit)
+            print(f"✅ Exported {written} pages to {args.export_fixtures}")
+            return
+
+        source = args.fixtures_dir or args.cache_dir
+        pages = load_fixture_pages(args.fixtures_dir) if args.fixtures_dir else load_pages(args.cache_dir)
+        if not any(pages.values()):
+            raise RuntimeError(f"No pedigree or schedule pages found in {source}")
+        if FAST_BACKEND != 'lxml':
+            print("⚠️  lxml is not installed; the fast path only skips the rest of the page (pip install lxml)")
+
+        mismatches = []
+        for kind, _, parse, tables in PAGE_KINDS:
+            if pages[kind]:
+                mismatches += compare(kind, parse, tables, pages[kind], args.repeat)
+
+        if mismatches:
+            print(f"\n❌ {len(mismatches)} pages parsed differently", file=sys.stderr)
+            sys.exit(1)
+        print("\n✅ Both parsers produced the same output")
+
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,23 @@
 """
 
 from google.cloud import bigquery, storage
-import json
+import os
 import sys
+from functools import partial
+
+import batch_stats
+import checkpoint
+import cost_estimate
+import incremental
+import stat_schema
+from parallel import (DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRIES, DEFAULT_WORKERS, cap_in_flight,
+                      fetch_sections, run_entities)
+from offline_client import OfflineClient
+from query_cache import CachedClient
+from query_params import run_query
+from query_stats import InstrumentedClient
+from publish_format import COMPRESSIONS, JSON_LAYOUTS, PublishFormat
+from uploads import DEFAULT_UPLOAD_WORKERS, GCSBackend, LocalBackend, UploadService
 
 # 設定
 PROJECT_ID = 'umadata'
@@ -182,24 +197,45 @@ TRACK_VARIANT_MAPPING = {
     'outer': '外',  # BigQueryでは外回りは'外'
 }
 
-# グローバル変数として現在処理中のコース情報を保持
-VENUE = '中山'
-SURFACE = 'ダート'
-DISTANCE = 1800
-VENUE_EN = 'nakayama'
-SURFACE_EN = 'dirt'
-TRACK_VARIANT = None  # None=内回り, '外'=外回り
+def make_course(venue, surface, distance, track_variant):
+    """クエリに渡すコース条件（track_variant は BigQuery 上の値に変換済み）"""
+    return {
+        'venue': venue,
+        'surface': surface,
+        'distance': distance,
+        'track_variant': TRACK_VARIANT_MAPPING.get(track_variant, track_variant),  # None=内回り, '外'=外回り
+    }
 
 
-def get_gate_stats(client):
+def has_track_variant(course):
+    """内回り・外回りを区別するコースか"""
+    return (course['venue'], course['surface'], course['distance']) in COURSES_WITH_VARIANT
+
+
+def course_params(course):
+    """コース条件のクエリパラメータ（@venue / @surface / @distance / @track_variant）"""
+    params = {
+        'venue': course['venue'],
+        'surface': course['surface'],
+        'distance': course['distance'],
+    }
+    if has_track_variant(course) and course['track_variant'] is not None:
+        params['track_variant'] = course['track_variant']
+    return params
+
+
+def course_variant_condition(course, alias='rm'):
+    """track_variant の条件（内回り・外回りを区別するコースのみ）"""
+    if not has_track_variant(course):
+        return ""
+    if course['track_variant'] is None:
+        return f"AND {alias}.track_variant IS NULL"
+    return f"AND {alias}.track_variant = @track_variant"
+
+
+def get_gate_stats(client, course):
     """枠順別データを取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        # TRACK_VARIANTをBigQuery用の値に変換
-        bq_variant = TRACK_VARIANT_MAPPING.get(TRACK_VARIANT, TRACK_VARIANT) if TRACK_VARIANT else None
-        track_variant_condition = "AND rm.track_variant IS NULL" if bq_variant is None else f"AND rm.track_variant = '{bq_variant}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -221,9 +257,9 @@ def get_gate_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY rr.bracket_number
@@ -231,20 +267,16 @@ def get_gate_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching gate stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_popularity_stats(client):
+def get_popularity_stats(client, course):
     """人気別データを取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -274,9 +306,9 @@ def get_popularity_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rr.popularity IS NOT NULL
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
@@ -284,7 +316,7 @@ def get_popularity_stats(client):
     """
     
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         data_dict = {row['popularity_group']: dict(row) for row in results}
 
         # 順序を保証して返す
@@ -295,13 +327,9 @@ def get_popularity_stats(client):
         raise
 
 
-def get_jockey_stats(client):
+def get_jockey_stats(client, course):
     """騎手別データを取得（過去3年間、現役のみ）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -330,9 +358,9 @@ def get_jockey_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.jockey` j ON CAST(rr.jockey_id AS STRING) = CAST(j.jockey_id AS STRING)
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rr.jockey_id IS NOT NULL
       AND j.is_active = true
@@ -347,20 +375,16 @@ def get_jockey_stats(client):
     """
     
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching jockey stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_trainer_stats(client):
+def get_trainer_stats(client, course):
     """調教師別データを取得（過去3年間、現役のみ）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -389,9 +413,9 @@ def get_trainer_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.trainer` t ON CAST(rr.trainer_id AS STRING) = CAST(t.trainer_id AS STRING)
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rr.trainer_id IS NOT NULL
       AND t.is_active = true
@@ -406,53 +430,37 @@ def get_trainer_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching trainer stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_volatility_stats(client):
-    """荒れやすさデータを取得（過去3年間）
+def get_volatility_rankings(client):
+    """全コースの三連単中央値・順位と全体の中央値を1回で計算する（過去3年間）
 
-    sanrentanはJSON形式の文字列で保存されているため、REGEXPで数値を抽出する
-    - 全コースの三連単中央値
-    - このコースの三連単中央値
-    - ランキング（何位/全コース数）
-    - 荒れやすさスコア（1-5）
+    三連単の払戻金は race_payout（build_derived_tables.py）の数値列を使う。
+    同着で複数ある場合は先頭の1件。
+    戻り値は {(venue, surface, distance, track_variant): row} の索引。
+    内回り・外回りを区別しないコースは track_variant=None のキーにまとめ、
+    中央値は距離単位（全回り）で計算した値を使う。
     """
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-        track_variant_condition_acr = "AND acr.track_variant IS NULL" if TRACK_VARIANT is None else f"AND acr.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
-        track_variant_condition_acr = ""
-
-    # Step 1: このコースの三連単中央値と順位を計算
-    ranking_query = f"""
+    query = f"""
     WITH payback_values AS (
       SELECT
         rm.venue_name,
         rm.surface,
         rm.distance,
-        CAST(REGEXP_EXTRACT(rm.sanrentan, r': (\\d+)') AS FLOAT64) as payback_amount
+        rm.track_variant,
+        CAST(rp.amount AS FLOAT64) as payback_amount
       FROM
-        `{DATASET}.race_master` rm
+        `{DATASET}.race_payout` rp
+        JOIN `{DATASET}.race_master` rm ON rp.race_id = rm.race_id
       WHERE
-        rm.venue_name = '{VENUE}'
-        AND rm.surface = '{SURFACE}'
-        AND rm.distance = {DISTANCE}
-        {track_variant_condition}
-        AND rm.sanrentan IS NOT NULL
-        AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-    ),
-    course_median AS (
-      SELECT
-        APPROX_QUANTILES(payback_amount, 100)[OFFSET(50)] as course_median
-      FROM
-        payback_values
+        rp.bet_type = 'sanrentan'
+        AND rp.payout_index = 0
+        AND rp.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     ),
     all_course_stats AS (
       SELECT
@@ -460,12 +468,10 @@ def get_volatility_stats(client):
         surface,
         distance,
         track_variant,
-        APPROX_QUANTILES(CAST(REGEXP_EXTRACT(sanrentan, r': (\\d+)') AS FLOAT64), 100)[OFFSET(50)] as course_median
+        COUNT(*) as races,
+        APPROX_QUANTILES(payback_amount, 100)[OFFSET(50)] as course_median
       FROM
-        `{DATASET}.race_master` rm
-      WHERE
-        rm.sanrentan IS NOT NULL
-        AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
+        payback_values
       GROUP BY
         venue_name,
         surface,
@@ -474,95 +480,118 @@ def get_volatility_stats(client):
     ),
     all_courses_ranked AS (
       SELECT
-        venue_name,
-        surface,
-        distance,
-        track_variant,
-        course_median,
+        *,
         ROW_NUMBER() OVER (ORDER BY course_median DESC) as rank,
         COUNT(*) OVER () as total_courses
       FROM
         all_course_stats
     ),
+    distance_medians AS (
+      SELECT
+        venue_name,
+        surface,
+        distance,
+        APPROX_QUANTILES(payback_amount, 100)[OFFSET(50)] as distance_median
+      FROM
+        payback_values
+      GROUP BY
+        venue_name,
+        surface,
+        distance
+    ),
     global_median AS (
       SELECT
-        APPROX_QUANTILES(CAST(REGEXP_EXTRACT(sanrentan, r': (\\d+)') AS FLOAT64), 100)[OFFSET(50)] as global_median
+        APPROX_QUANTILES(payback_amount, 100)[OFFSET(50)] as global_median
       FROM
-        `{DATASET}.race_master` rm
-      WHERE
-        rm.sanrentan IS NOT NULL
-        AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-        AND STRUCT(rm.venue_name, rm.surface, rm.distance, rm.track_variant) IN (
-          SELECT AS STRUCT venue_name, surface, distance, track_variant
-          FROM `{DATASET}.race_master`
-          WHERE
-            sanrentan IS NOT NULL
-            AND race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-          GROUP BY venue_name, surface, distance, track_variant
-        )
+        payback_values
     )
     SELECT
-      cm.course_median as trifecta_median_payback,
-      gm.global_median as trifecta_all_median_payback,
-      acr.rank as trifecta_avg_payback_rank,
-      acr.total_courses as total_courses
+      acr.venue_name,
+      acr.surface,
+      acr.distance,
+      acr.track_variant,
+      acr.races,
+      acr.course_median,
+      dm.distance_median,
+      acr.rank,
+      acr.total_courses,
+      gm.global_median
     FROM
-      course_median cm
+      all_courses_ranked acr
+      JOIN distance_medians dm USING (venue_name, surface, distance)
       CROSS JOIN global_median gm
-      CROSS JOIN all_courses_ranked acr
-    WHERE
-      acr.venue_name = '{VENUE}'
-      AND acr.surface = '{SURFACE}'
-      AND acr.distance = {DISTANCE}
-      {track_variant_condition_acr}
     """
 
     try:
-        results = client.query(ranking_query).result()
-        rows = list(results)
-        if not rows:
-            return None
-
-        row = rows[0]
-        course_median = float(row['trifecta_median_payback']) if row['trifecta_median_payback'] else 0
-        global_median = float(row['trifecta_all_median_payback']) if row['trifecta_all_median_payback'] else 0
-        rank = row['trifecta_avg_payback_rank']
-        total_courses = row['total_courses']
-
-        # Step 2: 荒れやすさスコア（1-5）を計算
-        # 配当が高いほど荒れやすい
-        # percentileに基づいて5段階評価
-        if rank <= total_courses * 0.2:
-            volatility_score = 5  # 上位20%：最も荒れやすい
-        elif rank <= total_courses * 0.4:
-            volatility_score = 4
-        elif rank <= total_courses * 0.6:
-            volatility_score = 3  # 中央：標準
-        elif rank <= total_courses * 0.8:
-            volatility_score = 2
-        else:
-            volatility_score = 1  # 下位20%：最も堅い
-
-        return {
-            'volatility': volatility_score,
-            'trifecta_median_payback': int(course_median),
-            'trifecta_all_median_payback': int(global_median),
-            'trifecta_avg_payback_rank': rank,
-            'total_courses': total_courses
-        }
-
+        results = client.query(query).result()
+        rankings = {}
+        for row in results:
+            row = dict(row)
+            venue, surface, distance = row['venue_name'], row['surface'], row['distance']
+            if (venue, surface, distance) in COURSES_WITH_VARIANT:
+                rankings[(venue, surface, distance, row['track_variant'])] = row
+                continue
+
+            # 回りを区別しないコースは出走数の多い回りの順位を使い、中央値は全回りで計算
+            key = (venue, surface, distance, None)
+            current = rankings.get(key)
+            if current is None or row['races'] > current['races']:
+                rankings[key] = {**row, 'course_median': row['distance_median']}
+        return rankings
     except Exception as e:
-        print(f"   ⚠️  Error fetching volatility stats: {str(e)}", file=sys.stderr)
+        print(f"   ⚠️  Error fetching volatility rankings: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_pedigree_stats(client):
-    """種牡馬別データを取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
+def get_volatility_stats(client, course, volatility_rankings=None):
+    """荒れやすさデータを取得（過去3年間）
+
+    - 全コースの三連単中央値
+    - このコースの三連単中央値
+    - ランキング（何位/全コース数）
+    - 荒れやすさスコア（1-5）
+
+    volatility_rankings: get_volatility_rankings の結果（なければここで全コース分を計算する）
+    """
+    if volatility_rankings is None:
+        volatility_rankings = get_volatility_rankings(client)
+
+    variant = course['track_variant'] if has_track_variant(course) else None
+    row = volatility_rankings.get((course['venue'], course['surface'], course['distance'], variant))
+    if not row:
+        return None
+
+    course_median = float(row['course_median']) if row['course_median'] else 0
+    global_median = float(row['global_median']) if row['global_median'] else 0
+    rank = row['rank']
+    total_courses = row['total_courses']
+
+    # 荒れやすさスコア（1-5）を計算
+    # 配当が高いほど荒れやすい
+    # percentileに基づいて5段階評価
+    if rank <= total_courses * 0.2:
+        volatility_score = 5  # 上位20%：最も荒れやすい
+    elif rank <= total_courses * 0.4:
+        volatility_score = 4
+    elif rank <= total_courses * 0.6:
+        volatility_score = 3  # 中央：標準
+    elif rank <= total_courses * 0.8:
+        volatility_score = 2
     else:
-        track_variant_condition = ""
+        volatility_score = 1  # 下位20%：最も堅い
+
+    return {
+        'volatility': volatility_score,
+        'trifecta_median_payback': int(course_median),
+        'trifecta_all_median_payback': int(global_median),
+        'trifecta_avg_payback_rank': rank,
+        'total_courses': total_courses
+    }
+
+
+def get_pedigree_stats(client, course):
+    """種牡馬別データを取得（過去3年間）"""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -591,9 +620,9 @@ def get_pedigree_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON CAST(rr.horse_id AS STRING) = CAST(h.horse_id AS STRING)
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND h.father IS NOT NULL
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
@@ -607,20 +636,16 @@ def get_pedigree_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching pedigree stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_dam_sire_stats(client):
+def get_dam_sire_stats(client, course):
     """母父別データを取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -649,9 +674,9 @@ def get_dam_sire_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON CAST(rr.horse_id AS STRING) = CAST(h.horse_id AS STRING)
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND h.mf IS NOT NULL
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
@@ -665,14 +690,14 @@ def get_dam_sire_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching dam_sire stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_running_style_stats(client):
+def get_running_style_stats(client, course):
     """脚質別データを取得（過去3年間）
 
     脚質の定義：
@@ -681,87 +706,25 @@ def get_running_style_stats(client):
     - 差し: 逃げ・先行に該当しない馬で、最終コーナーが出走頭数の3分の2以内（出走頭数≧8）
     - 追込: 逃げ・先行・差しに該当しない馬
     """
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course, 'e')
 
     query = f"""
-    WITH corner_data AS (
+    WITH running_style_classified AS (
+      -- 脚質は race_result_enriched で分類済み（build_derived_tables.py）
       SELECT
-        rm.race_id,
-        rr.horse_id,
-        rr.finish_position,
-        rr.popularity,
-        rr.win,
-        rr.place,
-        rm.entry_count,
-        rr.last_3f_time,
-        SPLIT(rr.corner_positions, '-') as corner_array
+        e.finish_position,
+        e.popularity,
+        e.win,
+        e.place,
+        e.running_style_top5 as running_style
       FROM
-        `{DATASET}.race_master` rm
-        JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+        `{DATASET}.race_result_enriched` e
       WHERE
-        rm.venue_name = '{VENUE}'
-        AND rm.surface = '{SURFACE}'
-        AND rm.distance = {DISTANCE}
+        e.venue_name = @venue
+        AND e.surface = @surface
+        AND e.distance = @distance
         {track_variant_condition}
-        AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-        AND rr.corner_positions IS NOT NULL
-        AND ARRAY_LENGTH(SPLIT(rr.corner_positions, '-')) > 0
-    ),
-    corner_parsed AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        entry_count,
-        last_3f_time,
-        corner_array,
-        ARRAY_LENGTH(corner_array) as corner_count,
-        -- 各コーナーを取得（存在しない場合はNULL）
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 1, corner_array[OFFSET(0)], NULL) AS INT64) as corner_1,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 2, corner_array[OFFSET(1)], NULL) AS INT64) as corner_2,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 3, corner_array[OFFSET(2)], NULL) AS INT64) as corner_3,
-        -- 最終コーナーを動的に取得
-        CAST(corner_array[OFFSET(ARRAY_LENGTH(corner_array)-1)] AS INT64) as final_corner,
-        -- 各レース内での上がり（ラスト3ハロン）ランク（タイムが短い順）
-        RANK() OVER (PARTITION BY race_id ORDER BY last_3f_time ASC) as last_3f_rank
-      FROM
-        corner_data
-    ),
-    running_style_classified AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        CASE
-          WHEN corner_count >= 1 AND (
-            COALESCE(corner_1, 0) = 1 OR
-            COALESCE(corner_2, 0) = 1 OR
-            COALESCE(corner_3, 0) = 1
-          )
-            THEN 'escape'
-          WHEN COALESCE(final_corner, 999) <= CAST(CEIL(entry_count / 3.0) AS INT64)
-            THEN 'lead'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(entry_count / 3.0) AS INT64)
-            AND COALESCE(final_corner, 999) <= CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 5
-            THEN 'pursue'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 5
-            THEN 'close'
-          ELSE NULL
-        END as running_style
-      FROM
-        corner_parsed
+        AND e.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     )
     SELECT
       running_style,
@@ -806,98 +769,34 @@ def get_running_style_stats(client):
     """
 
     try:
-        from google.cloud.bigquery import QueryJobConfig
-        job_config = QueryJobConfig(use_query_cache=False)
-        results = client.query(query, job_config=job_config).result()
+        results = run_query(client, query, course_params(course), use_query_cache=False)
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching running style stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_running_style_trends(client):
+def get_running_style_trends(client, course):
     """脚質傾向データを取得（「逃げ・先行」と「差し・追込」に分類、5段階評価）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course, 'e')
 
     query = f"""
-    WITH corner_data AS (
+    WITH running_style_classified AS (
+      -- 脚質は race_result_enriched で分類済み（build_derived_tables.py）
       SELECT
-        rm.race_id,
-        rr.horse_id,
-        rr.finish_position,
-        rr.win,
-        rr.place,
-        rm.entry_count,
-        rr.corner_positions,
-        rr.last_3f_time,
-        SPLIT(rr.corner_positions, '-') as corner_array
+        e.finish_position,
+        e.popularity,
+        e.win,
+        e.place,
+        e.running_style_top5 as running_style
       FROM
-        `{DATASET}.race_master` rm
-        JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+        `{DATASET}.race_result_enriched` e
       WHERE
-        rm.venue_name = '{VENUE}'
-        AND rm.surface = '{SURFACE}'
-        AND rm.distance = {DISTANCE}
+        e.venue_name = @venue
+        AND e.surface = @surface
+        AND e.distance = @distance
         {track_variant_condition}
-        AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-        AND rr.corner_positions IS NOT NULL
-        AND ARRAY_LENGTH(SPLIT(rr.corner_positions, '-')) > 0
-    ),
-    corner_parsed AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        win,
-        place,
-        entry_count,
-        last_3f_time,
-        corner_array,
-        ARRAY_LENGTH(corner_array) as corner_count,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 1, corner_array[OFFSET(0)], NULL) AS INT64) as corner_1,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 2, corner_array[OFFSET(1)], NULL) AS INT64) as corner_2,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 3, corner_array[OFFSET(2)], NULL) AS INT64) as corner_3,
-        CAST(corner_array[OFFSET(ARRAY_LENGTH(corner_array)-1)] AS INT64) as final_corner,
-        RANK() OVER (PARTITION BY race_id ORDER BY last_3f_time ASC) as last_3f_rank
-      FROM
-        corner_data
-    ),
-    running_style_classified AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        COALESCE(win, 0) as win,
-        COALESCE(place, 0) as place,
-        CASE
-          -- 逃げ: 最初の3コーナー（1,2,3番目）のいずれかを1位で通過
-          WHEN corner_count >= 1 AND (
-            COALESCE(corner_1, 0) = 1 OR
-            COALESCE(corner_2, 0) = 1 OR
-            COALESCE(corner_3, 0) = 1
-          )
-            THEN 'escape'
-          -- 先行: 最終コーナーが第1集団（1位～出走馬/3）
-          WHEN COALESCE(final_corner, 999) <= CAST(CEIL(entry_count / 3.0) AS INT64)
-            THEN 'lead'
-          -- 差し: 最終コーナーが第2集団（出走馬/3+1～2*出走馬/3）かつ上がり（ラスト3F）が5位以内
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(entry_count / 3.0) AS INT64)
-            AND COALESCE(final_corner, 999) <= CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 5
-            THEN 'pursue'
-          -- 追込: 最終コーナーが第3集団（2*出走馬/3+1～）かつ上がり（ラスト3F）が5位以内
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 5
-            THEN 'close'
-          -- その他: カウント対象外（NULLを返す）
-          ELSE NULL
-        END as running_style
-      FROM
-        corner_parsed
+        AND e.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     )
     SELECT
       CASE
@@ -928,9 +827,7 @@ def get_running_style_trends(client):
     """
 
     try:
-        from google.cloud.bigquery import QueryJobConfig
-        job_config = QueryJobConfig(use_query_cache=False)
-        results = client.query(query, job_config=job_config).result()
+        results = run_query(client, query, course_params(course), use_query_cache=False)
 
         # Convert results to dict and calculate trend_value (0-4 scale based on place_rate)
         trends = [dict(row) for row in results]
@@ -956,13 +853,9 @@ def get_running_style_trends(client):
         raise
 
 
-def get_total_races(client):
+def get_total_races(client, course):
     """対象コースの総レース数を取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        track_variant_condition = "AND rm.track_variant IS NULL" if TRACK_VARIANT is None else f"AND rm.track_variant = '{TRACK_VARIANT}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -970,15 +863,15 @@ def get_total_races(client):
     FROM
       `{DATASET}.race_master` rm
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         row = next(results)
         return row['total_races']
     except Exception as e:
@@ -986,14 +879,9 @@ def get_total_races(client):
         raise
 
 
-def get_gender_stats(client):
+def get_gender_stats(client, course):
     """性別成績を取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        bq_variant = TRACK_VARIANT_MAPPING.get(TRACK_VARIANT, TRACK_VARIANT) if TRACK_VARIANT else None
-        track_variant_condition = "AND rm.track_variant IS NULL" if bq_variant is None else f"AND rm.track_variant = '{bq_variant}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -1020,9 +908,9 @@ def get_gender_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.sex IS NOT NULL
@@ -1037,21 +925,16 @@ def get_gender_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching gender stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_horse_weight_stats(client):
+def get_horse_weight_stats(client, course):
     """馬体重別成績を取得（過去3年間）"""
-    # track_variant条件を動的に生成（内回り・外回りを区別するコースのみ）
-    if (VENUE, SURFACE, DISTANCE) in COURSES_WITH_VARIANT:
-        bq_variant = TRACK_VARIANT_MAPPING.get(TRACK_VARIANT, TRACK_VARIANT) if TRACK_VARIANT else None
-        track_variant_condition = "AND rm.track_variant IS NULL" if bq_variant is None else f"AND rm.track_variant = '{bq_variant}'"
-    else:
-        track_variant_condition = ""
+    track_variant_condition = course_variant_condition(course)
 
     query = f"""
     SELECT
@@ -1083,9 +966,9 @@ def get_horse_weight_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rm.venue_name = '{VENUE}'
-      AND rm.surface = '{SURFACE}'
-      AND rm.distance = {DISTANCE}
+      rm.venue_name = @venue
+      AND rm.surface = @surface
+      AND rm.distance = @distance
       {track_variant_condition}
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.horse_weight IS NOT NULL
@@ -1106,25 +989,95 @@ def get_horse_weight_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, course_params(course))
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching horse weight stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def process_course(bq_client, storage_client, venue, venue_en, surface, surface_en, distance, track_variant):
-    """単一コースのデータを処理してGCSにアップロード"""
-    global VENUE, SURFACE, DISTANCE, VENUE_EN, SURFACE_EN, TRACK_VARIANT
+# 全コース分を1クエリずつでまとめて集計するセクション（batch_stats）
+# コースキー: 「競馬場|路面|距離|内外回り」（内外回りは COURSES_WITH_VARIANT のみ）
+_VARIANT_COURSE_KEYS = ', '.join(f"'{v}|{s}|{d}'" for v, s, d in COURSES_WITH_VARIANT)
+BATCH_ENTITY = {
+    'key': f"""CONCAT(
+        rm.venue_name, '|', rm.surface, '|', CAST(rm.distance AS STRING), '|',
+        IF(CONCAT(rm.venue_name, '|', rm.surface, '|', CAST(rm.distance AS STRING)) IN ({_VARIANT_COURSE_KEYS}),
+           IFNULL(rm.track_variant, ''), '')
+      )""",
+}
+BATCH_SECTIONS = [
+    batch_stats.gate_section(),
+    batch_stats.popularity_section(),
+    batch_stats.ranking_section('jockey_stats', 'j.jockey_name', ['jockey'], "rr.jockey_id IS NOT NULL AND j.is_active = true"),
+    batch_stats.ranking_section('trainer_stats', 't.trainer_name', ['trainer'], "rr.trainer_id IS NOT NULL AND t.is_active = true"),
+    batch_stats.ranking_section('pedigree_stats', 'h.father', ['horse'], "h.father IS NOT NULL"),
+    batch_stats.ranking_section('dam_sire_stats', 'h.mf', ['horse'], "h.mf IS NOT NULL"),
+    batch_stats.gender_section(),
+    batch_stats.horse_weight_section(),
+]
+
+
+def course_key(venue, surface, distance, track_variant):
+    """BATCH_ENTITY のキーと同じ形式のコースキーを返す"""
+    course = make_course(venue, surface, distance, track_variant)
+    variant = (course['track_variant'] or '') if has_track_variant(course) else ''
+    return f"{venue}|{surface}|{distance}|{variant}"
+
 
-    # グローバル変数を更新
-    VENUE = venue
-    SURFACE = surface
-    DISTANCE = distance
-    VENUE_EN = venue_en
-    SURFACE_EN = surface_en
-    # TRACK_VARIANTをBigQuery用の値に変換
-    TRACK_VARIANT = TRACK_VARIANT_MAPPING.get(track_variant, track_variant)
+def precompute_rankings(client):
+    """全コースを対象にしたランキングを1回だけ計算する
+
+    荒れやすさの順位と全体中央値は全コースの集計が必要なため、
+    コースごとに計算し直さず実行の最初にまとめて求めて process_course に渡す。
+    """
+    print("   Precomputing rankings (trifecta volatility)...")
+    return {
+        'volatility': get_volatility_rankings(client),
+    }
+
+
+def entity_sections(rankings):
+    """1コース分のセクション（fetch_sections に渡す [(name, getter)]）"""
+    return [
+        ('gate_stats', get_gate_stats),
+        ('popularity_stats', get_popularity_stats),
+        ('jockey_stats', get_jockey_stats),
+        ('trainer_stats', get_trainer_stats),
+        ('volatility_stats', partial(get_volatility_stats, volatility_rankings=rankings['volatility'])),
+        ('pedigree_stats', get_pedigree_stats),
+        ('dam_sire_stats', get_dam_sire_stats),
+        ('running_style_stats', get_running_style_stats),
+        ('running_style_trends', get_running_style_trends),
+        ('gender_stats', get_gender_stats),
+        ('horse_weight_stats', get_horse_weight_stats),
+        ('total_races', get_total_races),
+    ]
+
+
+def estimate_cost(bq_client, sample, entity_count, no_batch=False):
+    """全コースのスキャン量と料金を見積もる（代表の1コース（sample: make_course の dict）のクエリを dry run して × entity_count）"""
+    client = cost_estimate.DryRunClient(bq_client)
+    batch_names = set()
+    if not no_batch:
+        batch_stats.prefetch_sections(client, BATCH_ENTITY, BATCH_SECTIONS)
+        batch_names = {section['name'] for section in BATCH_SECTIONS}
+    rankings = precompute_rankings(client)
+    with client.per_entity(entity_count):
+        cost_estimate.dry_run_sections(client, entity_sections(rankings), args=(sample,), skip=batch_names)
+    return cost_estimate.print_estimate(client, entity_count, 'courses')
+
+
+def process_course(bq_client, storage_client, venue, venue_en, surface, surface_en, distance, track_variant, prefetched=None,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, rankings=None):
+    """単一コースのデータを処理してGCSにアップロード
+
+    prefetched: batch_stats で全コース分まとめて取得済みのセクション（{name: rows}）。
+    含まれるセクションはクエリを発行せずにそのまま使う。
+    max_in_flight: 同時に実行するセクションクエリ数の上限（1 なら順番に実行）
+    rankings: precompute_rankings の結果。省略時はこのコースの処理の中で計算する
+    """
+    course = make_course(venue, surface, distance, track_variant)
 
     # コース名の表示用（内回り・外回りを含む）
     track_label = "（外回り）" if track_variant == '外' else "（内回り）" if track_variant is None and venue in ['京都', '新潟'] and surface == '芝' and distance in [1400, 1600, 2000] else ""
@@ -1132,19 +1085,25 @@ def process_course(bq_client, storage_client, venue, venue_en, surface, surface_
     try:
         print(f"  🚀 Processing {venue} {surface} {distance}m{track_label}")
 
-        # 各データを取得
-        gate_stats = get_gate_stats(bq_client)
-        popularity_stats = get_popularity_stats(bq_client)
-        jockey_stats = get_jockey_stats(bq_client)
-        trainer_stats = get_trainer_stats(bq_client)
-        volatility_stats = get_volatility_stats(bq_client)
-        pedigree_stats = get_pedigree_stats(bq_client)
-        dam_sire_stats = get_dam_sire_stats(bq_client)
-        running_style_stats = get_running_style_stats(bq_client)
-        running_style_trends = get_running_style_trends(bq_client)
-        gender_stats = get_gender_stats(bq_client)
-        horse_weight_stats = get_horse_weight_stats(bq_client)
-        total_races = get_total_races(bq_client)
+        if rankings is None:
+            rankings = precompute_rankings(bq_client)
+
+        # 全セクションのクエリをまとめて投入し、終わった順に回収
+        sections = entity_sections(rankings)
+        print(f"  Fetching {len(sections)} sections (max in flight: {max_in_flight})...")
+        data = fetch_sections(bq_client, sections, prefetched, max_in_flight, args=(course,))
+        gate_stats = data['gate_stats']
+        popularity_stats = data['popularity_stats']
+        jockey_stats = data['jockey_stats']
+        trainer_stats = data['trainer_stats']
+        volatility_stats = data['volatility_stats']
+        pedigree_stats = data['pedigree_stats']
+        dam_sire_stats = data['dam_sire_stats']
+        running_style_stats = data['running_style_stats']
+        running_style_trends = data['running_style_trends']
+        gender_stats = data['gender_stats']
+        horse_weight_stats = data['horse_weight_stats']
+        total_races = data['total_races']
 
         # 傾向計算
         # 1. 枠順傾向（内枠 vs 外枠）
@@ -1233,10 +1192,8 @@ def process_course(bq_client, storage_client, venue, venue_en, surface, surface_
             blob_path = f'course/{venue_en}/{surface_en}/{distance}.json'
 
         blob = bucket.blob(blob_path)
-        blob.upload_from_string(
-            json.dumps(course_data, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
+        # 数値項目の型をそろえてから送る（宣言した型に合わなければこのエンティティは失敗扱い）
+        blob.upload_json(stat_schema.coerce(course_data))
 
         print(f"    ✅ {venue} {surface} {distance}m{track_label} uploaded to {blob_path}")
         return True
@@ -1246,20 +1203,92 @@ def process_course(bq_client, storage_client, venue, venue_en, surface, surface_
         return False
 
 
+def checkpoint_key(entity_args):
+    """チェックポイントに記録するキー（process_course の引数のコースのキー）"""
+    return course_key(entity_args[2], entity_args[4], entity_args[6], entity_args[7])
+
+
 def main():
     """メイン処理 - 全コースをバッチ処理"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export course data from BigQuery to GCS')
+    parser.add_argument('--no-batch', action='store_true', help='Query each section per course instead of grouped batch queries')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help=f'Max concurrent section queries per course (1 = sequential, default: {DEFAULT_MAX_IN_FLIGHT})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'Number of courses processed in parallel (1 = sequential, default: {DEFAULT_WORKERS})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help=f'Times to retry failed courses (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--no-cache', action='store_true', help='Always query BigQuery instead of reusing cached results on disk')
+    parser.add_argument('--no-query-log', action='store_true', help='Do not write per-query latency/bytes/slot stats to a JSONL log')
+    parser.add_argument('--upload-workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help=f'Number of parallel uploads (default: {DEFAULT_UPLOAD_WORKERS})')
+    parser.add_argument('--json-layout', choices=JSON_LAYOUTS, default='pretty', help='Published JSON layout (columnar: stat arrays as column arrays; default: pretty)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none', help='Store JSON pre-compressed with this Content-Encoding (default: none)')
+    parser.add_argument('--incremental', action='store_true', help='Regenerate only courses with races loaded since the last run')
+    parser.add_argument('--resume', action='store_true', help='Skip courses completed in the interrupted last run (checkpoint file)')
+    parser.add_argument('--retry-failed', action='store_true', help='Process only the courses that failed in the last run (checkpoint file)')
+    parser.add_argument('--estimate', action='store_true', help='Dry-run one course\'s queries, print projected bytes scanned and cost, and exit')
+    parser.add_argument('--max-cost-usd', type=float, default=cost_estimate.DEFAULT_MAX_COST_USD, help='Abort before starting if the estimated cost exceeds this (default: $BQ_MAX_COST_USD, or no cap)')
+    parser.add_argument('--offline', action='store_true', help='Query the local snapshot (export_snapshot.py) with DuckDB and write JSON locally instead of GCS')
+    args = parser.parse_args()
+
+    # 途中の sys.exit や例外で抜けた場合も、finally で残りのアップロードとマニフェストを送り切る
+    storage_client = None
     try:
         print(f"🚀 Starting batch data export for {len(COURSES)} courses")
 
         # BigQueryとGCS クライアント
-        bq_client = bigquery.Client(project=PROJECT_ID)
-        storage_client = storage.Client(project=PROJECT_ID)
-
-        total_courses = 0
-        successful = 0
-        failed = 0
-
-        # 全コースを処理
+        if args.offline:
+            bq_client = OfflineClient()
+            backend = LocalBackend()
+            print(f"🗂️  Offline mode: snapshot {bq_client.snapshot_dir} → {backend.output_dir}")
+            state_dir = os.path.join(backend.output_dir, '.incremental')
+            checkpoint_dir = os.path.join(backend.output_dir, '.checkpoint')
+        else:
+            bq_client = bigquery.Client(project=PROJECT_ID)
+            if not args.no_cache:
+                bq_client = CachedClient(bq_client)
+            backend = GCSBackend(storage.Client(project=PROJECT_ID), pool_size=args.upload_workers)
+            state_dir = incremental.DEFAULT_STATE_DIR
+            checkpoint_dir = checkpoint.DEFAULT_CHECKPOINT_DIR
+        if not args.no_query_log:
+            # クエリごとの時間・処理バイト数・スロット時間を .query_log/ に記録する
+            bq_client = InstrumentedClient(bq_client, 'courses')
+        # 生成した JSON はキューに積み、クエリと並行して送る（最後にディレクトリの manifest.json を書き出す）
+        storage_client = UploadService(backend, workers=args.upload_workers,
+                                       publish_format=PublishFormat(args.json_layout, args.compression), manifest=True)
+
+        # 差分更新: 前回の実行以降に取り込まれたレースがあるコースだけに絞る
+        state = incremental.load_state('course', state_dir)
+        changes = incremental.detect_changes(bq_client, BATCH_ENTITY, state, full=not args.incremental)
+
+        # 見積もり: 代表の1コースのクエリを dry run して全体のスキャン量と料金を求め、予算を超えるなら始める前に止める
+        if args.estimate or args.max_cost_usd is not None:
+            targets = [
+                course for course in COURSES
+                if changes['full'] or course_key(course['venue'], course['surface'], course['distance'], course['track_variant']) in changes['affected']
+            ]
+            if targets:
+                sample = targets[0]
+                total = estimate_cost(bq_client, make_course(sample['venue'], sample['surface'], sample['distance'], sample['track_variant']),
+                                      len(targets), no_batch=args.no_batch)
+                if not args.estimate:
+                    cost_estimate.check_budget(total, args.max_cost_usd)
+            elif args.estimate:
+                cost_estimate.print_empty_estimate('courses')
+            # --estimate は対象がなくてもここで終える（まとめ取得・ランキングのクエリやアップロード、差分更新の状態の保存をしない）
+            if args.estimate:
+                return
+
+        # 全コース分のセクションを1クエリずつでまとめて取得
+        batch = None
+        if not args.no_batch:
+            print(f"   Prefetching {len(BATCH_SECTIONS)} sections for all courses...")
+            batch = batch_stats.prefetch_sections(bq_client, BATCH_ENTITY, BATCH_SECTIONS)
+
+        rankings = precompute_rankings(bq_client)
+
+        max_in_flight = cap_in_flight(args.workers, args.max_in_flight)
+        entities = []
+        keys_by_label = {}
         for course in COURSES:
             venue = course['venue']
             venue_en = course['venue_en']
@@ -1268,25 +1297,68 @@ def main():
             distance = course['distance']
             track_variant = course['track_variant']
 
-            total_courses += 1
+            key = course_key(venue, surface, distance, track_variant)
+            if not changes['full'] and key not in changes['affected']:
+                continue
+
+            prefetched = None
+            if batch:
+                prefetched = batch.for_entity(key)
+
+            label = f"{venue} {surface} {distance}m" + (f" ({track_variant})" if track_variant else "")
+            keys_by_label[label] = key
+            entities.append((
+                label,
+                (bq_client, storage_client, venue, venue_en, surface, surface_en, distance, track_variant, prefetched,
+                 max_in_flight, rankings),
+            ))
 
-            if process_course(bq_client, storage_client, venue, venue_en, surface, surface_en, distance, track_variant):
-                successful += 1
-            else:
-                failed += 1
+        if not changes['full']:
+            print(f"   Incremental: {len(entities)} courses to regenerate")
+
+        # 途中再開: --resume は前回完了したコースを飛ばし、--retry-failed は前回失敗したコースだけを処理する
+        progress = checkpoint.Checkpoint('course', checkpoint.mode_from_args(args), checkpoint_dir)
+        entities = progress.select(entities, checkpoint_key)
+
+        print(f"   Processing with {args.workers} workers (max in flight: {max_in_flight})")
+
+        # 全コースを処理
+        successful, failed = run_entities(
+            entities, progress.wrap(process_course, storage_client, checkpoint_key),
+            workers=args.workers, retries=args.retries,
+        )
+        progress.close()
+
+        # 失敗したコースは次回の差分更新でも処理する
+        failed_keys = [keys_by_label[label] for label in failed]
+        # アップロードに失敗したファイルがあれば、今回の対象を全件次回に持ち越す
+        storage_client.flush()
+        if storage_client.failed:
+            failed_keys = list(changes['affected'])
+        incremental.save_state('course', incremental.record_run(state, changes, failed_keys), state_dir)
 
         print(f"\n{'='*60}")
         print(f"✅ Batch processing complete!")
-        print(f"   Total courses: {total_courses}")
+        print(f"   Total courses: {len(entities)}")
         print(f"   Successful: {successful}")
-        print(f"   Failed: {failed}")
+        print(f"   Failed: {len(failed)}")
+        for label in failed:
+            print(f"     - {label}")
         print(f"{'='*60}")
 
+        if args.offline or not args.no_cache or not args.no_query_log:
+            bq_client.report()
+        storage_client.close()
+        storage_client.report()
+
     except Exception as e:
         print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if storage_client is not None:
+            storage_client.close()
 
 
 if __name__ == "__main__":
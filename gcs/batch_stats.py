@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+統計セクションを全エンティティ分まとめて BigQuery から取得する
+
+generate_jockeys.py などは1エンティティ × 1セクションごとにクエリを発行しているため、
+FULL MODE ではエンティティ数 × セクション数 回 race_master ⋈ race_result をスキャンする。
+ここでは1セクションにつき1回だけ `GROUP BY entity_key` したクエリを発行し、
+結果をメモリ上でエンティティごとに振り分ける（スキャン回数はセクション数のみ）。
+
+セクション定義（dict）:
+- name:     JSON のキー名（例: 'gate_stats'）
+- select:   集計軸の SELECT 式（エイリアス付き）。総合成績のように軸がない場合は空
+- group_by: 集計軸の GROUP BY 式
+- where:    追加の WHERE 条件（AND 区切り）
+- joins:    必要な JOIN 名のリスト（JOINS のキー）
+- metrics:  集計列（STANDARD_METRICS / RATE_METRICS など）
+- order_by: エンティティ内の並び順を決める Python のキー関数
+- rank_by:  rank 列を付与する場合の並び順キー関数（ROW_NUMBER 相当）
+- limit:    エンティティごとの最大件数（Top 50 など）
+- single:   True なら行のリストではなく1行（dict）を返す
+- rename:   結果の列名の付け替え（{SQL のエイリアス: JSON のキー名}）。
+            エイリアスが元の列名と同じだと GROUP BY がどちらを指すかがエンジンによって変わるため、
+            元の列と同じキー名で返したいときは別名で集計してここで戻す
+"""
+
+import sys
+from collections import defaultdict
+
+from query_stats import query_section
+
+DATASET = 'umadata.keiba_data'
+
+# 3年間の集計期間（各ジェネレーターと同じ条件）
+PERIOD_CONDITION = "rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)"
+
+# セクションが参照する JOIN 定義
+JOINS = {
+    'horse': f"JOIN `{DATASET}.horse` h ON CAST(rr.horse_id AS STRING) = CAST(h.horse_id AS STRING)",
+    'jockey': f"JOIN `{DATASET}.jockey` j ON CAST(rr.jockey_id AS STRING) = CAST(j.jockey_id AS STRING)",
+    'trainer': f"JOIN `{DATASET}.trainer` t ON CAST(rr.trainer_id AS STRING) = CAST(t.trainer_id AS STRING)",
+}
+
+# 勝率・連対率・複勝率のみ（騎手・調教師の総合成績）
+RATE_METRICS = """
+      COUNT(*) as races,
+      SUM(CASE WHEN rr.finish_position = 1 THEN 1 ELSE 0 END) as wins,
+      SUM(CASE WHEN rr.finish_position = 2 THEN 1 ELSE 0 END) as places_2,
+      SUM(CASE WHEN rr.finish_position = 3 THEN 1 ELSE 0 END) as places_3,
+      ROUND(AVG(CASE WHEN rr.finish_position = 1 THEN 1 ELSE 0 END) * 100, 1) as win_rate,
+      ROUND(AVG(CASE WHEN rr.finish_position <= 2 THEN 1 ELSE 0 END) * 100, 1) as quinella_rate,
+      ROUND(AVG(CASE WHEN rr.finish_position <= 3 THEN 1 ELSE 0 END) * 100, 1) as place_rate"""
+
+# 回収率なし・人気/着順あり（種牡馬の総合成績）
+RATE_RANK_METRICS = RATE_METRICS + """,
+      ROUND(AVG(rr.popularity), 1) as avg_popularity,
+      ROUND(AVG(rr.finish_position), 1) as avg_rank,
+      APPROX_QUANTILES(rr.popularity, 100)[OFFSET(50)] as median_popularity,
+      APPROX_QUANTILES(rr.finish_position, 100)[OFFSET(50)] as median_rank"""
+
+# 各セクション共通の集計列
+STANDARD_METRICS = RATE_METRICS + """,
+      ROUND(SAFE_DIVIDE(SUM(CASE WHEN rr.finish_position = 1 THEN rr.win ELSE 0 END), COUNT(*) * 100) * 100, 1) as win_payback,
+      ROUND(SAFE_DIVIDE(SUM(CASE WHEN rr.finish_position <= 3 THEN rr.place ELSE 0 END), COUNT(*) * 100) * 100, 1) as place_payback,
+      ROUND(AVG(rr.popularity), 1) as avg_popularity,
+      ROUND(AVG(rr.finish_position), 1) as avg_rank,
+      APPROX_QUANTILES(rr.popularity, 100)[OFFSET(50)] as median_popularity,
+      APPROX_QUANTILES(rr.finish_position, 100)[OFFSET(50)] as median_rank"""
+
+# 中央値のみ（中央・ローカル集計行用）
+MEDIAN_METRICS = """
+      APPROX_QUANTILES(rr.popularity, 100)[OFFSET(50)] as median_popularity,
+      APPROX_QUANTILES(rr.finish_position, 100)[OFFSET(50)] as median_rank"""
+
+
+def position(value, order):
+    """order 内の位置を返す（含まれない値は末尾扱い）"""
+    try:
+        return order.index(value)
+    except ValueError:
+        return len(order)
+
+
+def by_results(row):
+    """勝利数 → 2着数 → 3着数の降順、出走数の昇順"""
+    return (-(row['wins'] or 0), -(row['places_2'] or 0), -(row['places_3'] or 0), row['races'] or 0)
+
+
+DISTANCE_ORDER = ['短距離', 'マイル', '中距離', '長距離']
+SURFACE_ORDER = ['芝', 'ダート', '障害']
+POPULARITY_ORDER = ['fav1', 'fav2', 'fav3', 'fav4', 'fav5', 'fav6to9', 'fav10plus']
+CLASS_ORDER = ['G1', 'G2', 'G3', 'オープン', '3勝', '2勝', '1勝', '未勝利', '新馬']
+GENDER_ORDER = ['牡馬', '牝馬', 'セン馬']
+TRACK_CONDITION_ORDER = ['良', '稍', '重', '不']
+SHORT_SURFACE_ORDER = ['芝', 'ダ', '障']
+HORSE_WEIGHT_ORDER = [
+    '400kg以下', '401-420kg', '421-440kg', '441-460kg', '461-480kg',
+    '481-500kg', '501-520kg', '521-540kg', '541kg以上',
+]
+CENTRAL_RACECOURSES = ['東京', '中山', '阪神', '京都']
+LOCAL_RACECOURSES = ['札幌', '函館', '福島', '新潟', '中京', '小倉']
+
+
+# ========================================
+# 標準セクション定義
+# ========================================
+
+def total_section(metrics=RATE_METRICS):
+    """総合成績"""
+    return {'name': 'total_stats', 'metrics': metrics, 'single': True}
+
+
+def yearly_section():
+    """年度別成績"""
+    return {
+        'name': 'yearly_stats',
+        'select': "EXTRACT(YEAR FROM rm.race_date) as year",
+        'group_by': "year",
+        'order_by': lambda r: -r['year'],
+    }
+
+
+def distance_section():
+    """距離別成績"""
+    return {
+        'name': 'distance_stats',
+        'select': """CASE
+        WHEN rm.distance <= 1400 THEN '短距離'
+        WHEN rm.distance <= 1800 THEN 'マイル'
+        WHEN rm.distance <= 2100 THEN '中距離'
+        ELSE '長距離'
+      END as category""",
+        'group_by': "category",
+        'order_by': lambda r: position(r['category'], DISTANCE_ORDER),
+    }
+
+
+def surface_section(only_known=True):
+    """芝・ダート・障害別成績（only_known=False なら他の路面も含める）"""
+    return {
+        'name': 'surface_stats',
+        'select': "rm.surface as surface",
+        'group_by': "surface",
+        'where': "rm.surface IN ('芝', 'ダート', '障害')" if only_known else "",
+        'order_by': lambda r: position(r['surface'], SURFACE_ORDER),
+    }
+
+
+def popularity_section():
+    """人気別成績"""
+    return {
+        'name': 'popularity_stats',
+        'select': """CASE
+        WHEN rr.popularity = 1 THEN 'fav1'
+        WHEN rr.popularity = 2 THEN 'fav2'
+        WHEN rr.popularity = 3 THEN 'fav3'
+        WHEN rr.popularity = 4 THEN 'fav4'
+        WHEN rr.popularity = 5 THEN 'fav5'
+        WHEN rr.popularity BETWEEN 6 AND 9 THEN 'fav6to9'
+        WHEN rr.popularity >= 10 THEN 'fav10plus'
+      END as popularity_group""",
+        'group_by': "popularity_group",
+        'where': "rr.popularity IS NOT NULL",
+        'order_by': lambda r: position(r['popularity_group'], POPULARITY_ORDER),
+    }
+
+
+def gate_section(valid_only=False):
+    """枠順別成績（valid_only=True なら1〜8枠のみ）"""
+    return {
+        'name': 'gate_stats',
+        'select': "rr.bracket_number as gate",
+        'group_by': "gate",
+        'where': "rr.bracket_number BETWEEN 1 AND 8" if valid_only else "",
+        'order_by': lambda r: (r['gate'] is not None, r['gate'] or 0),
+    }
+
+
+def class_section():
+    """クラス別成績"""
+    return {
+        'name': 'class_stats',
+        'select': """CASE
+        WHEN rm.grade = 'G1' THEN 'G1'
+        WHEN rm.grade = 'G2' THEN 'G2'
+        WHEN rm.grade = 'G3' THEN 'G3'
+        WHEN rm.race_class = 'オープン' AND rm.grade IS NULL THEN 'オープン'
+        WHEN rm.race_class = '３勝クラス' THEN '3勝'
+        WHEN rm.race_class = '２勝クラス' THEN '2勝'
+        WHEN rm.race_class = '１勝クラス' THEN '1勝'
+        WHEN rm.race_class = '未勝利' THEN '未勝利'
+        WHEN rm.race_class = '新馬' THEN '新馬'
+        ELSE rm.race_class
+      END as class_name""",
+        'group_by': "class_name",
+        'where': "rm.race_class IS NOT NULL",
+        'order_by': lambda r: position(r['class_name'], CLASS_ORDER),
+        'rank_by': lambda r: position(r['class_name'], CLASS_ORDER),
+    }
+
+
+def track_condition_section():
+    """馬場状態別成績（路面は1文字表記）"""
+    return {
+        'name': 'track_condition_stats',
+        'select': """CASE rm.surface
+        WHEN 'ダート' THEN 'ダ'
+        WHEN '障害' THEN '障'
+        ELSE rm.surface
+      END as surface,
+      rm.track_condition as condition,
+      rm.track_condition as condition_label""",
+        'group_by': "surface, condition, condition_label",
+        'where': "rm.track_condition IS NOT NULL AND rm.surface IN ('芝', 'ダート', '障害')",
+        'order_by': lambda r: (
+            position(r['surface'], SHORT_SURFACE_ORDER),
+            position(r['condition'][:1] if r['condition'] else None, TRACK_CONDITION_ORDER),
+        ),
+    }
+
+
+def gender_section():
+    """性別成績"""
+    return {
+        'name': 'gender_stats',
+        'select': """CASE rr.sex
+        WHEN 1 THEN '牡馬'
+        WHEN 2 THEN '牝馬'
+        WHEN 3 THEN 'セン馬'
+        ELSE '不明'
+      END as name""",
+        'group_by': "name",
+        'where': "rr.sex IS NOT NULL",
+        'order_by': lambda r: position(r['name'], GENDER_ORDER),
+    }
+
+
+def horse_weight_section():
+    """馬体重別成績"""
+    return {
+        'name': 'horse_weight_stats',
+        'select': """CASE
+        WHEN rr.horse_weight <= 400 THEN '400kg以下'
+        WHEN rr.horse_weight BETWEEN 401 AND 420 THEN '401-420kg'
+        WHEN rr.horse_weight BETWEEN 421 AND 440 THEN '421-440kg'
+        WHEN rr.horse_weight BETWEEN 441 AND 460 THEN '441-460kg'
+        WHEN rr.horse_weight BETWEEN 461 AND 480 THEN '461-480kg'
+        WHEN rr.horse_weight BETWEEN 481 AND 500 THEN '481-500kg'
+        WHEN rr.horse_weight BETWEEN 501 AND 520 THEN '501-520kg'
+        WHEN rr.horse_weight BETWEEN 521 AND 540 THEN '521-540kg'
+        WHEN rr.horse_weight >= 541 THEN '541kg以上'
+      END as weight_category""",
+        'group_by': "weight_category",
+        'where': "rr.horse_weight IS NOT NULL AND rr.horse_weight > 0",
+        'order_by': lambda r: position(r['weight_category'], HORSE_WEIGHT_ORDER),
+    }
+
+
+def age_section():
+    """馬齢別成績（6歳以上はまとめて '6歳-'）"""
+    return {
+        'name': 'age_stats',
+        'select': """CASE
+        WHEN rr.age >= 6 THEN '6歳-'
+        ELSE CONCAT(CAST(rr.age AS STRING), '歳')
+      END as age_group""",
+        # rr.age と同じ名前にすると GROUP BY age が元の列（馬齢そのもの）を指すエンジンがあるので別名で集計する
+        'group_by': "age_group",
+        'where': "rr.age >= 2",
+        'rename': {'age_group': 'age'},
+        'order_by': lambda r: r['age'],
+    }
+
+
+def racecourse_section():
+    """競馬場別成績（中央・ローカル集計行は各ジェネレーター側で付与）"""
+    return {
+        'name': 'racecourse_stats',
+        'select': """rm.venue_name as name,
+      rm.venue_name as racecourse_ja,
+      CASE rm.venue_name
+        WHEN '札幌' THEN 'sapporo'
+        WHEN '函館' THEN 'hakodate'
+        WHEN '福島' THEN 'fukushima'
+        WHEN '新潟' THEN 'niigata'
+        WHEN '東京' THEN 'tokyo'
+        WHEN '中山' THEN 'nakayama'
+        WHEN '中京' THEN 'chukyo'
+        WHEN '京都' THEN 'kyoto'
+        WHEN '阪神' THEN 'hanshin'
+        WHEN '小倉' THEN 'kokura'
+      END as racecourse_en""",
+        'group_by': "name, racecourse_ja, racecourse_en",
+        'order_by': lambda r: -(r['wins'] or 0),
+    }
+
+
+def racecourse_region_median_section():
+    """中央・ローカル別の人気/着順中央値（集計行の中央値は全レースから直接計算する）"""
+    central = ', '.join(f"'{v}'" for v in CENTRAL_RACECOURSES)
+    local = ', '.join(f"'{v}'" for v in LOCAL_RACECOURSES)
+    return {
+        'name': 'racecourse_region_medians',
+        'select': f"""CASE
+        WHEN rm.venue_name IN ({central}) THEN 'central'
+        WHEN rm.venue_name IN ({local}) THEN 'local'
+      END as region""",
+        'group_by': "region",
+        'where': f"rm.venue_name IN ({central}, {local})",
+        'metrics': MEDIAN_METRICS,
+    }
+
+
+def owner_section(limit=50):
+    """馬主別成績（Top 50）"""
+    return {
+        'name': 'owner_stats',
+        'select': "h.owner_name as name",
+        'group_by': "name",
+        'where': "h.owner_name IS NOT NULL",
+        'joins': ['horse'],
+        'order_by': by_results,
+        'rank_by': by_results,
+        'limit': limit,
+    }
+
+
+def trainer_section(limit=50):
+    """調教師別成績（現役のみ、Top 50）"""
+    return {
+        'name': 'trainer_stats',
+        'select': "t.trainer_id as trainer_id, t.trainer_name as name",
+        'group_by': "t.trainer_id, t.trainer_name",
+        'where': "t.is_active = true",
+        'joins': ['trainer'],
+        'order_by': by_results,
+        'rank_by': by_results,
+        'limit': limit,
+    }
+
+
+def ranking_section(name, column, joins, where, limit=50):
+    """名前別ランキング（コースの騎手・調教師・種牡馬・母父 Top 50）
+
+    rank は勝利数 → 勝率 → 名前、並び順は勝利数 → 2着数 → 3着数 → 名前
+    """
+    return {
+        'name': name,
+        'select': f"{column} as name",
+        'group_by': "name",
+        'where': where,
+        'joins': joins,
+        'order_by': lambda r: (-(r['wins'] or 0), -(r['places_2'] or 0), -(r['places_3'] or 0), r['name']),
+        'rank_by': lambda r: (-(r['wins'] or 0), -(r['win_rate'] or 0), r['name']),
+        'limit': limit,
+    }
+
+
+# ========================================
+# クエリ生成と実行
+# ========================================
+
+def build_grouped_query(entity, section):
+    """セクションを全エンティティ分集計するクエリを生成する
+
+    entity: {'key': エンティティキーの SQL 式, 'joins': [...], 'where': 追加条件}
+    """
+    join_names = []
+    for name in list(entity.get('joins', [])) + list(section.get('joins', [])):
+        if name not in join_names:
+            join_names.append(name)
+    joins = '\n      '.join(JOINS[name] for name in join_names)
+
+    select = section.get('select', '')
+    group_by = section.get('group_by', '')
+    conditions = [PERIOD_CONDITION, f"{entity['key']} IS NOT NULL"]
+    for condition in (entity.get('where'), section.get('where')):
+        if condition:
+            conditions.append(condition)
+    where = '\n      AND '.join(conditions)
+
+    return f"""
+    SELECT
+      CAST({entity['key']} AS STRING) as entity_key,
+      {select + ',' if select else ''}{section.get('metrics', STANDARD_METRICS)}
+    FROM
+      `{DATASET}.race_master` rm
+      JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+      {joins}
+    WHERE
+      {where}
+    GROUP BY entity_key{', ' + group_by if group_by else ''}
+    """
+
+
+def split_by_entity(rows, section):
+    """集計結果をエンティティごとに振り分け、並び順・rank・件数上限を適用する"""
+    rename = section.get('rename', {})
+    grouped = defaultdict(list)
+    for row in rows:
+        row = {rename.get(column, column): value for column, value in dict(row).items()}
+        key = row.pop('entity_key')
+        grouped[key].append(row)
+
+    result = {}
+    for key, entity_rows in grouped.items():
+        if section.get('single'):
+            result[key] = entity_rows[0]
+            continue
+
+        rank_by = section.get('rank_by')
+        if rank_by:
+            for rank, row in enumerate(sorted(entity_rows, key=rank_by), 1):
+                row['rank'] = rank
+        order_by = section.get('order_by')
+        if order_by:
+            entity_rows.sort(key=order_by)
+        if section.get('limit'):
+            entity_rows = entity_rows[:section['limit']]
+        if rank_by:
+            entity_rows = [{'rank': row.pop('rank'), **row} for row in entity_rows]
+        result[key] = entity_rows
+    return result
+
+
+def fetch_grouped_section(client, entity, section):
+    """1セクションを全エンティティ分まとめて取得する（{entity_key: rows}）"""
+    query = build_grouped_query(entity, section)
+    try:
+        results = client.query(query).result()
+        return split_by_entity(results, section)
+    except Exception as e:
+        print(f"   ⚠️  Error fetching grouped {section['name']}: {str(e)}", file=sys.stderr)
+        raise
+
+
+class BatchStats:
+    """全エンティティ分の集計結果を保持し、エンティティ単位で取り出す"""
+
+    def __init__(self, sections, results):
+        self.sections = sections
+        self.results = results
+
+    def for_entity(self, entity_key):
+        """1エンティティ分のセクションを {name: rows} で返す（該当なしは [] / None）"""
+        key = str(entity_key)
+        data = {}
+        for section in self.sections:
+            default = None if section.get('single') else []
+            data[section['name']] = self.results[section['name']].get(key, default)
+        return data
+
+
+def prefetch_sections(client, entity, sections):
+    """全セクションを1回ずつ集計する（クエリ数 = セクション数）"""
+    results = {}
+    for i, section in enumerate(sections, 1):
+        print(f"  [batch {i}/{len(sections)}] Fetching {section['name']} for all entities...")
+        with query_section(f"batch:{section['name']}"):
+            results[section['name']] = fetch_grouped_section(client, entity, section)
+    return BatchStats(sections, results)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ジェネレーターが参照する派生テーブルを BigQuery 上に作成する
+
+race_master / race_result を更新したあと、各ジェネレーターを実行する前に1回だけ実行する。
+
+Usage:
+    python3 build_derived_tables.py                  # 全テーブルを作り直す
+    python3 build_derived_tables.py --table race_result_enriched
+"""
+
+import argparse
+import os
+import sys
+
+from google.cloud import bigquery
+
+PROJECT_ID = 'umadata'
+DATASET = 'umadata.keiba_data'
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 作成順（後のテーブルが前のテーブルを参照してもよい）: (テーブル名, SQLファイル)
+DERIVED_TABLES = [
+    ('race_result_enriched', 'race_result_enriched.sql'),
+    ('race_payout', 'race_payout.sql'),
+]
+
+
+def build_table(client, table_name, sql_file):
+    """SQLファイルを実行してテーブルを作り直す"""
+    with open(os.path.join(SCRIPT_DIR, sql_file), 'r', encoding='utf-8') as f:
+        sql = f.read()
+
+    print(f"🔨 Building {DATASET}.{table_name} ({sql_file})...")
+    client.query(sql).result()
+
+    table = client.get_table(f"{DATASET}.{table_name}")
+    print(f"  ✅ {table.num_rows:,} rows, {table.num_bytes / 1024 ** 2:,.1f} MB")
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='Build derived BigQuery tables used by the generators')
+    parser.add_argument('--table', choices=[name for name, _ in DERIVED_TABLES], help='Build only this table')
+    args = parser.parse_args()
+
+    try:
+        client = bigquery.Client(project=PROJECT_ID)
+        for table_name, sql_file in DERIVED_TABLES:
+            if args.table and table_name != args.table:
+                continue
+            build_table(client, table_name, sql_file)
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ track_variant の値を調査
 
 from google.cloud import bigquery
 
+from query_cache import CachedClient
+
 PROJECT_ID = 'umadata'
 DATASET = 'umadata.keiba_data'
 
@@ -66,7 +68,7 @@ def main():
     print("🔍 Track Variant Investigation Tool")
     print("="*60)
 
-    client = bigquery.Client(project=PROJECT_ID)
+    client = CachedClient(bigquery.Client(project=PROJECT_ID))
 
     for course in TEST_COURSES:
         check_track_variant(
@@ -78,6 +80,7 @@ def main():
 
     print(f"\n{'='*60}")
     print("✅ Investigation complete!")
+    client.report()
 
 
 if __name__ == "__main__":
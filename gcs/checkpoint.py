@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FULL MODE の途中再開
+
+FULL MODE の実行が途中で止まると、これまでは最初からやり直すしかなかった。
+ここではエンティティの処理が終わるたびに、チェックポイントファイル（{checkpoint_dir}/{kind}.jsonl）へ
+1行ずつ完了記録を追記する。
+
+    {"key": "00666", "status": "done", "content_hash": "...", "time": "2025-01-01T12:00:00"}
+
+- status:       done（生成したファイルのアップロードまで終わった）/ failed
+- content_hash: そのエンティティで保存したファイルの内容のハッシュ（uploads.content_hash）をまとめたもの
+
+通常の実行ではファイルを空にしてから書き始める。
+- --resume:       前回の記録で done のエンティティを飛ばし、残り（失敗・未着手）だけを処理する
+- --retry-failed: 前回の記録で failed のエンティティだけを処理する
+どちらも同じファイルに追記していくので、何度止まっても続きから再開できる。
+1行ごとに fsync するので、プロセスが強制終了しても書き終えた記録は残る（途中で切れた最終行は読み飛ばす）。
+
+差分更新（incremental.py）の状態は実行の最後に保存するので、
+--incremental の実行が止まった場合も --incremental --resume で同じ対象の残りから再開できる。
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+# チェックポイントの保存先
+DEFAULT_CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.checkpoint'))
+
+# 実行モード
+FRESH = 'fresh'
+RESUME = 'resume'
+RETRY_FAILED = 'retry-failed'
+
+
+def mode_from_args(args):
+    """--resume / --retry-failed から実行モードを決める"""
+    if args.resume and args.retry_failed:
+        raise ValueError("--resume and --retry-failed cannot be used together")
+    if args.resume:
+        return RESUME
+    if args.retry_failed:
+        return RETRY_FAILED
+    return FRESH
+
+
+def load_records(path):
+    """チェックポイントの記録をエンティティごとの最後の1行にまとめて {key: record} で返す"""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で止まった行
+                continue
+            records[record['key']] = record
+    return records
+
+
+def entity_hash(hashes):
+    """エンティティで保存したファイルごとのハッシュ（{path: hash}）を1つにまとめる"""
+    digest = hashlib.sha256()
+    for path, value in sorted(hashes.items()):
+        digest.update(f"{path}\t{value}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """エンティティごとの完了記録
+
+    kind:           ファイル名（jockey / trainer / sire / course）
+    mode:           FRESH / RESUME / RETRY_FAILED
+    checkpoint_dir: 保存先
+    """
+
+    def __init__(self, kind, mode=FRESH, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+        self.kind = kind
+        self.mode = mode
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(checkpoint_dir, f"{kind}.jsonl")
+        self.previous = {} if mode == FRESH else load_records(self.path)
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'w' if mode == FRESH else 'a', encoding='utf-8')
+        if mode != FRESH and self._file.tell() > 0:
+            # 途中で切れた最終行に続けて書かないよう、改行で終わっていなければ改行を足す
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def select(self, entities, key_of):
+        """実行モードに合わせて処理するエンティティに絞る
+
+        entities: run_entities に渡す [(label, args)]
+        key_of:   args からエンティティのキー（文字列）を返す関数
+        """
+        if self.mode == FRESH:
+            return entities
+        if self.mode == RESUME:
+            selected = [(label, args) for label, args in entities
+                        if self.previous.get(key_of(args), {}).get('status') != 'done']
+            print(f"   Resume: skipping {len(entities) - len(selected)} completed, {len(selected)} remaining ({self.path})")
+        else:
+            selected = [(label, args) for label, args in entities
+                        if self.previous.get(key_of(args), {}).get('status') == 'failed']
+            print(f"   Retry failed: {len(selected)} failed in the last run ({self.path})")
+        return selected
+
+    def record(self, key, ok, content_hash=None):
+        """1エンティティ分の記録を追記する"""
+        line = json.dumps({
+            'key': key,
+            'status': 'done' if ok else 'failed',
+            'content_hash': content_hash,
+            'time': datetime.now().isoformat(timespec='seconds'),
+        }, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def wrap(self, worker, storage_client, key_of):
+        """worker を包み、アップロードまで終わったら done、失敗したら failed を記録する"""
+        def run(*args):
+            key = key_of(args)
+            ok = False
+            content_hash = None
+            try:
+                with storage_client.track() as uploads:
+                    ok = worker(*args)
+                if ok:
+                    hashes = storage_client.settle(uploads)
+                    failed = [path for path, value in hashes.items() if value is None]
+                    if failed:
+                        print(f"   ⚠️  Error uploading {key}: {', '.join(failed)}", file=sys.stderr)
+                        ok = False
+                    else:
+                        content_hash = entity_hash(hashes)
+                return ok
+            finally:
+                self.record(key, ok, content_hash)
+
+        return run
+
+    def close(self):
+        with self._lock:
+            self._file.close()
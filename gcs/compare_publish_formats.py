@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公開する JSON の形式ごとのサイズと取得時間を比較する
+
+ローカルに生成した JSON（--offline の出力先など）を読み込み、publish_format.py の各形式で書き出し直して
+- サイズ（合計・平均・p95）と pretty に対する比率
+- 書き出し時間（JSON 化 + 圧縮）
+- 読み込み時間（展開 + JSON.parse 相当 + 列形式の復元）
+- 取得時間の見積もり（RTT + サイズ / 帯域 + 読み込み時間）
+を表示する。lib/get*DataFromGCS.ts はページを描画するたびに JSON を取得するので、1件あたりの取得時間で比べる。
+読み込み時間は Python での計測なので、ブラウザ・Node での絶対値ではなく形式間の比較に使う。
+
+Usage:
+    python3 generate_jockeys.py --offline                    # 比較用の JSON をローカルに生成
+    python3 compare_publish_formats.py                       # offline_output/umadata 以下の全 JSON
+    python3 compare_publish_formats.py --prefix jockey/ --bandwidth-mbps 10 --rtt-ms 80
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from publish_format import COMPRESSIONS, JSON_LAYOUTS, PublishFormat, brotli, decode, from_columnar
+from uploads import DEFAULT_OUTPUT_DIR, LocalBackend
+
+BUCKET_NAME = 'umadata'
+
+# 取得時間の見積もりに使う回線（モバイル回線程度）
+DEFAULT_BANDWIDTH_MBPS = 20
+DEFAULT_RTT_MS = 50
+
+
+def load_documents(backend, bucket_name, prefix):
+    """保存済みの JSON を読み込んで (パス, ドキュメント) のリストで返す（圧縮・列形式は元に戻す）"""
+    documents = []
+    root = os.path.join(backend.output_dir, bucket_name)
+    for dirpath, _, filenames in os.walk(os.path.join(root, prefix)):
+        for filename in sorted(filenames):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            content_encoding = (backend.metadata(bucket_name, name) or {}).get('content_encoding')
+            documents.append((name, from_columnar(json.loads(decode(data, content_encoding)))))
+    return documents
+
+
+def measure(publish_format, documents):
+    """形式ごとのサイズと書き出し・読み込み時間（1件ずつ）"""
+    sizes, encode_seconds, decode_seconds = [], [], []
+    for _, document in documents:
+        start = time.perf_counter()
+        data = publish_format.encode(publish_format.dumps(document).encode('utf-8'))
+        encode_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        parsed = json.loads(decode(data, publish_format.content_encoding))
+        if publish_format.layout == 'columnar':
+            parsed = from_columnar(parsed)
+        decode_seconds.append(time.perf_counter() - start)
+
+        if parsed != document:
+            raise ValueError(f"{publish_format.label} does not round-trip")
+        sizes.append(len(data))
+    return sizes, encode_seconds, decode_seconds
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='Compare published JSON sizes and fetch latency across publish formats')
+    parser.add_argument('--dir', default=DEFAULT_OUTPUT_DIR, help=f'Local output directory with generated JSON (default: {DEFAULT_OUTPUT_DIR})')
+    parser.add_argument('--prefix', default='', help='Only compare objects under this prefix (e.g. jockey/)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=DEFAULT_BANDWIDTH_MBPS, help=f'Bandwidth for the fetch estimate (default: {DEFAULT_BANDWIDTH_MBPS})')
+    parser.add_argument('--rtt-ms', type=float, default=DEFAULT_RTT_MS, help=f'Round-trip time for the fetch estimate (default: {DEFAULT_RTT_MS})')
+    args = parser.parse_args()
+
+    try:
+        documents = load_documents(LocalBackend(args.dir), BUCKET_NAME, args.prefix)
+        if not documents:
+            raise RuntimeError(f"No JSON found under {os.path.join(args.dir, BUCKET_NAME, args.prefix)}; run a generator with --offline first")
+
+        print(f"📊 Comparing publish formats over {len(documents)} documents "
+              f"({args.bandwidth_mbps:g} Mbps, RTT {args.rtt_ms:g} ms)")
+
+        compressions = [c for c in COMPRESSIONS if c != 'br' or brotli is not None]
+        if len(compressions) < len(COMPRESSIONS):
+            print("   ⚠️  brotli is not installed; skipping br")
+
+        print(f"\n{'format':<18}{'total MB':>10}{'avg KB':>9}{'p95 KB':>9}{'ratio':>8}"
+              f"{'encode ms':>11}{'decode ms':>11}{'fetch ms':>10}")
+        baseline = None
+        for layout in JSON_LAYOUTS:
+            for compression in compressions:
+                publish_format = PublishFormat(layout, compression)
+                sizes, encode_seconds, decode_seconds = measure(publish_format, documents)
+
+                total = sum(sizes)
+                baseline = baseline or total
+                avg_size = total / len(sizes)
+                avg_decode_ms = sum(decode_seconds) * 1000 / len(decode_seconds)
+                transfer_ms = avg_size * 8 / (args.bandwidth_mbps * 1000 ** 2) * 1000
+                print(f"{publish_format.label:<18}{total / 1024 ** 2:>10,.2f}{avg_size / 1024:>9,.1f}"
+                      f"{percentile(sizes, 95) / 1024:>9,.1f}{total / baseline:>8.1%}"
+                      f"{sum(encode_seconds) * 1000 / len(encode_seconds):>11.2f}{avg_decode_ms:>11.2f}"
+                      f"{args.rtt_ms + transfer_ms + avg_decode_ms:>10.1f}")
+
+        print("\nfetch ms = RTT + avg size / bandwidth + decode ms (per document)")
+
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
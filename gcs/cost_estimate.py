@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FULL MODE の実行前に BigQuery のスキャン量と料金を見積もる
+
+DryRunClient はクエリを dry run（実行せず、スキャンするバイト数だけを求める。料金はかからない）で発行し、
+セクションごとのバイト数を記録して空の結果を返す。
+- 実行全体で1回だけのクエリ（batch_stats のまとめ取得・ランキング）は1回分
+- エンティティごとのクエリ（基本情報・まとめ取得しないセクション）は代表の1エンティティを dry run して × エンティティ数
+として合計し、オンデマンド料金で換算する。
+
+BigQuery はクエリごとに最低 10 MB を課金するので、課金バイト数はクエリごとに 10 MB に切り上げる。
+ディスクキャッシュ（query_cache）や BigQuery のキャッシュに当たった分は実際には課金されないため、
+見積もりは上限の目安になる。対象エンティティの一覧と差分更新の判定のクエリは見積もりの前に実行される。
+dry run のクエリ自体が失敗した場合（構文エラー・権限など）は、そのクエリの分が抜けて見積もりが低くなるので、
+見積もりを出さずに止める（DryRunError）。
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+
+from google.cloud import bigquery
+
+from offline_client import OfflineClient
+from query_cache import CachedClient, _CachedJob
+from query_stats import InstrumentedClient, current_section, query_section
+
+# オンデマンド料金（USD / TiB）と、予算の上限のデフォルト（未設定なら上限なし）
+USD_PER_TIB = float(os.environ.get('BQ_USD_PER_TIB', '6.25'))
+DEFAULT_MAX_COST_USD = float(os.environ['BQ_MAX_COST_USD']) if os.environ.get('BQ_MAX_COST_USD') else None
+
+# クエリごとの最低課金バイト数
+MIN_BILLED_BYTES = 10 * 1024 ** 2
+
+
+class BudgetExceededError(RuntimeError):
+    """見積もりが予算の上限を超えた"""
+
+
+class DryRunError(RuntimeError):
+    """dry run のクエリが失敗した（見積もりにそのクエリの分が入らない）"""
+
+
+class DryRunClient:
+    """クエリを dry run してセクションごとのスキャン量を記録するクライアント（結果は常に空）"""
+
+    def __init__(self, client):
+        while isinstance(client, (InstrumentedClient, CachedClient)):
+            client = client.client
+        if isinstance(client, OfflineClient):
+            raise RuntimeError("Cost estimates need BigQuery; they are not available with --offline")
+        self.client = client
+        self.records = []   # [{'section', 'bytes', 'count'}]
+        self.failures = []  # [(section, エラー)]
+        self._count = 1
+
+    @contextmanager
+    def per_entity(self, count):
+        """この中で発行したクエリを count 回分として数える"""
+        previous, self._count = self._count, count
+        try:
+            yield
+        finally:
+            self._count = previous
+
+    def query(self, query, job_config=None):
+        job_config = job_config or bigquery.QueryJobConfig()
+        job_config.dry_run = True
+        job_config.use_query_cache = False
+        section, _ = current_section()
+        try:
+            job = self.client.query(query, job_config=job_config)
+        except Exception as e:
+            # エラーを握りつぶす getter があっても、print_estimate で見積もりを止められるように記録する
+            self.failures.append((section, e))
+            raise DryRunError(f"Dry run failed for {section or '(unknown)'}: {e}") from e
+        self.records.append({'section': section, 'bytes': job.total_bytes_processed or 0, 'count': self._count})
+        return _CachedJob([], source='dry_run')
+
+
+def dry_run_sections(client, sections, args=(), skip=()):
+    """セクションの getter を1回ずつ dry run する
+
+    結果が空なので、空の結果を想定していない getter は失敗することがある。
+    スキャン量はクエリの発行時に記録済みなので、その失敗は無視する。dry run のクエリ自体の失敗（DryRunError）は止める。
+    """
+    for name, getter in sections:
+        if name in skip:
+            continue
+        with query_section(name, args[0] if args else None):
+            try:
+                getter(client, *args)
+            except DryRunError:
+                raise
+            except Exception:
+                pass
+
+
+def summarize(client):
+    """見積もりの合計（処理バイト数・課金バイト数・料金）"""
+    processed = sum(r['bytes'] * r['count'] for r in client.records)
+    billed = sum(max(r['bytes'], MIN_BILLED_BYTES) * r['count'] for r in client.records)
+    return {
+        'queries': sum(r['count'] for r in client.records),
+        'bytes_processed': processed,
+        'bytes_billed': billed,
+        'cost_usd': billed / 1024 ** 4 * USD_PER_TIB,
+    }
+
+
+def print_estimate(client, entity_count, label):
+    """セクションごとの見積もりと合計を表示して合計を返す（失敗した dry run があれば DryRunError）"""
+    if client.failures:
+        for section, error in client.failures:
+            print(f"   ⚠️  Dry run failed for {section or '(unknown)'}: {error}", file=sys.stderr)
+        raise DryRunError(f"{len(client.failures)} dry-run queries failed, so the estimate would be too low")
+
+    print(f"\n💰 Estimated BigQuery cost for {entity_count} {label} (dry run, ${USD_PER_TIB:g}/TiB on-demand)")
+    print(f"{'section':<40}{'GB/query':>10}{'queries':>9}{'GB total':>10}")
+    for record in sorted(client.records, key=lambda r: r['bytes'] * r['count'], reverse=True):
+        print(f"{(record['section'] or '(unknown)')[:39]:<40}{record['bytes'] / 1024 ** 3:>10.3f}"
+              f"{record['count']:>9,}{record['bytes'] * record['count'] / 1024 ** 3:>10.2f}")
+
+    total = summarize(client)
+    print(f"   Total: {total['queries']:,} queries, {total['bytes_processed'] / 1024 ** 4:,.3f} TiB processed, "
+          f"{total['bytes_billed'] / 1024 ** 4:,.3f} TiB billed → ${total['cost_usd']:,.2f}")
+    print("   (cache hits are not billed, so this is an upper bound)")
+    return total
+
+
+def print_empty_estimate(label):
+    """対象がないときの見積もり（クエリを発行しないので 0）を表示する"""
+    print(f"\n💰 Estimated BigQuery cost for 0 {label}: nothing to regenerate → $0.00")
+
+
+def check_budget(total, max_cost_usd):
+    """見積もりが予算の上限を超えていたら実行前に止める"""
+    if max_cost_usd is not None and total['cost_usd'] > max_cost_usd:
+        raise BudgetExceededError(
+            f"Estimated cost ${total['cost_usd']:,.2f} exceeds the budget of ${max_cost_usd:,.2f}; "
+            f"narrow the run (--incremental) or raise --max-cost-usd"
+        )
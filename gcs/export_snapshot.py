@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ジェネレーターの --offline モードで使うローカルスナップショットを書き出す
+
+過去3年分の race_master / race_result と、派生テーブル・マスタのうちジェネレーターが参照する列を
+Parquet で保存する。build_derived_tables.py で派生テーブルを作ったあとに実行する。
+
+Usage:
+    python3 export_snapshot.py                       # gcs/.snapshot に書き出す
+    python3 export_snapshot.py --dir /tmp/snapshot
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date
+
+from google.cloud import bigquery
+
+from offline_client import DEFAULT_SNAPSHOT_DIR, SNAPSHOT_META_FILE
+from query_params import run_query
+
+PROJECT_ID = 'umadata'
+DATASET = 'umadata.keiba_data'
+
+# ジェネレーターの集計期間
+RECENT_RACES = f"SELECT race_id FROM `{DATASET}.race_master` WHERE race_date >= DATE_SUB(@snapshot_date, INTERVAL 3 YEAR)"
+
+# (テーブル名, 書き出すクエリ)
+SNAPSHOT_TABLES = [
+    ('race_master', f"SELECT * FROM `{DATASET}.race_master` WHERE race_id IN ({RECENT_RACES})"),
+    ('race_result', f"SELECT * FROM `{DATASET}.race_result` WHERE race_id IN ({RECENT_RACES})"),
+    ('race_result_enriched', f"SELECT * FROM `{DATASET}.race_result_enriched` WHERE race_id IN ({RECENT_RACES})"),
+    ('race_payout', f"SELECT * FROM `{DATASET}.race_payout` WHERE race_id IN ({RECENT_RACES})"),
+    # 種牡馬の産駒数は期間で絞らずに数えるので全頭分（列は参照するものだけ）
+    ('horse', f"SELECT horse_id, horse_name, father, mf, owner_name FROM `{DATASET}.horse`"),
+    ('jockey', f"SELECT * FROM `{DATASET}.jockey`"),
+    ('trainer', f"SELECT * FROM `{DATASET}.trainer`"),
+]
+
+
+def export_table(client, snapshot_dir, table_name, query, snapshot_date):
+    """クエリ結果を Parquet に書き出す"""
+    import pyarrow.parquet as pq
+
+    print(f"📦 Exporting {table_name}...")
+    table = run_query(client, query, {'snapshot_date': snapshot_date}).to_arrow()
+
+    path = os.path.join(snapshot_dir, f"{table_name}.parquet")
+    pq.write_table(table, path)
+    print(f"  ✅ {table.num_rows:,} rows, {os.path.getsize(path) / 1024 ** 2:,.1f} MB")
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='Export a local Parquet snapshot for --offline generator runs')
+    parser.add_argument('--dir', default=DEFAULT_SNAPSHOT_DIR, help=f'Snapshot directory (default: {DEFAULT_SNAPSHOT_DIR})')
+    args = parser.parse_args()
+
+    try:
+        client = bigquery.Client(project=PROJECT_ID)
+        os.makedirs(args.dir, exist_ok=True)
+        snapshot_date = date.today()
+
+        # メタ情報は最後に書き直す（途中で失敗したスナップショットは使われない）
+        meta_path = os.path.join(args.dir, SNAPSHOT_META_FILE)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        for table_name, query in SNAPSHOT_TABLES:
+            export_table(client, args.dir, table_name, query, snapshot_date)
+
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'snapshot_date': snapshot_date.isoformat(),
+                'tables': [table_name for table_name, _ in SNAPSHOT_TABLES],
+            }, f, ensure_ascii=False, indent=2)
+
+        print(f"\n✅ Snapshot written to {args.dir} (snapshot date {snapshot_date.isoformat()})")
+
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
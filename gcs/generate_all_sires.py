@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全種牡馬のデータを1プロセスで生成する（generate_all_sires.sh の置き換え）
+
+generate_all_sires.sh は種牡馬ごとに python3 generate_sires.py を起動していたため、
+1頭ごとにインタプリタの起動・google-cloud の import・クライアントの作成・認証をやり直していた。
+ここでは
+- 種牡馬の一覧（lib/sires_data.py の ALL_SIRES_DATA）を1回だけ読み込み
+- BigQuery / GCS のクライアントとアップロードのキューを全種牡馬で使い回し
+- batch_stats のまとめ取得とランキングを1回だけ実行して
+- parallel.run_entities で複数頭を並列に処理する。
+
+--measure-startup を付けると、python3 -c "import generate_sires" の起動時間を計測し、
+シェルのループで種牡馬数だけ起動した場合の起動コストと、このプロセスの起動コストを比べて表示する。
+
+Usage:
+    python3 generate_all_sires.py
+    python3 generate_all_sires.py --workers 8 --measure-startup
+    python3 generate_all_sires.py --offline
+"""
+
+import time
+
+# 起動コストの計測用（google-cloud などの import より前に記録する）
+_STARTED = time.monotonic()
+
+import os
+import statistics
+import subprocess
+import sys
+
+from google.cloud import bigquery, storage
+
+from generate_sires import (PROJECT_ID, checkpoint_key, estimate_cost, precompute_rankings,
+                            prefetch_all_sires, process_sire)
+import checkpoint
+import cost_estimate
+from parallel import DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRIES, DEFAULT_WORKERS, cap_in_flight, format_duration, run_entities
+from offline_client import OfflineClient
+from query_cache import CachedClient
+from query_stats import InstrumentedClient
+from publish_format import COMPRESSIONS, JSON_LAYOUTS, PublishFormat
+from uploads import DEFAULT_UPLOAD_WORKERS, GCSBackend, LocalBackend, UploadService
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+# 起動時間を計測するときの試行回数
+DEFAULT_STARTUP_SAMPLES = 3
+
+
+def load_sires():
+    """lib/sires_data.py の種牡馬一覧（[{'id', 'name'}]）を読み込む"""
+    sys.path.insert(0, os.path.join(PROJECT_ROOT, 'lib'))
+    try:
+        from sires_data import ALL_SIRES_DATA
+    except ImportError as e:
+        print(f"   ⚠️  Error loading lib/sires_data.py: {str(e)}", file=sys.stderr)
+        raise
+    return ALL_SIRES_DATA
+
+
+def measure_process_startup(samples=DEFAULT_STARTUP_SAMPLES):
+    """新しいプロセスで generate_sires を import するまでの時間（秒、samples 回の中央値）
+
+    シェルのループでは種牡馬ごとにこの分（とクライアントの作成）がかかる。
+    """
+    durations = []
+    for _ in range(samples):
+        started = time.monotonic()
+        subprocess.run([sys.executable, '-c', 'import generate_sires'], cwd=SCRIPT_DIR, check=True,
+                       stdout=subprocess.DEVNULL)
+        durations.append(time.monotonic() - started)
+    return statistics.median(durations)
+
+
+def print_startup_comparison(process_startup, import_seconds, client_seconds, sire_count):
+    """シェルのループ（1頭1プロセス）とこのプロセスの起動コストを比べて表示する"""
+    per_process = process_startup + client_seconds
+    print(f"\n⏱️  Startup overhead ({sire_count} sires)")
+    print(f"   Process start + imports: {process_startup:.2f}s (subprocess median), "
+          f"{import_seconds:.2f}s imports in this process")
+    print(f"   Client setup:            {client_seconds:.2f}s")
+    print(f"   Shell loop:  {sire_count} × {per_process:.2f}s = {format_duration(per_process * sire_count)}")
+    print(f"   This runner: 1 × {per_process:.2f}s = {format_duration(per_process)} "
+          f"(saves ~{format_duration(per_process * (sire_count - 1))})")
+    print("   (the shell loop also ran every section per sire; here batch_stats prefetches them once)")
+
+
+def main():
+    """メイン処理"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export all sires listed in lib/sires_data.py in one process')
+    parser.add_argument('--no-batch', action='store_true', help='Query each section per sire instead of grouped batch queries')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help=f'Max concurrent section queries per sire (1 = sequential, default: {DEFAULT_MAX_IN_FLIGHT})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'Number of sires processed in parallel (1 = sequential, default: {DEFAULT_WORKERS})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help=f'Times to retry failed sires (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--no-cache', action='store_true', help='Always query BigQuery instead of reusing cached results on disk')
+    parser.add_argument('--no-query-log', action='store_true', help='Do not write per-query latency/bytes/slot stats to a JSONL log')
+    parser.add_argument('--upload-workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help=f'Number of parallel uploads (default: {DEFAULT_UPLOAD_WORKERS})')
+    parser.add_argument('--json-layout', choices=JSON_LAYOUTS, default='pretty', help='Published JSON layout (columnar: stat arrays as column arrays; default: pretty)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none', help='Store JSON pre-compressed with this Content-Encoding (default: none)')
+    parser.add_argument('--resume', action='store_true', help='Skip sires completed in the interrupted last run (checkpoint file)')
+    parser.add_argument('--retry-failed', action='store_true', help='Process only the sires that failed in the last run (checkpoint file)')
+    parser.add_argument('--estimate', action='store_true', help='Dry-run one sire\'s queries, print projected bytes scanned and cost, and exit')
+    parser.add_argument('--max-cost-usd', type=float, default=cost_estimate.DEFAULT_MAX_COST_USD, help='Abort before starting if the estimated cost exceeds this (default: $BQ_MAX_COST_USD, or no cap)')
+    parser.add_argument('--measure-startup', action='store_true', help='Time a fresh "import generate_sires" process and compare the shell loop\'s startup cost with this run')
+    parser.add_argument('--startup-samples', type=int, default=DEFAULT_STARTUP_SAMPLES, help=f'Processes to time for --measure-startup (default: {DEFAULT_STARTUP_SAMPLES})')
+    parser.add_argument('--offline', action='store_true', help='Query the local snapshot (export_snapshot.py) with DuckDB and write JSON locally instead of GCS')
+    args = parser.parse_args()
+
+    import_seconds = time.monotonic() - _STARTED
+
+    # 途中の sys.exit や例外で抜けた場合も、finally で残りのアップロードとマニフェストを送り切る
+    storage_client = None
+    try:
+        sires = load_sires()
+        print(f"🚀 Starting sire data export (ALL SIRES, single process)")
+        print(f"   Loaded {len(sires)} sires from lib/sires_data.py")
+
+        # クライアントは全種牡馬で1つずつ
+        client_started = time.monotonic()
+        if args.offline:
+            bq_client = OfflineClient()
+            backend = LocalBackend()
+            print(f"🗂️  Offline mode: snapshot {bq_client.snapshot_dir} → {backend.output_dir}")
+            checkpoint_dir = os.path.join(backend.output_dir, '.checkpoint')
+        else:
+            bq_client = bigquery.Client(project=PROJECT_ID)
+            if not args.no_cache:
+                bq_client = CachedClient(bq_client)
+            backend = GCSBackend(storage.Client(project=PROJECT_ID), pool_size=args.upload_workers)
+            checkpoint_dir = checkpoint.DEFAULT_CHECKPOINT_DIR
+        if not args.no_query_log:
+            bq_client = InstrumentedClient(bq_client, 'sires')
+        storage_client = UploadService(backend, workers=args.upload_workers,
+                                       publish_format=PublishFormat(args.json_layout, args.compression), manifest=True)
+        client_seconds = time.monotonic() - client_started
+
+        if (args.estimate or args.max_cost_usd is not None) and sires:
+            total = estimate_cost(bq_client, sires[0]['name'], len(sires), no_batch=args.no_batch)
+            if not args.estimate:
+                cost_estimate.check_budget(total, args.max_cost_usd)
+        elif args.estimate:
+            cost_estimate.print_empty_estimate('sires')
+        # --estimate は対象がなくてもここで終える（まとめ取得・ランキングのクエリやアップロード、差分更新の状態の保存をしない）
+        if args.estimate:
+            return
+
+        run_started = time.monotonic()
+        for_sire = None
+        if not args.no_batch:
+            print(f"   Prefetching sections for all sires...")
+            for_sire = prefetch_all_sires(bq_client)
+
+        rankings = precompute_rankings(bq_client)
+
+        max_in_flight = cap_in_flight(args.workers, args.max_in_flight)
+        entities = []
+        for sire in sires:
+            prefetched = for_sire(sire['name']) if for_sire else None
+            entities.append((
+                f"{sire['name']} (ID: {sire['id']})",
+                (bq_client, storage_client, sire['id'], sire['name'], prefetched, max_in_flight, rankings),
+            ))
+
+        # 途中再開（generate_sires.py の FULL MODE と同じチェックポイントファイルを使う）
+        progress = checkpoint.Checkpoint('sire', checkpoint.mode_from_args(args), checkpoint_dir)
+        entities = progress.select(entities, checkpoint_key)
+
+        print(f"   Processing with {args.workers} workers (max in flight: {max_in_flight})")
+        print(f"\n{'='*60}")
+
+        success_count, failed = run_entities(
+            entities, progress.wrap(process_sire, storage_client, checkpoint_key),
+            workers=args.workers, retries=args.retries,
+        )
+        progress.close()
+        storage_client.flush()
+        run_seconds = time.monotonic() - run_started
+
+        print(f"\n{'='*60}")
+        print(f"✅ Processing complete! ({format_duration(run_seconds)})")
+        print(f"   Success: {success_count}/{len(entities)}")
+        print(f"   Failed:  {len(failed)}/{len(entities)}")
+        for label in failed:
+            print(f"     - {label}")
+        print(f"{'='*60}")
+
+        if args.measure_startup:
+            process_startup = measure_process_startup(args.startup_samples)
+            print_startup_comparison(process_startup, import_seconds, client_seconds, len(sires))
+
+        if args.offline or not args.no_cache or not args.no_query_log:
+            bq_client.report()
+        storage_client.close()
+        storage_client.report()
+
+        if failed or storage_client.failed:
+            sys.exit(1)
+
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        if storage_client is not None:
+            storage_client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -30,38 +30,9 @@ else
 fi
 
 echo ""
-echo "Step 2: 各種牡馬のデータを生成中..."
+echo "Step 2: 全種牡馬のデータを生成中..."
 echo ""
 
-# lib/sires.ts から種牡馬名を抽出
-SIRE_NAMES=$(grep "name: '" lib/sires.ts | sed "s/.*name: '\([^']*\)'.*/\1/")
-
-TOTAL=$(echo "$SIRE_NAMES" | wc -l | tr -d ' ')
-CURRENT=0
-SUCCESS=0
-FAILED=0
-
-for SIRE_NAME in $SIRE_NAMES; do
-    CURRENT=$((CURRENT + 1))
-    echo ""
-    echo "========================================="
-    echo "[$CURRENT/$TOTAL] $SIRE_NAME"
-    echo "========================================="
-
-    if python3 generate_sires.py "$SIRE_NAME" 2>&1; then
-        SUCCESS=$((SUCCESS + 1))
-        echo ""
-        echo "  ✅ Success ($CURRENT/$TOTAL)"
-    else
-        FAILED=$((FAILED + 1))
-        echo ""
-        echo "  ❌ Failed ($CURRENT/$TOTAL)"
-    fi
-done
-
-echo "========================================="
-echo "完了"
-echo "========================================="
-echo "成功: $SUCCESS"
-echo "失敗: $FAILED"
-echo "合計: $TOTAL"
+# 種牡馬ごとにプロセスを起動せず、1プロセスでクライアントを使い回して並列に処理する
+# （追加のオプションはそのまま generate_all_sires.py に渡す）
+python3 -u generate_all_sires.py "$@"
@@ -5,20 +5,32 @@
 """
 
 from google.cloud import bigquery, storage
-import json
+import os
 import sys
 from datetime import datetime
+from functools import partial
+
+import batch_stats
+import checkpoint
+import cost_estimate
+import incremental
+import stat_schema
+from parallel import (DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRIES, DEFAULT_WORKERS, cap_in_flight,
+                      fetch_sections, run_entities)
+from offline_client import OfflineClient
+from query_cache import CachedClient
+from query_params import run_query
+from query_stats import InstrumentedClient, query_section
+from publish_format import COMPRESSIONS, JSON_LAYOUTS, PublishFormat
+from uploads import DEFAULT_UPLOAD_WORKERS, GCSBackend, LocalBackend, UploadService
 
 # 設定
 PROJECT_ID = 'umadata'
 BUCKET_NAME = 'umadata'
 DATASET = 'umadata.keiba_data'
 
-# グローバル変数として現在処理中の騎手情報を保持
-JOCKEY_ID = None
 
-
-def get_jockey_basic_info(client):
+def get_jockey_basic_info(client, jockey_id):
     """騎手の基本情報を取得"""
     query = f"""
     SELECT
@@ -31,11 +43,11 @@ def get_jockey_basic_info(client):
     FROM
       `{DATASET}.jockey`
     WHERE
-      jockey_id = {JOCKEY_ID}
+      jockey_id = @jockey_id
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         rows = list(results)
         if not rows:
             return None
@@ -45,7 +57,7 @@ def get_jockey_basic_info(client):
         raise
 
 
-def get_total_stats(client):
+def get_total_stats(client, jockey_id):
     """総合成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -60,12 +72,12 @@ def get_total_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         rows = list(results)
         if not rows:
             return None
@@ -75,7 +87,7 @@ def get_total_stats(client):
         raise
 
 
-def get_yearly_stats(client):
+def get_yearly_stats(client, jockey_id):
     """年度別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -97,22 +109,25 @@ def get_yearly_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY year
     ORDER BY year DESC
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching yearly stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_yearly_leading(client):
-    """年度別リーディング順位を取得（過去3年間）"""
+def get_all_yearly_leading(client):
+    """全騎手の年度別リーディング順位を取得（過去3年間）
+
+    戻り値は {jockey_id: [{year, wins, ranking}]}（年度の新しい順）
+    """
     query = f"""
     WITH yearly_wins AS (
       SELECT
@@ -138,23 +153,27 @@ def get_yearly_leading(client):
       FROM yearly_wins
     )
     SELECT
+      jockey_id,
       year,
       wins,
       ranking
     FROM ranked
-    WHERE jockey_id = {JOCKEY_ID}
     ORDER BY year DESC
     """
 
     try:
         results = client.query(query).result()
-        return [dict(row) for row in results]
+        leading = {}
+        for row in results:
+            row = dict(row)
+            leading.setdefault(row.pop('jockey_id'), []).append(row)
+        return leading
     except Exception as e:
         print(f"   ⚠️  Error fetching yearly leading: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_distance_stats(client):
+def get_distance_stats(client, jockey_id):
     """距離別成績を取得（過去3年間）
 
     距離カテゴリ定義:
@@ -188,7 +207,7 @@ def get_distance_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY category
     ORDER BY
@@ -201,14 +220,14 @@ def get_distance_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching distance stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_surface_stats(client):
+def get_surface_stats(client, jockey_id):
     """路面別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -230,7 +249,7 @@ def get_surface_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rm.surface IN ('芝', 'ダート', '障害')
     GROUP BY rm.surface
@@ -244,14 +263,14 @@ def get_surface_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching surface stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_popularity_stats(client):
+def get_popularity_stats(client, jockey_id):
     """人気別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -281,14 +300,14 @@ def get_popularity_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.popularity IS NOT NULL
     GROUP BY popularity_group
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         data_dict = {row['popularity_group']: dict(row) for row in results}
 
         # 順序を保証して返す
@@ -299,95 +318,22 @@ def get_popularity_stats(client):
         raise
 
 
-def get_running_style_stats(client):
+def get_running_style_stats(client, jockey_id):
     """脚質別成績を取得（過去3年間）"""
     query = f"""
-    WITH all_horses AS (
+    WITH running_style_classified AS (
+      -- 脚質は race_result_enriched で分類済み（build_derived_tables.py）
       SELECT
-        rm.race_id,
-        rr.horse_id,
-        rr.jockey_id,
-        rr.finish_position,
-        rr.popularity,
-        rr.win,
-        rr.place,
-        rm.entry_count,
-        rr.last_3f_time,
-        SPLIT(rr.corner_positions, '-') as corner_array,
-        RANK() OVER (PARTITION BY rm.race_id ORDER BY rr.last_3f_time ASC) as last_3f_rank
-      FROM
-        `{DATASET}.race_master` rm
-        JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
-      WHERE
-        rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-    ),
-    corner_data AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        entry_count,
-        last_3f_time,
-        last_3f_rank,
-        corner_array
+        e.finish_position,
+        e.popularity,
+        e.win,
+        e.place,
+        e.running_style
       FROM
-        all_horses
+        `{DATASET}.race_result_enriched` e
       WHERE
-        jockey_id = {JOCKEY_ID}
-        AND corner_array IS NOT NULL
-        AND ARRAY_LENGTH(corner_array) > 0
-    ),
-    corner_parsed AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        entry_count,
-        last_3f_time,
-        last_3f_rank,
-        corner_array,
-        ARRAY_LENGTH(corner_array) as corner_count,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 1, corner_array[OFFSET(0)], NULL) AS INT64) as corner_1,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 2, corner_array[OFFSET(1)], NULL) AS INT64) as corner_2,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 3, corner_array[OFFSET(2)], NULL) AS INT64) as corner_3,
-        CAST(corner_array[OFFSET(ARRAY_LENGTH(corner_array)-1)] AS INT64) as final_corner
-      FROM
-        corner_data
-    ),
-    running_style_classified AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        CASE
-          WHEN corner_count >= 1 AND (
-            COALESCE(corner_1, 0) = 1 OR
-            COALESCE(corner_2, 0) = 1 OR
-            COALESCE(corner_3, 0) = 1
-          )
-            THEN 'escape'
-          WHEN COALESCE(final_corner, 999) <= CAST(CEIL(entry_count / 3.0) AS INT64)
-            THEN 'lead'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(entry_count / 3.0) AS INT64)
-            AND COALESCE(final_corner, 999) <= CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 3
-            THEN 'pursue'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 3
-            THEN 'close'
-          ELSE NULL
-        END as running_style
-      FROM
-        corner_parsed
+        e.jockey_id = @jockey_id
+        AND e.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     )
     SELECT
       running_style as style,
@@ -432,16 +378,34 @@ def get_running_style_stats(client):
     """
 
     try:
-        from google.cloud.bigquery import QueryJobConfig
-        job_config = QueryJobConfig(use_query_cache=False)
-        results = client.query(query, job_config=job_config).result()
+        results = run_query(client, query, {'jockey_id': jockey_id}, use_query_cache=False)
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching running style stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_gate_stats(client):
+# 枠番の色を定義
+GATE_COLORS = {
+    1: '#FFFFFF',
+    2: '#222222',
+    3: '#C62927',
+    4: '#2573CD',
+    5: '#E4CA3C',
+    6: '#58AF4A',
+    7: '#FAA727',
+    8: '#DC6179',
+}
+
+
+def add_gate_colors(gate_data):
+    """枠順別成績に色情報を追加"""
+    for row_dict in gate_data:
+        row_dict['color'] = GATE_COLORS.get(row_dict['gate'], '#999999')
+    return gate_data
+
+
+def get_gate_stats(client, jockey_id):
     """枠順別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -463,42 +427,21 @@ def get_gate_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY rr.bracket_number
     ORDER BY rr.bracket_number
     """
 
     try:
-        results = client.query(query).result()
-
-        # 枠番の色を定義
-        GATE_COLORS = {
-            1: '#FFFFFF',
-            2: '#222222',
-            3: '#C62927',
-            4: '#2573CD',
-            5: '#E4CA3C',
-            6: '#58AF4A',
-            7: '#FAA727',
-            8: '#DC6179',
-        }
-
-        # 色情報を追加
-        gate_data = []
-        for row in results:
-            row_dict = dict(row)
-            gate_num = row_dict['gate']
-            row_dict['color'] = GATE_COLORS.get(gate_num, '#999999')
-            gate_data.append(row_dict)
-
-        return gate_data
+        results = run_query(client, query, {'jockey_id': jockey_id})
+        return add_gate_colors([dict(row) for row in results])
     except Exception as e:
         print(f"   ⚠️  Error fetching gate stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_course_stats(client):
+def get_course_stats(client, jockey_id):
     """コース別成績を取得（過去3年間）"""
     query = f"""
     WITH course_data AS (
@@ -524,7 +467,7 @@ def get_course_stats(client):
         `{DATASET}.race_master` rm
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       WHERE
-        rr.jockey_id = {JOCKEY_ID}
+        rr.jockey_id = @jockey_id
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       GROUP BY
         rm.venue_name,
@@ -597,7 +540,7 @@ def get_course_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         # リンクを追加
         course_list = []
         for row in results:
@@ -613,7 +556,12 @@ def get_course_stats(client):
         raise
 
 
-def get_trainer_stats(client):
+def add_trainer_links(trainer_data):
+    """調教師別成績にリンクを追加"""
+    return [{**row, 'link': f"/trainers/{row['trainer_id']}"} for row in trainer_data]
+
+
+def get_trainer_stats(client, jockey_id):
     """調教師別成績を取得（過去3年間、現役のみ、Top 50）"""
     query = f"""
     WITH trainer_data AS (
@@ -638,7 +586,7 @@ def get_trainer_stats(client):
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
         JOIN `{DATASET}.trainer` t ON CAST(rr.trainer_id AS STRING) = CAST(t.trainer_id AS STRING)
       WHERE
-        rr.jockey_id = {JOCKEY_ID}
+        rr.jockey_id = @jockey_id
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
         AND t.is_active = true
       GROUP BY t.trainer_id, t.trainer_name
@@ -666,15 +614,14 @@ def get_trainer_stats(client):
     """
 
     try:
-        results = client.query(query).result()
-        # リンクを追加
-        return [{**dict(row), 'link': f'/trainers/{row.trainer_id}'} for row in results]
+        results = run_query(client, query, {'jockey_id': jockey_id})
+        return add_trainer_links([dict(row) for row in results])
     except Exception as e:
         print(f"   ⚠️  Error fetching trainer stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_class_stats(client):
+def get_class_stats(client, jockey_id):
     """クラス別成績を取得（過去3年間）"""
     query = f"""
     WITH class_data AS (
@@ -708,7 +655,7 @@ def get_class_stats(client):
         `{DATASET}.race_master` rm
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       WHERE
-        rr.jockey_id = {JOCKEY_ID}
+        rr.jockey_id = @jockey_id
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
         AND rm.race_class IS NOT NULL
       GROUP BY class_name
@@ -759,14 +706,14 @@ def get_class_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching class stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_track_condition_stats(client):
+def get_track_condition_stats(client, jockey_id):
     """馬場状態別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -794,7 +741,7 @@ def get_track_condition_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rm.track_condition IS NOT NULL
       AND rm.surface IN ('芝', 'ダート', '障害')
@@ -818,14 +765,14 @@ def get_track_condition_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching track condition stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_gender_stats(client):
+def get_gender_stats(client, jockey_id):
     """性別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -852,7 +799,7 @@ def get_gender_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.sex IS NOT NULL
     GROUP BY rr.sex
@@ -866,14 +813,60 @@ def get_gender_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching gender stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_racecourse_stats(client):
+# 中央・ローカルの競馬場区分
+CENTRAL_RACECOURSES = ['東京', '中山', '阪神', '京都']
+LOCAL_RACECOURSES = ['札幌', '函館', '福島', '新潟', '中京', '小倉']
+
+
+def append_region_summaries(racecourse_data, region_medians):
+    """競馬場別成績に中央・ローカルの集計行を追加
+
+    region_medians: {'central': {...}, 'local': {...}}（人気・着順の中央値）
+    """
+    regions = (
+        ('central', '中央', CENTRAL_RACECOURSES),
+        ('local', 'ローカル', LOCAL_RACECOURSES),
+    )
+    summaries = []
+    for region_en, region_ja, venues in regions:
+        region_data = [r for r in racecourse_data if r['name'] in venues]
+        if not region_data:
+            continue
+        total_races = sum(r['races'] for r in region_data)
+        total_wins = sum(r['wins'] for r in region_data)
+        total_places_2 = sum(r['places_2'] for r in region_data)
+        total_places_3 = sum(r['places_3'] for r in region_data)
+        median_row = region_medians.get(region_en) or {}
+
+        summaries.append({
+            'name': region_ja,
+            'racecourse_ja': region_ja,
+            'racecourse_en': region_en,
+            'races': total_races,
+            'wins': total_wins,
+            'places_2': total_places_2,
+            'places_3': total_places_3,
+            'win_rate': round((total_wins / total_races * 100), 1) if total_races > 0 else 0,
+            'quinella_rate': round(((total_wins + total_places_2) / total_races * 100), 1) if total_races > 0 else 0,
+            'place_rate': round(((total_wins + total_places_2 + total_places_3) / total_races * 100), 1) if total_races > 0 else 0,
+            'win_payback': round(sum(r['win_payback'] * r['races'] for r in region_data) / total_races, 1) if total_races > 0 else 0,
+            'place_payback': round(sum(r['place_payback'] * r['races'] for r in region_data) / total_races, 1) if total_races > 0 else 0,
+            'avg_popularity': round(sum(r['avg_popularity'] * r['races'] for r in region_data) / total_races, 1) if total_races > 0 else None,
+            'avg_rank': round(sum(r['avg_rank'] * r['races'] for r in region_data) / total_races, 1) if total_races > 0 else None,
+            'median_popularity': median_row.get('median_popularity'),
+            'median_rank': median_row.get('median_rank'),
+        })
+    return racecourse_data + summaries
+
+
+def get_racecourse_stats(client, jockey_id):
     """競馬場別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -908,74 +901,23 @@ def get_racecourse_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY rm.venue_name
     ORDER BY wins DESC
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         racecourse_data = [dict(row) for row in results]
 
-        # 中央・ローカルの集計行を追加
-        central_racecourses = ['東京', '中山', '阪神', '京都']
-        local_racecourses = ['札幌', '函館', '福島', '新潟', '中京', '小倉']
-
-        # 中央競馬場の集計
-        central_data = [r for r in racecourse_data if r['name'] in central_racecourses]
-        if central_data:
-            total_races = sum(r['races'] for r in central_data)
-            total_wins = sum(r['wins'] for r in central_data)
-            total_places_2 = sum(r['places_2'] for r in central_data)
-            total_places_3 = sum(r['places_3'] for r in central_data)
-
-            # 中央値は加重平均ではなく、全レースから直接計算
-            central_median_query = f"""
-            SELECT
-              APPROX_QUANTILES(rr.popularity, 100)[OFFSET(50)] as median_popularity,
-              APPROX_QUANTILES(rr.finish_position, 100)[OFFSET(50)] as median_rank
-            FROM
-              `{DATASET}.race_master` rm
-              JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
-            WHERE
-              rr.jockey_id = {JOCKEY_ID}
-              AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-              AND rm.venue_name IN ('東京', '中山', '阪神', '京都')
-            """
-            central_median_results = client.query(central_median_query).result()
-            central_median_row = dict(list(central_median_results)[0])
-
-            central_summary = {
-                'name': '中央',
-                'racecourse_ja': '中央',
-                'racecourse_en': 'central',
-                'races': total_races,
-                'wins': total_wins,
-                'places_2': total_places_2,
-                'places_3': total_places_3,
-                'win_rate': round((total_wins / total_races * 100), 1) if total_races > 0 else 0,
-                'quinella_rate': round(((total_wins + total_places_2) / total_races * 100), 1) if total_races > 0 else 0,
-                'place_rate': round(((total_wins + total_places_2 + total_places_3) / total_races * 100), 1) if total_races > 0 else 0,
-                'win_payback': round(sum(r['win_payback'] * r['races'] for r in central_data) / total_races, 1) if total_races > 0 else 0,
-                'place_payback': round(sum(r['place_payback'] * r['races'] for r in central_data) / total_races, 1) if total_races > 0 else 0,
-                'avg_popularity': round(sum(r['avg_popularity'] * r['races'] for r in central_data) / total_races, 1) if total_races > 0 else None,
-                'avg_rank': round(sum(r['avg_rank'] * r['races'] for r in central_data) / total_races, 1) if total_races > 0 else None,
-                'median_popularity': central_median_row['median_popularity'],
-                'median_rank': central_median_row['median_rank'],
-            }
-            racecourse_data.append(central_summary)
-
-        # ローカル競馬場の集計
-        local_data = [r for r in racecourse_data if r['name'] in local_racecourses]
-        if local_data:
-            total_races = sum(r['races'] for r in local_data)
-            total_wins = sum(r['wins'] for r in local_data)
-            total_places_2 = sum(r['places_2'] for r in local_data)
-            total_places_3 = sum(r['places_3'] for r in local_data)
-
-            # 中央値は加重平均ではなく、全レースから直接計算
-            local_median_query = f"""
+        # 中央値は加重平均ではなく、全レースから直接計算
+        region_medians = {}
+        for region, venues in (('central', CENTRAL_RACECOURSES), ('local', LOCAL_RACECOURSES)):
+            if not any(r['name'] in venues for r in racecourse_data):
+                continue
+            venue_list = ', '.join(f"'{v}'" for v in venues)
+            median_query = f"""
             SELECT
               APPROX_QUANTILES(rr.popularity, 100)[OFFSET(50)] as median_popularity,
               APPROX_QUANTILES(rr.finish_position, 100)[OFFSET(50)] as median_rank
@@ -983,40 +925,20 @@ def get_racecourse_stats(client):
               `{DATASET}.race_master` rm
               JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
             WHERE
-              rr.jockey_id = {JOCKEY_ID}
+              rr.jockey_id = @jockey_id
               AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-              AND rm.venue_name IN ('札幌', '函館', '福島', '新潟', '中京', '小倉')
+              AND rm.venue_name IN ({venue_list})
             """
-            local_median_results = client.query(local_median_query).result()
-            local_median_row = dict(list(local_median_results)[0])
-
-            local_summary = {
-                'name': 'ローカル',
-                'racecourse_ja': 'ローカル',
-                'racecourse_en': 'local',
-                'races': total_races,
-                'wins': total_wins,
-                'places_2': total_places_2,
-                'places_3': total_places_3,
-                'win_rate': round((total_wins / total_races * 100), 1) if total_races > 0 else 0,
-                'quinella_rate': round(((total_wins + total_places_2) / total_races * 100), 1) if total_races > 0 else 0,
-                'place_rate': round(((total_wins + total_places_2 + total_places_3) / total_races * 100), 1) if total_races > 0 else 0,
-                'win_payback': round(sum(r['win_payback'] * r['races'] for r in local_data) / total_races, 1) if total_races > 0 else 0,
-                'place_payback': round(sum(r['place_payback'] * r['races'] for r in local_data) / total_races, 1) if total_races > 0 else 0,
-                'avg_popularity': round(sum(r['avg_popularity'] * r['races'] for r in local_data) / total_races, 1) if total_races > 0 else None,
-                'avg_rank': round(sum(r['avg_rank'] * r['races'] for r in local_data) / total_races, 1) if total_races > 0 else None,
-                'median_popularity': local_median_row['median_popularity'],
-                'median_rank': local_median_row['median_rank'],
-            }
-            racecourse_data.append(local_summary)
-
-        return racecourse_data
+            median_results = run_query(client, median_query, {'jockey_id': jockey_id})
+            region_medians[region] = dict(list(median_results)[0])
+
+        return append_region_summaries(racecourse_data, region_medians)
     except Exception as e:
         print(f"   ⚠️  Error fetching racecourse stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_owner_stats(client):
+def get_owner_stats(client, jockey_id):
     """馬主別成績を取得（過去3年間、Top 50）"""
     query = f"""
     WITH owner_data AS (
@@ -1040,7 +962,7 @@ def get_owner_stats(client):
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
         JOIN `{DATASET}.horse` h ON CAST(rr.horse_id AS STRING) = CAST(h.horse_id AS STRING)
       WHERE
-        rr.jockey_id = {JOCKEY_ID}
+        rr.jockey_id = @jockey_id
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
         AND h.owner_name IS NOT NULL
       GROUP BY h.owner_name
@@ -1067,14 +989,14 @@ def get_owner_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching owner stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_fav1_place_rate(client):
+def get_fav1_place_rate(client, jockey_id):
     """1番人気時の複勝率を取得"""
     query = f"""
     SELECT
@@ -1085,13 +1007,13 @@ def get_fav1_place_rate(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      rr.jockey_id = {JOCKEY_ID}
+      rr.jockey_id = @jockey_id
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.popularity = 1
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'jockey_id': jockey_id})
         rows = list(results)
         if not rows or rows[0]['races'] == 0:
             return None
@@ -1140,6 +1062,7 @@ def get_all_jockeys_fav1_stats(client):
 
         return {
             'jockeys': jockeys_data,
+            'rankings': {j['jockey_id']: j['ranking'] for j in jockeys_data},
             'total_jockeys': len(jockeys_data),
             'avg_place_rate': round(avg_place_rate, 1)
         }
@@ -1169,11 +1092,15 @@ def calculate_reliability_level(ranking, total_jockeys):
         return 1  # 低い（上位81-100%）
 
 
-def get_characteristics(client):
-    """特性データを取得（荒れやすさなど）"""
+def get_characteristics(client, jockey_id, all_jockeys_data=None):
+    """特性データを取得（荒れやすさなど）
+
+    all_jockeys_data: precompute_rankings で計算済みの全騎手の1番人気成績（なければここで取得）
+    """
     # 1番人気時の複勝率を取得
-    fav1_data = get_fav1_place_rate(client)
-    all_jockeys_data = get_all_jockeys_fav1_stats(client)
+    fav1_data = get_fav1_place_rate(client, jockey_id)
+    if all_jockeys_data is None:
+        all_jockeys_data = get_all_jockeys_fav1_stats(client)
 
     jockey_fav1_place_rate = fav1_data['place_rate'] if fav1_data else 0
     fav1_races = fav1_data['races'] if fav1_data else 0
@@ -1186,11 +1113,7 @@ def get_characteristics(client):
     if all_jockeys_data:
         total_jockeys = all_jockeys_data['total_jockeys']
         avg_place_rate = all_jockeys_data['avg_place_rate']
-
-        for jockey in all_jockeys_data['jockeys']:
-            if jockey['jockey_id'] == JOCKEY_ID:
-                ranking = jockey['ranking']
-                break
+        ranking = all_jockeys_data['rankings'].get(jockey_id)
 
     # 信頼度レベルを計算
     volatility = calculate_reliability_level(ranking, total_jockeys)
@@ -1208,11 +1131,98 @@ def get_characteristics(client):
     }
 
 
-def process_jockey(bq_client, storage_client, jockey_id, jockey_name):
-    """1人の騎手のデータを処理してGCSにアップロード"""
-    global JOCKEY_ID
-    JOCKEY_ID = jockey_id
+def precompute_rankings(client):
+    """全騎手を対象にしたランキングを1回だけ計算する
+
+    年度別リーディングと1番人気複勝率の順位は全騎手の集計が必要なため、
+    騎手ごとに計算し直さず実行の最初にまとめて求めて process_jockey に渡す。
+    """
+    print("   Precomputing rankings (yearly leading, fav1 place rate)...")
+    return {
+        'yearly_leading': get_all_yearly_leading(client),
+        'fav1': get_all_jockeys_fav1_stats(client),
+    }
+
 
+# 全騎手分を1クエリずつでまとめて集計するセクション（batch_stats）
+BATCH_ENTITY = {'key': 'rr.jockey_id'}
+BATCH_SECTIONS = [
+    batch_stats.total_section(),
+    batch_stats.yearly_section(),
+    batch_stats.distance_section(),
+    batch_stats.surface_section(only_known=True),
+    batch_stats.popularity_section(),
+    batch_stats.gate_section(),
+    batch_stats.class_section(),
+    batch_stats.track_condition_section(),
+    batch_stats.gender_section(),
+    batch_stats.racecourse_section(),
+    batch_stats.racecourse_region_median_section(),
+    batch_stats.owner_section(),
+    batch_stats.trainer_section(),
+]
+
+
+def prefetch_all_jockeys(client):
+    """全騎手分のセクションをまとめて取得し、騎手IDから prefetched を返す関数を作る"""
+    batch = batch_stats.prefetch_sections(client, BATCH_ENTITY, BATCH_SECTIONS)
+
+    def for_jockey(jockey_id):
+        data = batch.for_entity(jockey_id)
+        data['gate_stats'] = add_gate_colors(data['gate_stats'])
+        data['trainer_stats'] = add_trainer_links(data['trainer_stats'])
+        region_medians = {r['region']: r for r in data.pop('racecourse_region_medians')}
+        data['racecourse_stats'] = append_region_summaries(data['racecourse_stats'], region_medians)
+        return data
+
+    return for_jockey
+
+
+def entity_sections(rankings):
+    """1人分のセクション（fetch_sections に渡す [(name, getter)]）"""
+    return [
+        ('total_stats', get_total_stats),
+        ('yearly_stats', get_yearly_stats),
+        ('distance_stats', get_distance_stats),
+        ('surface_stats', get_surface_stats),
+        ('popularity_stats', get_popularity_stats),
+        ('running_style_stats', get_running_style_stats),
+        ('gate_stats', get_gate_stats),
+        ('course_stats', get_course_stats),
+        ('trainer_stats', get_trainer_stats),
+        ('class_stats', get_class_stats),
+        ('track_condition_stats', get_track_condition_stats),
+        ('gender_stats', get_gender_stats),
+        ('racecourse_stats', get_racecourse_stats),
+        ('owner_stats', get_owner_stats),
+        ('characteristics', partial(get_characteristics, all_jockeys_data=rankings['fav1'])),
+    ]
+
+
+def estimate_cost(bq_client, sample, entity_count, no_batch=False):
+    """FULL MODE のスキャン量と料金を見積もる（代表の1人（sample: 騎手 ID）のクエリを dry run して × entity_count）"""
+    client = cost_estimate.DryRunClient(bq_client)
+    batch_names = set()
+    if not no_batch:
+        batch_stats.prefetch_sections(client, BATCH_ENTITY, BATCH_SECTIONS)
+        batch_names = {section['name'] for section in BATCH_SECTIONS}
+    rankings = precompute_rankings(client)
+    with client.per_entity(entity_count):
+        with query_section('basic_info', sample):
+            get_jockey_basic_info(client, sample)
+        cost_estimate.dry_run_sections(client, entity_sections(rankings), args=(sample,), skip=batch_names)
+    return cost_estimate.print_estimate(client, entity_count, 'jockeys')
+
+
+def process_jockey(bq_client, storage_client, jockey_id, jockey_name, prefetched=None,
+                   max_in_flight=DEFAULT_MAX_IN_FLIGHT, rankings=None):
+    """1人の騎手のデータを処理してGCSにアップロード
+
+    prefetched: batch_stats で全騎手分まとめて取得済みのセクション（{name: rows}）。
+    含まれるセクションはクエリを発行せずにそのまま使う。
+    max_in_flight: 同時に実行するセクションクエリ数の上限（1 なら順番に実行）
+    rankings: precompute_rankings の結果。省略時はこの騎手の処理の中で計算する
+    """
     print(f"\n{'='*60}")
     print(f"📊 Processing: {jockey_name} (ID: {jockey_id})")
     print(f"{'='*60}")
@@ -1220,58 +1230,34 @@ def process_jockey(bq_client, storage_client, jockey_id, jockey_name):
     try:
         # 各種データを取得
         print("  [1/17] Fetching basic info...")
-        basic_info = get_jockey_basic_info(bq_client)
+        basic_info = get_jockey_basic_info(bq_client, jockey_id)
         if not basic_info:
             print(f"  ⚠️  Jockey not found: {jockey_id}")
             return False
 
-        print("  [2/17] Fetching total stats...")
-        total_stats = get_total_stats(bq_client)
-
-        print("  [3/17] Fetching yearly stats...")
-        yearly_stats = get_yearly_stats(bq_client)
-
-        print("  [4/17] Fetching yearly leading...")
-        yearly_leading = get_yearly_leading(bq_client)
-
-        print("  [5/17] Fetching distance stats...")
-        distance_stats = get_distance_stats(bq_client)
-
-        print("  [6/17] Fetching surface stats...")
-        surface_stats = get_surface_stats(bq_client)
-
-        print("  [7/17] Fetching popularity stats...")
-        popularity_stats = get_popularity_stats(bq_client)
-
-        print("  [8/17] Fetching running style stats...")
-        running_style_stats = get_running_style_stats(bq_client)
-
-        print("  [9/17] Fetching gate stats...")
-        gate_stats = get_gate_stats(bq_client)
-
-        print("  [10/17] Fetching course stats...")
-        course_stats = get_course_stats(bq_client)
-
-        print("  [11/17] Fetching trainer stats...")
-        trainer_stats = get_trainer_stats(bq_client)
-
-        print("  [12/17] Fetching class stats...")
-        class_stats = get_class_stats(bq_client)
-
-        print("  [13/17] Fetching track condition stats...")
-        track_condition_stats = get_track_condition_stats(bq_client)
-
-        print("  [14/17] Fetching gender stats...")
-        gender_stats = get_gender_stats(bq_client)
-
-        print("  [15/17] Fetching racecourse stats...")
-        racecourse_stats = get_racecourse_stats(bq_client)
-
-        print("  [16/17] Fetching owner stats...")
-        owner_stats = get_owner_stats(bq_client)
-
-        print("  [17/17] Calculating characteristics...")
-        characteristics = get_characteristics(bq_client)
+        if rankings is None:
+            rankings = precompute_rankings(bq_client)
+
+        # 全セクションのクエリをまとめて投入し、終わった順に回収
+        sections = entity_sections(rankings)
+        print(f"  Fetching {len(sections)} sections (max in flight: {max_in_flight})...")
+        data = fetch_sections(bq_client, sections, prefetched, max_in_flight, args=(jockey_id,))
+        total_stats = data['total_stats']
+        yearly_stats = data['yearly_stats']
+        yearly_leading = rankings['yearly_leading'].get(jockey_id, [])
+        distance_stats = data['distance_stats']
+        surface_stats = data['surface_stats']
+        popularity_stats = data['popularity_stats']
+        running_style_stats = data['running_style_stats']
+        gate_stats = data['gate_stats']
+        course_stats = data['course_stats']
+        trainer_stats = data['trainer_stats']
+        class_stats = data['class_stats']
+        track_condition_stats = data['track_condition_stats']
+        gender_stats = data['gender_stats']
+        racecourse_stats = data['racecourse_stats']
+        owner_stats = data['owner_stats']
+        characteristics = data['characteristics']
 
         # 傾向計算を追加
         # 1. 芝・ダート傾向
@@ -1381,10 +1367,8 @@ def process_jockey(bq_client, storage_client, jockey_id, jockey_name):
         bucket = storage_client.bucket(BUCKET_NAME)
         blob_path = f'jockey/{str(jockey_id).zfill(5)}.json'
         blob = bucket.blob(blob_path)
-        blob.upload_from_string(
-            json.dumps(jockey_data, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
+        # 数値項目の型をそろえてから送る（宣言した型に合わなければこのエンティティは失敗扱い）
+        blob.upload_json(stat_schema.coerce(jockey_data))
 
         print(f"  ✅ {jockey_name} uploaded to {blob_path}")
         return True
@@ -1396,6 +1380,11 @@ def process_jockey(bq_client, storage_client, jockey_id, jockey_name):
         return False
 
 
+def checkpoint_key(entity_args):
+    """チェックポイントに記録するキー（process_jockey の引数の騎手 ID）"""
+    return str(entity_args[2])
+
+
 def main():
     """メイン処理"""
     import argparse
@@ -1403,18 +1392,52 @@ def main():
     parser = argparse.ArgumentParser(description='Export jockey data from BigQuery to GCS')
     parser.add_argument('--test', action='store_true', help='Test mode: process only 武豊 (ID: 666)')
     parser.add_argument('--jockey-id', type=int, help='Process a specific jockey by ID')
+    parser.add_argument('--no-batch', action='store_true', help='FULL MODE: query each section per jockey instead of grouped batch queries')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help=f'Max concurrent section queries per jockey (1 = sequential, default: {DEFAULT_MAX_IN_FLIGHT})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'FULL MODE: number of jockeys processed in parallel (1 = sequential, default: {DEFAULT_WORKERS})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help=f'FULL MODE: times to retry failed jockeys (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--no-cache', action='store_true', help='Always query BigQuery instead of reusing cached results on disk')
+    parser.add_argument('--no-query-log', action='store_true', help='Do not write per-query latency/bytes/slot stats to a JSONL log')
+    parser.add_argument('--upload-workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help=f'Number of parallel uploads (default: {DEFAULT_UPLOAD_WORKERS})')
+    parser.add_argument('--json-layout', choices=JSON_LAYOUTS, default='pretty', help='Published JSON layout (columnar: stat arrays as column arrays; default: pretty)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none', help='Store JSON pre-compressed with this Content-Encoding (default: none)')
+    parser.add_argument('--incremental', action='store_true', help='FULL MODE: regenerate only jockeys who ran in races loaded since the last run')
+    parser.add_argument('--resume', action='store_true', help='FULL MODE: skip jockeys completed in the interrupted last run (checkpoint file)')
+    parser.add_argument('--retry-failed', action='store_true', help='FULL MODE: process only the jockeys that failed in the last run (checkpoint file)')
+    parser.add_argument('--estimate', action='store_true', help='FULL MODE: dry-run one jockey\'s queries, print projected bytes scanned and cost, and exit')
+    parser.add_argument('--max-cost-usd', type=float, default=cost_estimate.DEFAULT_MAX_COST_USD, help='FULL MODE: abort before starting if the estimated cost exceeds this (default: $BQ_MAX_COST_USD, or no cap)')
+    parser.add_argument('--offline', action='store_true', help='Query the local snapshot (export_snapshot.py) with DuckDB and write JSON locally instead of GCS')
     args = parser.parse_args()
 
+    # 途中の sys.exit や例外で抜けた場合も、finally で残りのアップロードとマニフェストを送り切る
+    storage_client = None
     try:
         # BigQueryとGCS クライアント
-        bq_client = bigquery.Client(project=PROJECT_ID)
-        storage_client = storage.Client(project=PROJECT_ID)
+        if args.offline:
+            bq_client = OfflineClient()
+            backend = LocalBackend()
+            print(f"🗂️  Offline mode: snapshot {bq_client.snapshot_dir} → {backend.output_dir}")
+            state_dir = os.path.join(backend.output_dir, '.incremental')
+            checkpoint_dir = os.path.join(backend.output_dir, '.checkpoint')
+        else:
+            bq_client = bigquery.Client(project=PROJECT_ID)
+            if not args.no_cache:
+                bq_client = CachedClient(bq_client)
+            backend = GCSBackend(storage.Client(project=PROJECT_ID), pool_size=args.upload_workers)
+            state_dir = incremental.DEFAULT_STATE_DIR
+            checkpoint_dir = checkpoint.DEFAULT_CHECKPOINT_DIR
+        if not args.no_query_log:
+            # クエリごとの時間・処理バイト数・スロット時間を .query_log/ に記録する
+            bq_client = InstrumentedClient(bq_client, 'jockeys')
+        # 生成した JSON はキューに積み、クエリと並行して送る（最後にディレクトリの manifest.json を書き出す）
+        storage_client = UploadService(backend, workers=args.upload_workers,
+                                       publish_format=PublishFormat(args.json_layout, args.compression), manifest=True)
 
         if args.test:
             # テストモード: 武豊のみ
             print(f"🚀 Starting jockey data export (TEST MODE)")
             print(f"   Processing single jockey: 武豊 (ID: 666)")
-            success = process_jockey(bq_client, storage_client, 666, "武豊")
+            success = process_jockey(bq_client, storage_client, 666, "武豊", max_in_flight=args.max_in_flight)
 
             print(f"\n{'='*60}")
             if success:
@@ -1427,7 +1450,7 @@ def main():
             # 特定の騎手のみ処理
             print(f"🚀 Starting jockey data export (SINGLE JOCKEY MODE)")
             print(f"   Processing jockey ID: {args.jockey_id}")
-            success = process_jockey(bq_client, storage_client, args.jockey_id, f"ID:{args.jockey_id}")
+            success = process_jockey(bq_client, storage_client, args.jockey_id, f"ID:{args.jockey_id}", max_in_flight=args.max_in_flight)
 
             print(f"\n{'='*60}")
             if success:
@@ -1464,34 +1487,83 @@ def main():
             jockeys = [(row.id, row.name) for row in result]
 
             print(f"   Found {len(jockeys)} active jockeys")
-            print(f"\n{'='*60}")
 
-            success_count = 0
-            fail_count = 0
+            # 差分更新: 前回の実行以降に取り込まれたレースに出走した騎手だけに絞る
+            state = incremental.load_state('jockey', state_dir)
+            changes = incremental.detect_changes(bq_client, BATCH_ENTITY, state, full=not args.incremental)
+            if not changes['full']:
+                jockeys = [(jockey_id, jockey_name) for jockey_id, jockey_name in jockeys if str(jockey_id) in changes['affected']]
+                print(f"   Incremental: {len(jockeys)} jockeys to regenerate")
+
+            # 見積もり: 代表の1人のクエリを dry run して全体のスキャン量と料金を求め、予算を超えるなら始める前に止める
+            if (args.estimate or args.max_cost_usd is not None) and jockeys:
+                total = estimate_cost(bq_client, jockeys[0][0], len(jockeys), no_batch=args.no_batch)
+                if not args.estimate:
+                    cost_estimate.check_budget(total, args.max_cost_usd)
+            elif args.estimate:
+                cost_estimate.print_empty_estimate('jockeys')
+            # --estimate は対象がなくてもここで終える（まとめ取得・ランキングのクエリやアップロード、差分更新の状態の保存をしない）
+            if args.estimate:
+                return
+
+            # 全騎手分のセクションを1クエリずつでまとめて取得
+            for_jockey = None
+            if not args.no_batch:
+                print(f"   Prefetching {len(BATCH_SECTIONS)} sections for all jockeys...")
+                for_jockey = prefetch_all_jockeys(bq_client)
+
+            rankings = precompute_rankings(bq_client)
+
+            max_in_flight = cap_in_flight(args.workers, args.max_in_flight)
+            entities = [
+                (f"{jockey_name} (ID: {jockey_id})",
+                 (bq_client, storage_client, jockey_id, jockey_name, for_jockey(jockey_id) if for_jockey else None, max_in_flight,
+                  rankings))
+                for jockey_id, jockey_name in jockeys
+            ]
+
+            # 途中再開: --resume は前回完了した騎手を飛ばし、--retry-failed は前回失敗した騎手だけを処理する
+            progress = checkpoint.Checkpoint('jockey', checkpoint.mode_from_args(args), checkpoint_dir)
+            entities = progress.select(entities, checkpoint_key)
+
+            print(f"   Processing with {args.workers} workers (max in flight: {max_in_flight})")
+            print(f"\n{'='*60}")
 
-            for i, (jockey_id, jockey_name) in enumerate(jockeys, 1):
-                print(f"\n[{i}/{len(jockeys)}] Processing: {jockey_name} (ID: {jockey_id})")
+            success_count, failed = run_entities(
+                entities, progress.wrap(process_jockey, storage_client, checkpoint_key),
+                workers=args.workers, retries=args.retries,
+            )
+            progress.close()
 
-                try:
-                    if process_jockey(bq_client, storage_client, jockey_id, jockey_name):
-                        success_count += 1
-                    else:
-                        fail_count += 1
-                except Exception as e:
-                    print(f"  ❌ Error: {str(e)}")
-                    fail_count += 1
+            # 失敗した騎手は次回の差分更新でも処理する（entity_args[2] は ID）
+            failed_keys = [str(entity_args[2]) for label, entity_args in entities if label in failed]
+            # アップロードに失敗したファイルがあれば、今回の対象を全件次回に持ち越す
+            storage_client.flush()
+            if storage_client.failed:
+                failed_keys = list(changes['affected'])
+            incremental.save_state('jockey', incremental.record_run(state, changes, failed_keys), state_dir)
 
             print(f"\n{'='*60}")
             print(f"✅ Processing complete!")
-            print(f"   Success: {success_count}/{len(jockeys)}")
-            print(f"   Failed:  {fail_count}/{len(jockeys)}")
+            print(f"   Success: {success_count}/{len(entities)}")
+            print(f"   Failed:  {len(failed)}/{len(entities)}")
+            for label in failed:
+                print(f"     - {label}")
             print(f"{'='*60}")
 
+        if args.offline or not args.no_cache or not args.no_query_log:
+            bq_client.report()
+        storage_client.close()
+        storage_client.report()
+
     except Exception as e:
         print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if storage_client is not None:
+            storage_client.close()
 
 
 if __name__ == "__main__":
@@ -13,6 +13,8 @@ from datetime import datetime
 from google.cloud import bigquery
 from google.cloud import storage
 
+from uploads import GCSBackend, UploadService
+
 # スクリプト自身のディレクトリを基準にパスを解決
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -100,18 +102,17 @@ print(f"   種牡馬: {len(leading_data['sire_leading'])}頭")
 
 # GCSに保存
 print(f"\n💾 GCSに保存中...")
-storage_client = storage.Client()
-bucket = storage_client.bucket('umadata')
-blob = bucket.blob('leading.json')
+uploads = UploadService(GCSBackend(storage.Client()))
 
 # JSON文字列に変換
 json_str = json.dumps(leading_data, ensure_ascii=False, indent=2)
 
-# アップロード
-blob.upload_from_string(
-    json_str,
-    content_type='application/json'
-)
+# アップロード（内容が前回と同じなら送らない）
+uploads.submit('umadata', 'leading.json', json_str, content_type='application/json')
+uploads.close()
+uploads.report()
+if uploads.failed:
+    exit(1)
 
 print(f"✅ GCSに保存完了: gs://umadata/leading.json")
 print(f"   公開URL: https://storage.googleapis.com/umadata/leading.json")
@@ -3,8 +3,6 @@
 JRAレーススケジュールをスクレイピングしてJSONを生成
 """
 
-import requests
-from bs4 import BeautifulSoup
 import json
 import re
 import sys
@@ -12,6 +10,13 @@ import os
 from datetime import datetime
 from google.cloud import storage
 
+from uploads import GCSBackend, UploadService
+
+# ページ取得のディスクキャッシュと HTML パース（リポジトリ直下の http_cache.py / html_parse.py）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from html_parse import SCHEDULE_TABLES, parse_tables
+from http_cache import CachedSession
+
 
 # 内回り・外回りの区別があるコース定義
 # format: (競馬場ID, コース区分, 距離)
@@ -52,12 +57,14 @@ def generate_jra_url(date_str):
     return url
 
 
-def scrape_race_schedule(url):
+def scrape_race_schedule(url, session=None):
     """
     JRAカレンダーページからレーススケジュールをスクレイピング
 
     Args:
         url: JRAカレンダーページのURL
+        session: ページの取得に使うセッション（省略時は http_cache.CachedSession。
+                 ページが変わっていなければ 304 で保存済みのページを使う）
 
     Returns:
         dict: レーススケジュールデータ
@@ -65,9 +72,26 @@ def scrape_race_schedule(url):
     print(f"🔍 Fetching: {url}")
 
     # ページを取得
-    response = requests.get(url)
+    session = session or CachedSession()
+    response = session.get(url)
     response.encoding = 'shift_jis'  # JRAページはShift_JISエンコーディング
-    soup = BeautifulSoup(response.text, 'html.parser')
+
+    return parse_race_schedule(response.text, url)
+
+
+def parse_race_schedule(html, url, fast=True):
+    """
+    JRAカレンダーページの HTML からレーススケジュールを取り出す
+
+    Args:
+        html: ページの HTML（デコード済みの str）
+        url: JRAカレンダーページのURL（日付の取得に使う）
+        fast: table.basic だけを lxml でパースする（False ならページ全体を html.parser でパースする。html_parse.py）
+
+    Returns:
+        dict: レーススケジュールデータ
+    """
+    soup = parse_tables(html, SCHEDULE_TABLES, fast=fast)
 
     # 日付を抽出（URLから）
     # https://www.jra.go.jp/keiba/calendar2026/2026/2/0214.html → 2026-02-14
@@ -273,13 +297,14 @@ def save_schedule_json(schedule, output_path):
     print(f"\n✅ Saved to: {output_path}")
 
 
-def upload_to_gcs(schedule, bucket_name='umadata'):
+def upload_to_gcs(schedule, bucket_name='umadata', uploads=None):
     """
     スケジュールをGCSにアップロード
 
     Args:
         schedule: スケジュールデータ
         bucket_name: GCSバケット名
+        uploads: 共有の UploadService（省略時はこの呼び出し用に作って送り切る）
     """
     # ファイル名を YYYYMMDD.json 形式で生成
     filename = schedule['date'].replace('-', '') + '.json'
@@ -290,19 +315,20 @@ def upload_to_gcs(schedule, bucket_name='umadata'):
     # JSONに変換
     json_data = json.dumps(schedule, ensure_ascii=False, indent=2)
 
-    try:
-        # GCSクライアント作成
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(gcs_path)
+    owns_uploads = uploads is None
+    if owns_uploads:
+        uploads = UploadService(GCSBackend(storage.Client()))
 
-        # アップロード
-        blob.upload_from_string(json_data, content_type='application/json')
+    # アップロード（キューに積み、送信はバックグラウンドで行う）
+    uploads.submit(bucket_name, gcs_path, json_data, content_type='application/json')
 
+    if owns_uploads:
+        uploads.close()
+        uploads.report()
+        if uploads.failed:
+            print(f"❌ Failed to upload to GCS: gs://{bucket_name}/{gcs_path}")
+            raise RuntimeError(f"Failed to upload gs://{bucket_name}/{gcs_path}")
         print(f"✅ Uploaded to GCS: gs://{bucket_name}/{gcs_path}")
-    except Exception as e:
-        print(f"❌ Failed to upload to GCS: {e}")
-        raise
 
 
 def display_race_names(schedule):
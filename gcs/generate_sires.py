@@ -5,35 +5,46 @@
 """
 
 from google.cloud import bigquery, storage
-import json
+import os
 import sys
 from datetime import datetime
 
+import batch_stats
+import checkpoint
+import cost_estimate
+import incremental
+import stat_schema
+from parallel import (DEFAULT_MAX_IN_FLIGHT, DEFAULT_RETRIES, DEFAULT_WORKERS, cap_in_flight,
+                      fetch_sections, run_entities)
+from offline_client import OfflineClient
+from query_cache import CachedClient
+from query_params import run_query
+from query_stats import InstrumentedClient, query_section
+from publish_format import COMPRESSIONS, JSON_LAYOUTS, PublishFormat
+from uploads import DEFAULT_UPLOAD_WORKERS, GCSBackend, LocalBackend, UploadService
+
 # 設定
 PROJECT_ID = 'umadata'
 BUCKET_NAME = 'umadata'
 DATASET = 'umadata.keiba_data'
 
-# グローバル変数として現在処理中の種牡馬情報を保持
-SIRE_NAME = None
-SIRE_NAME_SQL = None  # SQL文字列内で安全に使えるエスケープ済み名前
 
-def get_sire_basic_info(client):
+def get_sire_basic_info(client, sire_name):
     """種牡馬の基本情報を取得"""
     # 種牡馬を父に持つ馬の数を取得
     query = f"""
     SELECT
-      '{SIRE_NAME_SQL}' as name,
-      '{SIRE_NAME_SQL}' as name_en,
+      @father as name,
+      @father as name_en,
       COUNT(DISTINCT h.horse_id) as total_horses
     FROM
       `{DATASET}.horse` h
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         rows = list(results)
         if not rows:
             return None
@@ -47,7 +58,7 @@ def get_sire_basic_info(client):
         raise
 
 
-def get_total_stats(client):
+def get_total_stats(client, sire_name):
     """総合成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -67,12 +78,12 @@ def get_total_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         rows = list(results)
         if not rows:
             return None
@@ -82,7 +93,7 @@ def get_total_stats(client):
         raise
 
 
-def get_yearly_stats(client):
+def get_yearly_stats(client, sire_name):
     """年度別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -105,22 +116,25 @@ def get_yearly_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY year
     ORDER BY year DESC
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching yearly stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_yearly_leading(client):
-    """年度別リーディング順位を取得（過去3年間）"""
+def get_all_yearly_leading(client):
+    """全種牡馬の年度別リーディング順位を取得（過去3年間）
+
+    戻り値は {father: [{year, wins, ranking}]}（年度の新しい順）
+    """
     query = f"""
     WITH yearly_wins AS (
       SELECT
@@ -148,23 +162,27 @@ def get_yearly_leading(client):
       FROM yearly_wins
     )
     SELECT
+      father,
       year,
       wins,
       ranking
     FROM ranked
-    WHERE father = '{SIRE_NAME_SQL}'
     ORDER BY year DESC
     """
 
     try:
         results = client.query(query).result()
-        return [dict(row) for row in results]
+        leading = {}
+        for row in results:
+            row = dict(row)
+            leading.setdefault(row.pop('father'), []).append(row)
+        return leading
     except Exception as e:
         print(f"   ⚠️  Error fetching yearly leading: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_distance_stats(client):
+def get_distance_stats(client, sire_name):
     """距離別成績を取得（過去3年間）
 
     距離カテゴリ定義:
@@ -199,7 +217,7 @@ def get_distance_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY category
     ORDER BY
@@ -212,14 +230,14 @@ def get_distance_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching distance stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_surface_stats(client):
+def get_surface_stats(client, sire_name):
     """芝・ダート別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -247,7 +265,7 @@ def get_surface_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY surface
     ORDER BY
@@ -260,102 +278,30 @@ def get_surface_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching surface stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_running_style_stats(client):
+def get_running_style_stats(client, sire_name):
     """脚質別成績を取得（過去3年間）"""
     query = f"""
-    WITH all_horses AS (
-      SELECT
-        rm.race_id,
-        rr.horse_id,
-        rr.finish_position,
-        rr.popularity,
-        rr.win,
-        rr.place,
-        rm.entry_count,
-        rr.last_3f_time,
-        SPLIT(rr.corner_positions, '-') as corner_array,
-        RANK() OVER (PARTITION BY rm.race_id ORDER BY rr.last_3f_time ASC) as last_3f_rank
-      FROM
-        `{DATASET}.race_master` rm
-        JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
-      WHERE
-        rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
-    ),
-    sire_horses AS (
+    WITH running_style_classified AS (
+      -- 脚質は race_result_enriched で分類済み（build_derived_tables.py）
       SELECT
-        ah.race_id,
-        ah.horse_id,
-        ah.finish_position,
-        ah.popularity,
-        ah.win,
-        ah.place,
-        ah.entry_count,
-        ah.last_3f_time,
-        ah.last_3f_rank,
-        ah.corner_array
+        e.finish_position,
+        e.popularity,
+        e.win,
+        e.place,
+        e.running_style
       FROM
-        all_horses ah
-        JOIN `{DATASET}.horse` h ON ah.horse_id = h.horse_id
+        `{DATASET}.race_result_enriched` e
+        JOIN `{DATASET}.horse` h ON e.horse_id = h.horse_id
       WHERE
-        h.father = '{SIRE_NAME_SQL}'
-        AND ah.corner_array IS NOT NULL
-        AND ARRAY_LENGTH(ah.corner_array) > 0
-    ),
-    corner_parsed AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        entry_count,
-        last_3f_time,
-        last_3f_rank,
-        corner_array,
-        ARRAY_LENGTH(corner_array) as corner_count,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 1, corner_array[OFFSET(0)], NULL) AS INT64) as corner_1,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 2, corner_array[OFFSET(1)], NULL) AS INT64) as corner_2,
-        CAST(IF(ARRAY_LENGTH(corner_array) >= 3, corner_array[OFFSET(2)], NULL) AS INT64) as corner_3,
-        CAST(corner_array[OFFSET(ARRAY_LENGTH(corner_array)-1)] AS INT64) as final_corner
-      FROM
-        sire_horses
-    ),
-    running_style_classified AS (
-      SELECT
-        race_id,
-        horse_id,
-        finish_position,
-        popularity,
-        win,
-        place,
-        CASE
-          WHEN corner_count >= 1 AND (
-            COALESCE(corner_1, 0) = 1 OR
-            COALESCE(corner_2, 0) = 1 OR
-            COALESCE(corner_3, 0) = 1
-          )
-            THEN 'escape'
-          WHEN COALESCE(final_corner, 999) <= CAST(CEIL(entry_count / 3.0) AS INT64)
-            THEN 'lead'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(entry_count / 3.0) AS INT64)
-            AND COALESCE(final_corner, 999) <= CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 3
-            THEN 'pursue'
-          WHEN COALESCE(final_corner, 999) > CAST(CEIL(2 * entry_count / 3.0) AS INT64)
-            AND last_3f_rank <= 3
-            THEN 'close'
-          ELSE NULL
-        END as running_style
-      FROM
-        corner_parsed
+        h.father = @father
+        AND e.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     )
     SELECT
       running_style as style,
@@ -400,29 +346,28 @@ def get_running_style_stats(client):
     """
 
     try:
-        from google.cloud.bigquery import QueryJobConfig
-        job_config = QueryJobConfig(use_query_cache=False)
-        results = client.query(query, job_config=job_config).result()
+        results = run_query(client, query, {'father': sire_name}, use_query_cache=False)
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching running style stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_gate_stats(client):
-    """枠順別成績を取得（過去3年間）"""
-    # 枠番の色定義（騎手/コースページと同じ）
-    gate_colors = {
-        1: '#FFFFFF',
-        2: '#222222',
-        3: '#C62927',
-        4: '#2573CD',
-        5: '#E4CA3C',
-        6: '#58AF4A',
-        7: '#FAA727',
-        8: '#DC6179',
-    }
+# 枠番の色定義（騎手/コースページと同じ）
+GATE_COLORS = {
+    1: '#FFFFFF',
+    2: '#222222',
+    3: '#C62927',
+    4: '#2573CD',
+    5: '#E4CA3C',
+    6: '#58AF4A',
+    7: '#FAA727',
+    8: '#DC6179',
+}
 
+
+def get_gate_stats(client, sire_name):
+    """枠順別成績を取得（過去3年間）"""
     query = f"""
     SELECT
       rr.bracket_number as gate,
@@ -444,7 +389,7 @@ def get_gate_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.bracket_number BETWEEN 1 AND 8
     GROUP BY rr.bracket_number
@@ -452,11 +397,11 @@ def get_gate_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         gate_stats = []
         for row in results:
             row_dict = dict(row)
-            row_dict['color'] = gate_colors.get(row_dict['gate'], '#CCCCCC')
+            row_dict['color'] = GATE_COLORS.get(row_dict['gate'], '#CCCCCC')
             gate_stats.append(row_dict)
         return gate_stats
     except Exception as e:
@@ -464,7 +409,7 @@ def get_gate_stats(client):
         raise
 
 
-def get_track_condition_stats(client):
+def get_track_condition_stats(client, sire_name):
     """馬場状態別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -503,7 +448,7 @@ def get_track_condition_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rm.track_condition IS NOT NULL
     GROUP BY surface, condition, condition_label
@@ -518,14 +463,14 @@ def get_track_condition_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching track condition stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_class_stats(client):
+def get_class_stats(client, sire_name):
     """クラス別成績を取得（過去3年間）"""
     query = f"""
     WITH class_data AS (
@@ -560,7 +505,7 @@ def get_class_stats(client):
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
         JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
       WHERE
-        h.father = '{SIRE_NAME_SQL}'
+        h.father = @father
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
         AND rm.race_class IS NOT NULL
       GROUP BY class_name
@@ -598,14 +543,14 @@ def get_class_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching class stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_gender_stats(client):
+def get_gender_stats(client, sire_name):
     """性別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -633,7 +578,7 @@ def get_gender_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.sex IS NOT NULL
     GROUP BY rr.sex
@@ -647,14 +592,14 @@ def get_gender_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching gender stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_age_stats(client):
+def get_age_stats(client, sire_name):
     """馬齢別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -677,7 +622,7 @@ def get_age_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.age BETWEEN 2 AND 5
     GROUP BY age
@@ -685,7 +630,7 @@ def get_age_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         age_stats = [dict(row) for row in results]
 
         # 6歳以上をまとめて追加
@@ -710,12 +655,12 @@ def get_age_stats(client):
           JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
           JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
         WHERE
-          h.father = '{SIRE_NAME_SQL}'
+          h.father = @father
           AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
           AND rr.age >= 6
         """
 
-        results_6plus = client.query(query_6plus).result()
+        results_6plus = run_query(client, query_6plus, {'father': sire_name})
         for row in results_6plus:
             age_stats.append(dict(row))
 
@@ -725,7 +670,7 @@ def get_age_stats(client):
         raise
 
 
-def get_horse_weight_stats(client):
+def get_horse_weight_stats(client, sire_name):
     """馬体重別成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -758,7 +703,7 @@ def get_horse_weight_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND rr.horse_weight IS NOT NULL
       AND rr.horse_weight > 0
@@ -778,14 +723,14 @@ def get_horse_weight_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching horse weight stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_dam_sire_stats(client):
+def get_dam_sire_stats(client, sire_name):
     """母父別成績を取得（過去3年間、上位50頭）"""
     query = f"""
     SELECT
@@ -809,7 +754,7 @@ def get_dam_sire_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       AND h.mf IS NOT NULL
     GROUP BY name
@@ -818,14 +763,14 @@ def get_dam_sire_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching dam sire stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_racecourse_stats(client):
+def get_racecourse_stats(client, sire_name):
     """競馬場別成績を取得（過去3年間）
 
     中央・ローカル・右回り・左回りの集計行も含める
@@ -864,14 +809,14 @@ def get_racecourse_stats(client):
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
       JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
     WHERE
-      h.father = '{SIRE_NAME_SQL}'
+      h.father = @father
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     GROUP BY rm.venue_name
     ORDER BY wins DESC, places_2 DESC, places_3 DESC, races ASC
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         racecourse_data = [dict(row) for row in results]
 
         # 右回り・左回り・中央・ローカルの定義
@@ -898,11 +843,11 @@ def get_racecourse_stats(client):
               JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
               JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
             WHERE
-              h.father = '{SIRE_NAME_SQL}'
+              h.father = @father
               AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
               AND rm.venue_name IN ('東京', '新潟', '中京', '小倉')
             """
-            median_results = client.query(right_turn_median_query).result()
+            median_results = run_query(client, right_turn_median_query, {'father': sire_name})
             median_row = dict(list(median_results)[0]) if median_results else {}
 
             right_turn_summary = {
@@ -943,11 +888,11 @@ def get_racecourse_stats(client):
               JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
               JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
             WHERE
-              h.father = '{SIRE_NAME_SQL}'
+              h.father = @father
               AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
               AND rm.venue_name IN ('札幌', '函館', '福島', '中山', '阪神', '京都')
             """
-            median_results = client.query(left_turn_median_query).result()
+            median_results = run_query(client, left_turn_median_query, {'father': sire_name})
             median_row = dict(list(median_results)[0]) if median_results else {}
 
             left_turn_summary = {
@@ -988,11 +933,11 @@ def get_racecourse_stats(client):
               JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
               JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
             WHERE
-              h.father = '{SIRE_NAME_SQL}'
+              h.father = @father
               AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
               AND rm.venue_name IN ('東京', '中山', '阪神', '京都')
             """
-            median_results = client.query(central_median_query).result()
+            median_results = run_query(client, central_median_query, {'father': sire_name})
             median_row = dict(list(median_results)[0]) if median_results else {}
 
             central_summary = {
@@ -1033,11 +978,11 @@ def get_racecourse_stats(client):
               JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
               JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
             WHERE
-              h.father = '{SIRE_NAME_SQL}'
+              h.father = @father
               AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
               AND rm.venue_name IN ('札幌', '函館', '福島', '新潟', '中京', '小倉')
             """
-            median_results = client.query(local_median_query).result()
+            median_results = run_query(client, local_median_query, {'father': sire_name})
             median_row = dict(list(median_results)[0]) if median_results else {}
 
             local_summary = {
@@ -1067,7 +1012,7 @@ def get_racecourse_stats(client):
         raise
 
 
-def get_course_stats(client):
+def get_course_stats(client, sire_name):
     """コース別成績を取得（過去3年間）"""
     query = f"""
     WITH course_data AS (
@@ -1094,7 +1039,7 @@ def get_course_stats(client):
         JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
         JOIN `{DATASET}.horse` h ON rr.horse_id = h.horse_id
       WHERE
-        h.father = '{SIRE_NAME_SQL}'
+        h.father = @father
         AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
       GROUP BY
         rm.venue_name,
@@ -1166,14 +1111,14 @@ def get_course_stats(client):
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'father': sire_name})
         return [dict(row) for row in results]
     except Exception as e:
         print(f"   ⚠️  Error fetching course stats: {str(e)}", file=sys.stderr)
         raise
 
 
-def get_surface_change_stats(client):
+def get_surface_change_stats(client, sire_name):
     """芝・ダート変わりの成績を取得（過去3年間）"""
     # ダート変わり：芝デビュー後、初めてダートを走った際の成績
     turf_to_dirt_query = f"""
@@ -1189,7 +1134,7 @@ def get_surface_change_stats(client):
         JOIN `{DATASET}.race_result` rr ON h.horse_id = rr.horse_id
         JOIN `{DATASET}.race_master` rm ON rr.race_id = rm.race_id
       WHERE
-        h.father = '{SIRE_NAME_SQL}'
+        h.father = @father
       QUALIFY ROW_NUMBER() OVER (PARTITION BY h.horse_id ORDER BY rm.race_date ASC) = 1
     ),
     first_dirt_race AS (
@@ -1246,7 +1191,7 @@ def get_surface_change_stats(client):
         JOIN `{DATASET}.race_result` rr ON h.horse_id = rr.horse_id
         JOIN `{DATASET}.race_master` rm ON rr.race_id = rm.race_id
       WHERE
-        h.father = '{SIRE_NAME_SQL}'
+        h.father = @father
       QUALIFY ROW_NUMBER() OVER (PARTITION BY h.horse_id ORDER BY rm.race_date ASC) = 1
     ),
     first_turf_race AS (
@@ -1291,11 +1236,11 @@ def get_surface_change_stats(client):
 
     try:
         # ダート変わりデータ取得
-        turf_to_dirt_results = client.query(turf_to_dirt_query).result()
+        turf_to_dirt_results = run_query(client, turf_to_dirt_query, {'father': sire_name})
         turf_to_dirt_data = dict(list(turf_to_dirt_results)[0]) if turf_to_dirt_results else {}
 
         # 芝変わりデータ取得
-        dirt_to_turf_results = client.query(dirt_to_turf_query).result()
+        dirt_to_turf_results = run_query(client, dirt_to_turf_query, {'father': sire_name})
         dirt_to_turf_data = dict(list(dirt_to_turf_results)[0]) if dirt_to_turf_results else {}
 
         return {
@@ -1311,12 +1256,105 @@ def get_surface_change_stats(client):
         }
 
 
-def process_sire(bq_client, storage_client, sire_id, sire_name):
-    """1頭の種牡馬のデータを処理してGCSにアップロード"""
-    global SIRE_NAME, SIRE_NAME_SQL
-    SIRE_NAME = sire_name
-    SIRE_NAME_SQL = sire_name.replace("'", "\\'")
+def precompute_rankings(client):
+    """全種牡馬を対象にしたランキングを1回だけ計算する
+
+    年度別リーディングの順位は全種牡馬の集計が必要なため、
+    種牡馬ごとに計算し直さず実行の最初にまとめて求めて process_sire に渡す。
+    """
+    print("   Precomputing rankings (yearly leading)...")
+    return {
+        'yearly_leading': get_all_yearly_leading(client),
+    }
+
 
+# 全種牡馬分を1クエリずつでまとめて集計するセクション（batch_stats）
+BATCH_ENTITY = {'key': 'h.father', 'joins': ['horse']}
+BATCH_SECTIONS = [
+    batch_stats.total_section(batch_stats.RATE_RANK_METRICS),
+    batch_stats.yearly_section(),
+    batch_stats.distance_section(),
+    batch_stats.surface_section(only_known=False),
+    batch_stats.gate_section(valid_only=True),
+    batch_stats.class_section(),
+    batch_stats.gender_section(),
+    batch_stats.age_section(),
+    batch_stats.horse_weight_section(),
+]
+
+def prefetch_all_sires(client):
+    """全種牡馬分のセクションをまとめて取得し、種牡馬名から prefetched を返す関数を作る"""
+    batch = batch_stats.prefetch_sections(client, BATCH_ENTITY, BATCH_SECTIONS)
+
+    def for_sire(sire_name):
+        data = batch.for_entity(sire_name)
+        if data['total_stats'] is None:
+            # 出走がない場合は個別クエリに任せる
+            del data['total_stats']
+        for row in data['gate_stats']:
+            row['color'] = GATE_COLORS.get(row['gate'], '#CCCCCC')
+        # 6歳以上の行は出走がなくても常に含める（get_age_stats と同じ形）
+        if not any(row['age'] == '6歳-' for row in data['age_stats']):
+            data['age_stats'].append({'age': '6歳-', 'races': 0, **{
+                key: None for key in (
+                    'wins', 'places_2', 'places_3', 'win_rate', 'quinella_rate', 'place_rate',
+                    'win_payback', 'place_payback', 'avg_popularity', 'avg_rank',
+                    'median_popularity', 'median_rank',
+                )
+            }})
+        return data
+
+    return for_sire
+
+
+def entity_sections(rankings):
+    """1頭分のセクション（fetch_sections に渡す [(name, getter)]）
+
+    rankings はこのジェネレーターでは使わない（他のジェネレーターと引数をそろえている）
+    """
+    return [
+        ('total_stats', get_total_stats),
+        ('yearly_stats', get_yearly_stats),
+        ('distance_stats', get_distance_stats),
+        ('surface_stats', get_surface_stats),
+        ('running_style_stats', get_running_style_stats),
+        ('gate_stats', get_gate_stats),
+        ('track_condition_stats', get_track_condition_stats),
+        ('class_stats', get_class_stats),
+        ('gender_stats', get_gender_stats),
+        ('age_stats', get_age_stats),
+        ('horse_weight_stats', get_horse_weight_stats),
+        ('dam_sire_stats', get_dam_sire_stats),
+        ('racecourse_stats', get_racecourse_stats),
+        ('course_stats', get_course_stats),
+        ('surface_change_stats', get_surface_change_stats),
+    ]
+
+
+def estimate_cost(bq_client, sample, entity_count, no_batch=False):
+    """FULL MODE のスキャン量と料金を見積もる（代表の1頭（sample: 種牡馬名）のクエリを dry run して × entity_count）"""
+    client = cost_estimate.DryRunClient(bq_client)
+    batch_names = set()
+    if not no_batch:
+        batch_stats.prefetch_sections(client, BATCH_ENTITY, BATCH_SECTIONS)
+        batch_names = {section['name'] for section in BATCH_SECTIONS}
+    rankings = precompute_rankings(client)
+    with client.per_entity(entity_count):
+        with query_section('basic_info', sample):
+            get_sire_basic_info(client, sample)
+        cost_estimate.dry_run_sections(client, entity_sections(rankings), args=(sample,), skip=batch_names)
+    return cost_estimate.print_estimate(client, entity_count, 'sires')
+
+
+def process_sire(bq_client, storage_client, sire_id, sire_name, prefetched=None,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, rankings=None):
+    """1頭の種牡馬のデータを処理してGCSにアップロード
+
+    prefetched: batch_stats で全種牡馬分まとめて取得済みのセクション（{name: rows}）。
+    含まれるセクションはクエリを発行せずにそのまま使う。
+    max_in_flight: 同時に実行するセクションクエリ数の上限（1 なら順番に実行）
+    rankings: precompute_rankings の結果。省略時はこの種牡馬の処理の中で計算する
+    """
     print(f"\n{'='*60}")
     print(f"🏇 Processing: {sire_name} (ID: {sire_id})")
     print(f"{'='*60}")
@@ -1324,73 +1362,34 @@ def process_sire(bq_client, storage_client, sire_id, sire_name):
     try:
         # 基本情報取得
         print("  [1/18] Fetching basic info...")
-        basic_info = get_sire_basic_info(bq_client)
+        basic_info = get_sire_basic_info(bq_client, sire_name)
         if not basic_info:
             print(f"  ⚠️  Sire not found: {sire_name}")
             return False
 
-        # 総合成績取得
-        print("  [2/18] Fetching total stats...")
-        total_stats = get_total_stats(bq_client)
-
-        # 年度別成績取得
-        print("  [3/18] Fetching yearly stats...")
-        yearly_stats = get_yearly_stats(bq_client)
-
-        print("  [4/18] Fetching yearly leading...")
-        yearly_leading = get_yearly_leading(bq_client)
-
-        # 距離別成績取得
-        print("  [5/18] Fetching distance stats...")
-        distance_stats = get_distance_stats(bq_client)
-
-        # 芝・ダート別成績取得
-        print("  [6/18] Fetching surface stats...")
-        surface_stats = get_surface_stats(bq_client)
-
-        # 脚質別成績取得
-        print("  [7/18] Fetching running style stats...")
-        running_style_stats = get_running_style_stats(bq_client)
-
-        # 枠順別成績取得
-        print("  [8/18] Fetching gate stats...")
-        gate_stats = get_gate_stats(bq_client)
-
-        # 馬場状態別成績取得
-        print("  [9/18] Fetching track condition stats...")
-        track_condition_stats = get_track_condition_stats(bq_client)
-
-        # クラス別成績取得
-        print("  [10/18] Fetching class stats...")
-        class_stats = get_class_stats(bq_client)
-
-        # 性別成績取得
-        print("  [11/18] Fetching gender stats...")
-        gender_stats = get_gender_stats(bq_client)
-
-        # 馬齢別成績取得
-        print("  [12/18] Fetching age stats...")
-        age_stats = get_age_stats(bq_client)
-
-        # 馬体重別成績取得
-        print("  [13/18] Fetching horse weight stats...")
-        horse_weight_stats = get_horse_weight_stats(bq_client)
-
-        # 母父別成績取得
-        print("  [14/18] Fetching dam sire stats...")
-        dam_sire_stats = get_dam_sire_stats(bq_client)
-
-        # 競馬場別成績取得
-        print("  [15/18] Fetching racecourse stats...")
-        racecourse_stats = get_racecourse_stats(bq_client)
-
-        # コース別成績取得
-        print("  [16/18] Fetching course stats...")
-        course_stats = get_course_stats(bq_client)
-
-        # 芝・ダート変わりデータ取得
-        print("  [17/18] Fetching surface change stats...")
-        surface_change_stats = get_surface_change_stats(bq_client)
+        if rankings is None:
+            rankings = precompute_rankings(bq_client)
+
+        # 全セクションのクエリをまとめて投入し、終わった順に回収
+        sections = entity_sections(rankings)
+        print(f"  Fetching {len(sections)} sections (max in flight: {max_in_flight})...")
+        data = fetch_sections(bq_client, sections, prefetched, max_in_flight, args=(sire_name,))
+        total_stats = data['total_stats']
+        yearly_stats = data['yearly_stats']
+        yearly_leading = rankings['yearly_leading'].get(sire_name, [])
+        distance_stats = data['distance_stats']
+        surface_stats = data['surface_stats']
+        running_style_stats = data['running_style_stats']
+        gate_stats = data['gate_stats']
+        track_condition_stats = data['track_condition_stats']
+        class_stats = data['class_stats']
+        gender_stats = data['gender_stats']
+        age_stats = data['age_stats']
+        horse_weight_stats = data['horse_weight_stats']
+        dam_sire_stats = data['dam_sire_stats']
+        racecourse_stats = data['racecourse_stats']
+        course_stats = data['course_stats']
+        surface_change_stats = data['surface_change_stats']
 
         # データ期間の計算
         from datetime import timedelta
@@ -1498,10 +1497,8 @@ def process_sire(bq_client, storage_client, sire_id, sire_name):
         blob_path = f"sires/{padded_id}.json"
         blob = bucket.blob(blob_path)
 
-        blob.upload_from_string(
-            json.dumps(sire_data, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
+        # 数値項目の型をそろえてから送る（宣言した型に合わなければこのエンティティは失敗扱い）
+        blob.upload_json(stat_schema.coerce(sire_data))
 
         print(f"  ✅ {sire_name} (ID: {sire_id}) uploaded to {blob_path}")
         return True
@@ -1626,6 +1623,11 @@ def auto_register_new_sires(bq_sires, sire_mapping, sires_ts_path):
     return sire_mapping
 
 
+def checkpoint_key(entity_args):
+    """チェックポイントに記録するキー（process_sire の引数の種牡馬名）"""
+    return entity_args[3]
+
+
 def main():
     """メイン処理"""
     import argparse
@@ -1634,10 +1636,24 @@ def main():
     parser.add_argument('--sire-id', type=int, help='Process a specific sire by ID')
     parser.add_argument('--sire-name', type=str, help='Process a specific sire by name')
     parser.add_argument('--test', action='store_true', help='Test mode: process only ディープインパクト')
+    parser.add_argument('--no-batch', action='store_true', help='FULL MODE: query each section per sire instead of grouped batch queries')
+    parser.add_argument('--max-in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT, help=f'Max concurrent section queries per sire (1 = sequential, default: {DEFAULT_MAX_IN_FLIGHT})')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'FULL MODE: number of sires processed in parallel (1 = sequential, default: {DEFAULT_WORKERS})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help=f'FULL MODE: times to retry failed sires (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--no-cache', action='store_true', help='Always query BigQuery instead of reusing cached results on disk')
+    parser.add_argument('--no-query-log', action='store_true', help='Do not write per-query latency/bytes/slot stats to a JSONL log')
+    parser.add_argument('--upload-workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help=f'Number of parallel uploads (default: {DEFAULT_UPLOAD_WORKERS})')
+    parser.add_argument('--json-layout', choices=JSON_LAYOUTS, default='pretty', help='Published JSON layout (columnar: stat arrays as column arrays; default: pretty)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none', help='Store JSON pre-compressed with this Content-Encoding (default: none)')
+    parser.add_argument('--incremental', action='store_true', help='FULL MODE: regenerate only sires whose offspring ran in races loaded since the last run')
+    parser.add_argument('--resume', action='store_true', help='FULL MODE: skip sires completed in the interrupted last run (checkpoint file)')
+    parser.add_argument('--retry-failed', action='store_true', help='FULL MODE: process only the sires that failed in the last run (checkpoint file)')
+    parser.add_argument('--estimate', action='store_true', help='FULL MODE: dry-run one sire\'s queries, print projected bytes scanned and cost, and exit')
+    parser.add_argument('--max-cost-usd', type=float, default=cost_estimate.DEFAULT_MAX_COST_USD, help='FULL MODE: abort before starting if the estimated cost exceeds this (default: $BQ_MAX_COST_USD, or no cap)')
+    parser.add_argument('--offline', action='store_true', help='Query the local snapshot (export_snapshot.py) with DuckDB and write JSON locally instead of GCS')
     args = parser.parse_args()
 
     # lib/sires.tsからIDマッピングをロード
-    import os
     sire_mapping = {}
     sires_ts_path = os.path.join(os.path.dirname(__file__), '..', 'lib', 'sires.ts')
     if os.path.exists(sires_ts_path):
@@ -1652,10 +1668,29 @@ def main():
                 sire_mapping[sire_id] = sire_name
                 sire_mapping[sire_name] = sire_id
 
+    # 途中の sys.exit や例外で抜けた場合も、finally で残りのアップロードとマニフェストを送り切る
+    storage_client = None
     try:
         # BigQueryとGCS クライアント
-        bq_client = bigquery.Client(project=PROJECT_ID)
-        storage_client = storage.Client(project=PROJECT_ID)
+        if args.offline:
+            bq_client = OfflineClient()
+            backend = LocalBackend()
+            print(f"🗂️  Offline mode: snapshot {bq_client.snapshot_dir} → {backend.output_dir}")
+            state_dir = os.path.join(backend.output_dir, '.incremental')
+            checkpoint_dir = os.path.join(backend.output_dir, '.checkpoint')
+        else:
+            bq_client = bigquery.Client(project=PROJECT_ID)
+            if not args.no_cache:
+                bq_client = CachedClient(bq_client)
+            backend = GCSBackend(storage.Client(project=PROJECT_ID), pool_size=args.upload_workers)
+            state_dir = incremental.DEFAULT_STATE_DIR
+            checkpoint_dir = checkpoint.DEFAULT_CHECKPOINT_DIR
+        if not args.no_query_log:
+            # クエリごとの時間・処理バイト数・スロット時間を .query_log/ に記録する
+            bq_client = InstrumentedClient(bq_client, 'sires')
+        # 生成した JSON はキューに積み、クエリと並行して送る（最後にディレクトリの manifest.json を書き出す）
+        storage_client = UploadService(backend, workers=args.upload_workers,
+                                       publish_format=PublishFormat(args.json_layout, args.compression), manifest=True)
 
         if args.test:
             # テストモード: ディープインパクトのみ
@@ -1663,7 +1698,7 @@ def main():
             print(f"   Processing single sire: ディープインパクト")
             sire_name = "ディープインパクト"
             sire_id = sire_mapping.get(sire_name, 36)  # ディープインパクトはID=36
-            success = process_sire(bq_client, storage_client, sire_id, sire_name)
+            success = process_sire(bq_client, storage_client, sire_id, sire_name, max_in_flight=args.max_in_flight)
 
             print(f"\n{'='*60}")
             if success:
@@ -1682,7 +1717,7 @@ def main():
                 sys.exit(1)
             print(f"🚀 Starting sire data export (SINGLE SIRE MODE)")
             print(f"   Processing sire: {sire_name} (ID: {sire_id})")
-            success = process_sire(bq_client, storage_client, sire_id, sire_name)
+            success = process_sire(bq_client, storage_client, sire_id, sire_name, max_in_flight=args.max_in_flight)
 
             print(f"\n{'='*60}")
             if success:
@@ -1701,7 +1736,7 @@ def main():
                 sys.exit(1)
             print(f"🚀 Starting sire data export (SINGLE SIRE MODE)")
             print(f"   Processing sire: {sire_name} (ID: {sire_id})")
-            success = process_sire(bq_client, storage_client, sire_id, sire_name)
+            success = process_sire(bq_client, storage_client, sire_id, sire_name, max_in_flight=args.max_in_flight)
 
             print(f"\n{'='*60}")
             if success:
@@ -1727,42 +1762,92 @@ def main():
             # sires.ts に未登録の種牡馬を自動追加
             sire_mapping = auto_register_new_sires(sires, sire_mapping, sires_ts_path)
 
-            print(f"\n{'='*60}")
-
-            success_count = 0
-            fail_count = 0
-
-            for i, sire_info in enumerate(sires, 1):
+            # 差分更新: 前回の実行以降に取り込まれたレースに産駒が出走した種牡馬だけに絞る
+            state = incremental.load_state('sire', state_dir)
+            changes = incremental.detect_changes(bq_client, BATCH_ENTITY, state, full=not args.incremental)
+            if not changes['full']:
+                sires = [sire_info for sire_info in sires if sire_info['name'] in changes['affected']]
+                print(f"   Incremental: {len(sires)} sires to regenerate")
+
+            # 見積もり: 代表の1頭のクエリを dry run して全体のスキャン量と料金を求め、予算を超えるなら始める前に止める
+            if (args.estimate or args.max_cost_usd is not None) and sires:
+                total = estimate_cost(bq_client, sires[0]['name'], len(sires), no_batch=args.no_batch)
+                if not args.estimate:
+                    cost_estimate.check_budget(total, args.max_cost_usd)
+            elif args.estimate:
+                cost_estimate.print_empty_estimate('sires')
+            # --estimate は対象がなくてもここで終える（まとめ取得・ランキングのクエリやアップロード、差分更新の状態の保存をしない）
+            if args.estimate:
+                return
+
+            # 全種牡馬分のセクションを1クエリずつでまとめて取得
+            for_sire = None
+            if not args.no_batch:
+                print(f"   Prefetching {len(BATCH_SECTIONS)} sections for all sires...")
+                for_sire = prefetch_all_sires(bq_client)
+
+            rankings = precompute_rankings(bq_client)
+
+            max_in_flight = cap_in_flight(args.workers, args.max_in_flight)
+            entities = []
+            skipped = []
+            for sire_info in sires:
                 sire_name = sire_info['name']
                 sire_id = sire_mapping.get(sire_name)
                 if not sire_id:
-                    print(f"\n[{i}/{len(sires)}] ⚠️  Skipping {sire_name} (not found in sires.ts)")
-                    fail_count += 1
+                    print(f"   ⚠️  Skipping {sire_name} (not found in sires.ts)")
+                    skipped.append(sire_name)
                     continue
 
-                print(f"\n[{i}/{len(sires)}] Processing: {sire_name} (ID: {sire_id})")
-                print(f"   (レース数: {sire_info['race_count']}, 産駒数: {sire_info['horse_count']})")
+                prefetched = for_sire(sire_name) if for_sire else None
+                entities.append((
+                    f"{sire_name} (ID: {sire_id}, レース数: {sire_info['race_count']}, 産駒数: {sire_info['horse_count']})",
+                    (bq_client, storage_client, sire_id, sire_name, prefetched, max_in_flight, rankings),
+                ))
 
-                try:
-                    if process_sire(bq_client, storage_client, sire_id, sire_name):
-                        success_count += 1
-                    else:
-                        fail_count += 1
-                except Exception as e:
-                    print(f"  ❌ Error: {str(e)}")
-                    fail_count += 1
+            # 途中再開: --resume は前回完了した種牡馬を飛ばし、--retry-failed は前回失敗した種牡馬だけを処理する
+            progress = checkpoint.Checkpoint('sire', checkpoint.mode_from_args(args), checkpoint_dir)
+            entities = progress.select(entities, checkpoint_key)
+
+            print(f"   Processing with {args.workers} workers (max in flight: {max_in_flight})")
+            print(f"\n{'='*60}")
+
+            success_count, failed = run_entities(
+                entities, progress.wrap(process_sire, storage_client, checkpoint_key),
+                workers=args.workers, retries=args.retries,
+            )
+            progress.close()
+
+            # 失敗した種牡馬は次回の差分更新でも処理する（entity_args[3] は種牡馬名。sires.ts 未登録は対象外）
+            failed_keys = [entity_args[3] for label, entity_args in entities if label in failed]
+            # アップロードに失敗したファイルがあれば、今回の対象を全件次回に持ち越す
+            storage_client.flush()
+            if storage_client.failed:
+                failed_keys = list(changes['affected'])
+            incremental.save_state('sire', incremental.record_run(state, changes, failed_keys), state_dir)
+            failed = skipped + failed
 
             print(f"\n{'='*60}")
             print(f"✅ Processing complete!")
-            print(f"   Success: {success_count}/{len(sires)}")
-            print(f"   Failed:  {fail_count}/{len(sires)}")
+            print(f"   Success: {success_count}/{len(entities) + len(skipped)}")
+            print(f"   Failed:  {len(failed)}/{len(entities) + len(skipped)}")
+            for label in failed:
+                print(f"     - {label}")
             print(f"{'='*60}")
 
+        if args.offline or not args.no_cache or not args.no_query_log:
+            bq_client.report()
+        storage_client.close()
+        storage_client.report()
+
     except Exception as e:
         print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if storage_client is not None:
+            storage_client.close()
 
 
 if __name__ == "__main__":
@@ -5,20 +5,19 @@
 """
 
 from google.cloud import bigquery, storage
-import json
 import sys
 from datetime import datetime
 
+from query_params import run_query
+from uploads import GCSBackend, UploadService
+
 # 設定
 PROJECT_ID = 'umadata'
 BUCKET_NAME = 'umadata'
 DATASET = 'umadata.keiba_data'
 
-# グローバル変数として現在処理中の調教師情報を保持
-TRAINER_ID = None
-
 
-def get_trainer_basic_info(client):
+def get_trainer_basic_info(client, trainer_id):
     """調教師の基本情報を取得"""
     query = f"""
     SELECT
@@ -30,11 +29,11 @@ def get_trainer_basic_info(client):
     FROM
       `{DATASET}.trainer`
     WHERE
-      trainer_id = {TRAINER_ID}
+      trainer_id = @trainer_id
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'trainer_id': trainer_id})
         rows = list(results)
         if not rows:
             return None
@@ -44,7 +43,7 @@ def get_trainer_basic_info(client):
         raise
 
 
-def get_total_stats(client):
+def get_total_stats(client, trainer_id):
     """総合成績を取得（過去3年間）"""
     query = f"""
     SELECT
@@ -59,12 +58,12 @@ def get_total_stats(client):
       `{DATASET}.race_master` rm
       JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
     WHERE
-      CAST(rr.trainer_id AS STRING) = CAST({TRAINER_ID} AS STRING)
+      CAST(rr.trainer_id AS STRING) = CAST(@trainer_id AS STRING)
       AND rm.race_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 3 YEAR)
     """
 
     try:
-        results = client.query(query).result()
+        results = run_query(client, query, {'trainer_id': trainer_id})
         rows = list(results)
         if not rows:
             return None
@@ -76,9 +75,6 @@ def get_total_stats(client):
 
 def process_trainer(bq_client, storage_client, trainer_id, trainer_name):
     """1人の調教師のデータを処理してGCSにアップロード"""
-    global TRAINER_ID
-    TRAINER_ID = trainer_id
-
     print(f"\n{'='*60}")
     print(f"📊 Processing: {trainer_name} (ID: {trainer_id})")
     print(f"{'='*60}")
@@ -86,13 +82,13 @@ def process_trainer(bq_client, storage_client, trainer_id, trainer_name):
     try:
         # 基本情報を取得
         print("  [1/2] Fetching basic info...")
-        basic_info = get_trainer_basic_info(bq_client)
+        basic_info = get_trainer_basic_info(bq_client, trainer_id)
         if not basic_info:
             print(f"  ⚠️  Trainer not found: {trainer_id}")
             return False
 
         print("  [2/2] Fetching total stats...")
-        total_stats = get_total_stats(bq_client)
+        total_stats = get_total_stats(bq_client, trainer_id)
 
         # データ期間と更新日を設定
         today = datetime.now()
@@ -129,14 +125,11 @@ def process_trainer(bq_client, storage_client, trainer_id, trainer_name):
             'owner_stats': [],
         }
 
-        # GCSにアップロード
+        # GCSにアップロード（generate_trainers.py と同じく trainer/manifest.json のバージョンも更新する）
         bucket = storage_client.bucket(BUCKET_NAME)
         blob_path = f'trainer/{str(trainer_id).zfill(5)}.json'
         blob = bucket.blob(blob_path)
-        blob.upload_from_string(
-            json.dumps(trainer_data, ensure_ascii=False, indent=2),
-            content_type='application/json'
-        )
+        blob.upload_json(trainer_data)
 
         print(f"  ✅ {trainer_name} uploaded to {blob_path}")
         return True
@@ -156,10 +149,11 @@ def main():
     parser.add_argument('--trainer-id', type=int, required=True, help='Process a specific trainer by ID')
     args = parser.parse_args()
 
+    storage_client = None
     try:
         # BigQueryとGCS クライアント
         bq_client = bigquery.Client(project=PROJECT_ID)
-        storage_client = storage.Client(project=PROJECT_ID)
+        storage_client = UploadService(GCSBackend(storage.Client(project=PROJECT_ID)), manifest=True)
 
         print(f"🚀 Starting trainer data export (TEST MODE)")
         print(f"   Processing trainer ID: {args.trainer_id}")
@@ -172,11 +166,19 @@ def main():
             print(f"❌ Processing failed!")
         print(f"{'='*60}")
 
+        storage_client.close()
+        storage_client.report()
+        if storage_client.failed:
+            sys.exit(1)
+
     except Exception as e:
         print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        if storage_client is not None:
+            storage_client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+差分更新: 前回の実行以降に取り込まれたレースから、作り直しが必要なエンティティを求める
+
+開催日ごとに変わるのは、その日のレースに出走した騎手・調教師・種牡馬（horse.father）・コースだけなので、
+--incremental では前回の実行時点（ウォーターマーク）より後のレースに出てきたエンティティだけを処理する。
+
+状態ファイル（{state_dir}/{kind}.json）:
+- watermark: 取り込み済みの最終開催日と、その日のレース ID
+             （同じ日の結果が後から追加で取り込まれても取りこぼさないよう、日付と ID の両方で判定する）
+- entities:  エンティティごとの最終出走レース（last_race_id / last_race_date）
+- pending:   前回失敗したエンティティ。次回の差分更新でも対象に含める
+
+エンティティは各ジェネレーターの BATCH_ENTITY（{'key': SQL 式, 'joins': [...]}）で表し、
+キーは batch_stats と同じく文字列にそろえる。
+
+3年間の集計期間から古いレースが外れる分や、全体の順位（年間リーディング・荒れやすさなど）の変動は
+差分更新では反映されないので、定期的に --incremental なしの全件実行で作り直す。
+"""
+
+import json
+import os
+import sys
+from datetime import date
+
+from batch_stats import DATASET, JOINS, PERIOD_CONDITION
+from query_params import run_query
+
+# 状態ファイルの保存先
+DEFAULT_STATE_DIR = os.environ.get('INCREMENTAL_STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.incremental'))
+
+
+def load_state(kind, state_dir=DEFAULT_STATE_DIR):
+    """状態を読み込む（初回は空の状態）"""
+    path = os.path.join(state_dir, f"{kind}.json")
+    if not os.path.exists(path):
+        return {'watermark': None, 'entities': {}, 'pending': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(kind, state, state_dir=DEFAULT_STATE_DIR):
+    """状態を保存する（書き込み途中で止まっても前回の状態が残るよう一時ファイルから置き換える）"""
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, f"{kind}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _entity_from(entity):
+    """エンティティの JOIN 句"""
+    return '\n      '.join(JOINS[name] for name in entity.get('joins', []))
+
+
+def fetch_watermark(client):
+    """結果が取り込まれている最終開催日と、その日のレース ID"""
+    query = f"""
+    SELECT DISTINCT
+      rm.race_id,
+      rm.race_date
+    FROM
+      `{DATASET}.race_master` rm
+      JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+    WHERE
+      rm.race_date = (
+        SELECT MAX(rm2.race_date)
+        FROM `{DATASET}.race_master` rm2
+        JOIN `{DATASET}.race_result` rr2 ON rm2.race_id = rr2.race_id
+      )
+    """
+
+    try:
+        rows = list(client.query(query).result())
+        if not rows:
+            return None
+        return {
+            'race_date': rows[0]['race_date'].isoformat(),
+            'race_ids': sorted(row['race_id'] for row in rows),
+        }
+    except Exception as e:
+        print(f"   ⚠️  Error fetching watermark: {str(e)}", file=sys.stderr)
+        raise
+
+
+def fetch_latest_races(client, entity):
+    """全エンティティの最終出走レース（過去3年間）を {key: {...}} で返す"""
+    query = f"""
+    WITH entries AS (
+      SELECT DISTINCT
+        CAST({entity['key']} AS STRING) as entity_key,
+        rm.race_id,
+        rm.race_date
+      FROM
+        `{DATASET}.race_master` rm
+        JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+        {_entity_from(entity)}
+      WHERE
+        {PERIOD_CONDITION}
+        AND {entity['key']} IS NOT NULL
+    ),
+    latest AS (
+      SELECT
+        entity_key,
+        MAX(race_date) as race_date
+      FROM
+        entries
+      GROUP BY
+        entity_key
+    )
+    SELECT
+      e.entity_key,
+      e.race_date as last_race_date,
+      MAX(e.race_id) as last_race_id
+    FROM
+      entries e
+      JOIN latest l ON e.entity_key = l.entity_key AND e.race_date = l.race_date
+    GROUP BY
+      e.entity_key,
+      e.race_date
+    """
+
+    try:
+        results = client.query(query).result()
+        return {
+            row['entity_key']: {
+                'last_race_id': row['last_race_id'],
+                'last_race_date': row['last_race_date'].isoformat(),
+            }
+            for row in results
+        }
+    except Exception as e:
+        print(f"   ⚠️  Error fetching latest races: {str(e)}", file=sys.stderr)
+        raise
+
+
+def fetch_new_races(client, entity, watermark):
+    """ウォーターマークより後に取り込まれたレースの (エンティティ, レース) を返す"""
+    query = f"""
+    SELECT DISTINCT
+      CAST({entity['key']} AS STRING) as entity_key,
+      rm.race_id,
+      rm.race_date
+    FROM
+      `{DATASET}.race_master` rm
+      JOIN `{DATASET}.race_result` rr ON rm.race_id = rr.race_id
+      {_entity_from(entity)}
+    WHERE
+      rm.race_date >= @watermark_date
+      AND {entity['key']} IS NOT NULL
+    """
+
+    try:
+        results = run_query(client, query, {'watermark_date': date.fromisoformat(watermark['race_date'])})
+        seen = set(watermark['race_ids'])
+        return [
+            dict(row) for row in results
+            if not (row['race_date'].isoformat() == watermark['race_date'] and row['race_id'] in seen)
+        ]
+    except Exception as e:
+        print(f"   ⚠️  Error fetching new races: {str(e)}", file=sys.stderr)
+        raise
+
+
+def detect_changes(client, entity, state, full=False):
+    """作り直すエンティティと、実行後に保存するウォーターマークを求める
+
+    full=True（全件実行）または state['watermark'] がない（初回）場合は全エンティティを対象にする。
+    戻り値: {'full': 全件か, 'affected': {key: 最終出走レース}, 'watermark': 新しいウォーターマーク}
+    """
+    watermark = state.get('watermark')
+    if full or not watermark:
+        if not full:
+            print("   ⚠️  No watermark yet; regenerating all entities")
+        return {
+            'full': True,
+            'affected': fetch_latest_races(client, entity),
+            'watermark': fetch_watermark(client),
+        }
+
+    new_races = fetch_new_races(client, entity, watermark)
+
+    affected = {key: state['entities'].get(key) for key in state.get('pending', [])}
+    for row in new_races:
+        key = row['entity_key']
+        race = {'last_race_id': row['race_id'], 'last_race_date': row['race_date'].isoformat()}
+        current = affected.get(key)
+        if current is None or (race['last_race_date'], race['last_race_id']) > (current['last_race_date'], current['last_race_id']):
+            affected[key] = race
+
+    # 新しいウォーターマーク: 取り込まれた最終開催日とその日のレース（前回と同じ日なら前回分も含める）
+    new_watermark = dict(watermark)
+    if new_races:
+        last_date = max(row['race_date'].isoformat() for row in new_races)
+        race_ids = {row['race_id'] for row in new_races if row['race_date'].isoformat() == last_date}
+        if last_date == watermark['race_date']:
+            race_ids |= set(watermark['race_ids'])
+        new_watermark = {'race_date': last_date, 'race_ids': sorted(race_ids)}
+
+    print(f"   🔎 {len({row['race_id'] for row in new_races})} new races since {watermark['race_date']}, "
+          f"{len(affected)} entities to regenerate ({len(state.get('pending', []))} pending from last run)")
+    return {'full': False, 'affected': affected, 'watermark': new_watermark}
+
+
+def record_run(state, changes, failed_keys):
+    """実行結果を状態に反映する（失敗したエンティティは pending に残して次回も処理する）"""
+    failed_keys = set(failed_keys)
+    if changes['full']:
+        state['entities'] = {}
+    for key, race in changes['affected'].items():
+        if key not in failed_keys and race is not None:
+            state['entities'][key] = race
+    state['watermark'] = changes['watermark']
+    state['pending'] = sorted(failed_keys)
+    return state
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカルスナップショット（Parquet）に対して BigQuery のクエリを実行するクライアント
+
+export_snapshot.py で書き出した過去3年分の Parquet を DuckDB で読み、
+ジェネレーターの SQL を BigQuery 方言から DuckDB 方言に書き換えて実行する。
+BigQuery の料金・ネットワークなしで全 JSON を作り直せるので、手元での確認・ベンチマーク・CI に使う。
+
+client.query(sql, job_config=...).result() の呼び方は BigQuery と同じ。
+CURRENT_DATE() はスナップショットを書き出した日に置き換えるため、同じスナップショットなら毎回同じ結果になる。
+スナップショットには過去3年分のレースしか含まれないので、それより前を参照する集計
+（芝ダ変わりのデビュー戦判定など）は BigQuery と結果が変わることがある。
+"""
+
+import json
+import os
+import re
+import threading
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from query_cache import CachedRow, _CachedJob
+
+# スナップショットの保存先
+DEFAULT_SNAPSHOT_DIR = os.environ.get('BQ_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.snapshot'))
+
+# スナップショットの情報（書き出した日・テーブル一覧）
+SNAPSHOT_META_FILE = 'snapshot.json'
+
+# SQL 中のテーブル参照（`project.dataset.table`）
+TABLE_REF_PATTERN = re.compile(r'`[\w-]+\.[\w-]+\.([\w$-]+)`')
+
+# BigQuery にあって DuckDB にない関数
+DUCKDB_MACROS = [
+    "CREATE OR REPLACE MACRO SAFE_DIVIDE(a, b) AS CASE WHEN b = 0 THEN NULL ELSE a / b END",
+]
+
+
+def _find_calls(sql, name):
+    """sql 中の name(...) の呼び出し位置を後ろから返す: (開始, 閉じ括弧の次, [引数])"""
+    calls = []
+    for match in re.finditer(rf'\b{name}\s*\(', sql, re.IGNORECASE):
+        depth, args, arg_start, quote = 1, [], match.end(), None
+        i = match.end()
+        while i < len(sql) and depth:
+            ch = sql[i]
+            if quote:
+                if ch == quote:
+                    quote = None
+            elif ch in ("'", '"'):
+                quote = ch
+            elif ch == '(':
+                depth += 1
+            elif ch == ')':
+                depth -= 1
+            elif ch == ',' and depth == 1:
+                args.append(sql[arg_start:i].strip())
+                arg_start = i + 1
+            i += 1
+        args.append(sql[arg_start:i - 1].strip())
+        calls.append((match.start(), i, args))
+    return reversed(calls)
+
+
+def translate_sql(sql, current_date):
+    """ジェネレーターが使う範囲の BigQuery SQL を DuckDB で実行できる形に書き換える"""
+    sql = TABLE_REF_PATTERN.sub(r'\1', sql)
+    sql = re.sub(r'@(\w+)', r'$\1', sql)
+    sql = re.sub(r'\bCURRENT_DATE\(\)', f"DATE '{current_date}'", sql)
+    sql = re.sub(r'\bAS\s+FLOAT64\b', 'AS DOUBLE', sql)
+
+    # DATE_SUB(date, INTERVAL 3 YEAR) → (date - INTERVAL 3 YEAR)
+    for start, end, args in _find_calls(sql, 'DATE_SUB'):
+        sql = f"{sql[:start]}({args[0]} - {args[1]}){sql[end:]}"
+
+    # DATE_DIFF(end, start, DAY) → date_diff('day', start, end)
+    for start, end, args in _find_calls(sql, 'DATE_DIFF'):
+        sql = f"{sql[:start]}date_diff('{args[2].lower()}', {args[1]}, {args[0]}){sql[end:]}"
+
+    # APPROX_QUANTILES(x, 100)[OFFSET(50)] → quantile_disc(x, 50 / 100)
+    for start, end, args in _find_calls(sql, 'APPROX_QUANTILES'):
+        offset = re.match(r'\s*\[\s*OFFSET\s*\(\s*(\d+)\s*\)\s*\]', sql[end:], re.IGNORECASE)
+        if not offset:
+            raise ValueError(f"Unsupported APPROX_QUANTILES usage: {sql[start:end + 40]}")
+        sql = f"{sql[:start]}quantile_disc({args[0]}, {offset.group(1)} / {args[1]}){sql[end + offset.end():]}"
+
+    return sql
+
+
+class OfflineClient:
+    """スナップショットに対してクエリを実行する BigQuery クライアントの代わり"""
+
+    def __init__(self, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        if duckdb is None:
+            raise RuntimeError("duckdb is not installed; run `pip install duckdb` to use --offline")
+
+        meta_path = os.path.join(snapshot_dir, SNAPSHOT_META_FILE)
+        if not os.path.exists(meta_path):
+            raise RuntimeError(f"No snapshot found in {snapshot_dir}; run export_snapshot.py first")
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+
+        self.snapshot_dir = snapshot_dir
+        self.current_date = self.meta['snapshot_date']
+        self.queries = 0
+        self._lock = threading.Lock()
+
+        self._conn = duckdb.connect()
+        # BigQuery と同じく昇順では NULL を先頭、降順では末尾に並べる
+        self._conn.execute("SET GLOBAL default_null_order = 'nulls_first_on_asc_last_on_desc'")
+        for table_name in self.meta['tables']:
+            path = os.path.join(snapshot_dir, f"{table_name}.parquet").replace("'", "''")
+            self._conn.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{path}')")
+        for macro in DUCKDB_MACROS:
+            self._conn.execute(macro)
+
+    def query(self, query, job_config=None):
+        params = {
+            p.name: p.value
+            for p in (getattr(job_config, 'query_parameters', None) or [])
+        }
+        # DuckDB の接続はスレッド間で共有できないので、クエリごとにカーソルを作る
+        cursor = self._conn.cursor()
+        try:
+            cursor.execute(translate_sql(query, self.current_date), params or None)
+            columns = [column[0] for column in cursor.description]
+            rows = [CachedRow(zip(columns, values)) for values in cursor.fetchall()]
+        finally:
+            cursor.close()
+        with self._lock:
+            self.queries += 1
+        return _CachedJob(rows, source='offline')
+
+    def report(self):
+        """実行したクエリ数を表示する"""
+        print(f"🗂️  Offline snapshot: {self.queries} queries ({self.snapshot_dir}, snapshot date {self.current_date})")
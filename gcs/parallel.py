@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BigQuery クエリの並列実行ヘルパー
+
+各ジェネレーターの get_*_stats(client) は client.query(q).result() で結果を待ってから
+次のセクションに進むため、1エンティティの処理時間は全クエリの往復時間の合計になる。
+ここでは全セクションのジョブを先に投入し、終わった順に回収する。
+同時実行数の上限（max_in_flight）を超えるジョブは空きができるまで待機する。
+
+FULL MODE の複数エンティティ処理は run_entities でスレッドプールに分散する。
+get_*_stats はエンティティをクエリパラメータで受け取る（query_params）ため、
+1つのクライアントとコネクションプールを全スレッドで共有できる。
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from query_stats import query_section
+
+# 1エンティティあたりの同時実行クエリ数のデフォルト
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# FULL MODE で同時に処理するエンティティ数のデフォルト
+DEFAULT_WORKERS = 4
+
+# 失敗したエンティティを再実行する回数と、再実行前の待機秒数（回数に比例して延ばす）
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF_SECONDS = 10
+
+# プロジェクト全体で同時に走らせるクエリ数の上限（BigQuery の同時実行クォータに余裕を持たせた値）
+BQ_MAX_CONCURRENT_QUERIES = 100
+
+
+def _fetch_section(name, getter, client, args):
+    """セクションを1つ取得する（クエリログにセクション名とエンティティを付ける）"""
+    with query_section(name, args[0] if args else None):
+        return getter(client, *args)
+
+
+def fetch_sections(client, sections, prefetched=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT, args=()):
+    """セクションをまとめて取得する
+
+    sections:      [(name, getter)] のリスト。getter は getter(client, *args) で結果を返す関数
+    prefetched:    取得済みのセクション（{name: rows}）。含まれるものはクエリを発行しない
+    max_in_flight: 同時に実行するクエリ数の上限（1 なら従来どおり順番に実行）
+    args:          各 getter に client の後ろで渡す引数（処理中のエンティティなど）
+
+    戻り値は {name: result}。いずれかのセクションが失敗した場合は未着手のジョブを
+    キャンセルして例外をそのまま送出する。
+    """
+    prefetched = prefetched or {}
+    results = {name: prefetched[name] for name, _ in sections if name in prefetched}
+    pending = [(name, getter) for name, getter in sections if name not in prefetched]
+    total = len(sections)
+
+    if max_in_flight <= 1:
+        for name, getter in pending:
+            print(f"  [{len(results) + 1}/{total}] Fetching {name}...")
+            results[name] = _fetch_section(name, getter, client, args)
+        return results
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        futures = {executor.submit(_fetch_section, name, getter, client, args): name for name, getter in pending}
+        for future in as_completed(futures):
+            name = futures[future]
+            results[name] = future.result()
+            print(f"  [{len(results)}/{total}] Fetched {name}")
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return results
+
+
+def cap_in_flight(workers, max_in_flight, limit=BQ_MAX_CONCURRENT_QUERIES):
+    """workers × max_in_flight が BigQuery の同時実行上限を超えないよう max_in_flight を絞る"""
+    capped = max(1, min(max_in_flight, limit // max(workers, 1)))
+    if capped < max_in_flight:
+        print(f"   ⚠️  {workers} workers × {max_in_flight} in flight exceeds {limit} concurrent queries; "
+              f"using max in flight {capped}")
+    return capped
+
+
+def format_duration(seconds):
+    """秒数を H:MM:SS / M:SS 表記にする"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
+
+
+def _run_round(entities, worker, workers, on_done):
+    """1回分の実行。失敗したエンティティを返す"""
+    failed = []
+
+    if workers <= 1:
+        for label, args in entities:
+            try:
+                ok = worker(*args)
+            except Exception as e:
+                print(f"  ❌ Error: {label}: {str(e)}", file=sys.stderr)
+                ok = False
+            if not ok:
+                failed.append((label, args))
+            on_done(label, ok)
+        return failed
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(worker, *args): (label, args) for label, args in entities}
+        for future in as_completed(futures):
+            label, args = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"  ❌ Error: {label}: {str(e)}", file=sys.stderr)
+                ok = False
+            if not ok:
+                failed.append((label, args))
+            on_done(label, ok)
+    return failed
+
+
+def run_entities(entities, worker, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES):
+    """複数エンティティを workers 個のスレッドで並列に処理する
+
+    entities: [(label, args)] のリスト。label は進捗表示用、args は worker に渡す引数
+    worker:   worker(*args) で1エンティティを処理し成否を返す関数
+    workers:  同時に処理するエンティティ数（1 なら順番に処理）
+    retries:  失敗したエンティティを再実行する回数
+
+    戻り値は (成功数, 最終的に失敗した label のリスト)。
+    """
+    total = len(entities)
+    started = time.monotonic()
+    state = {'done': 0, 'success': 0}
+
+    def on_done(label, ok):
+        state['done'] += 1
+        if ok:
+            state['success'] += 1
+        elapsed = time.monotonic() - started
+        remaining = elapsed / state['done'] * (total - state['done'])
+        mark = '✅' if ok else '❌'
+        print(f"[{state['done']}/{total}] {mark} {label} "
+              f"(elapsed {format_duration(elapsed)}, ETA {format_duration(remaining)})")
+
+    pending = _run_round(entities, worker, workers, on_done)
+
+    for attempt in range(1, retries + 1):
+        if not pending:
+            break
+        wait = RETRY_BACKOFF_SECONDS * attempt
+        print(f"\n🔁 Retrying {len(pending)} failed (attempt {attempt}/{retries}) in {wait}s...")
+        time.sleep(wait)
+
+        # 再実行分は進捗の母数に含めず、成功した分だけ数え直す
+        state['done'] -= len(pending)
+        pending = _run_round(pending, worker, workers, on_done)
+
+    return state['success'], [label for label, _ in pending]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公開する JSON の形式（レイアウトと圧縮）
+
+lib/get*DataFromGCS.ts はページを描画するたびにこれらの JSON を取得するため、サイズがそのまま転送時間になる。
+
+レイアウト:
+- pretty:   indent=2（これまでの形式。既定）
+- compact:  区切りの空白なし
+- columnar: compact に加えて、同じキーのオブジェクトが並ぶ配列を列ごとの配列にまとめる
+            [{"gate": 1, "races": 10}, {"gate": 2, "races": 12}]
+            → {"$cols": {"gate": [1, 2], "races": [10, 12]}}
+            読み込み側は lib/expandColumnar.ts で元の形に戻す
+
+圧縮（Content-Encoding を付けて保存する）:
+- gzip: GCS は Accept-Encoding に gzip がないクライアントには展開して返す
+- br:   brotli パッケージが必要。GCS は展開して返さないので、br に対応したクライアント（Node の fetch など）専用
+
+形式ごとのサイズと取得時間の比較は compare_publish_formats.py で確認する。
+"""
+
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_LAYOUTS = ('pretty', 'compact', 'columnar')
+COMPRESSIONS = ('none', 'gzip', 'br')
+
+# 列形式にまとめた配列のキー
+COLUMNAR_KEY = '$cols'
+
+# これより短い配列は列形式にしない（キー名を省く効果がない）
+COLUMNAR_MIN_ROWS = 2
+
+
+def to_columnar(value):
+    """同じキー（同じ順序）のオブジェクトが並ぶ配列を {"$cols": {キー: [値, ...]}} にまとめる"""
+    if isinstance(value, dict):
+        return {key: to_columnar(item) for key, item in value.items()}
+    if isinstance(value, list):
+        items = [to_columnar(item) for item in value]
+        if len(items) >= COLUMNAR_MIN_ROWS and all(isinstance(item, dict) for item in items):
+            keys = list(items[0])
+            if keys and all(list(item) == keys for item in items[1:]):
+                return {COLUMNAR_KEY: {key: [item[key] for item in items] for key in keys}}
+        return items
+    return value
+
+
+def from_columnar(value):
+    """to_columnar の逆変換"""
+    if isinstance(value, dict):
+        if list(value) == [COLUMNAR_KEY]:
+            columns = value[COLUMNAR_KEY]
+            rows = len(next(iter(columns.values()), []))
+            return [
+                {key: from_columnar(values[i]) for key, values in columns.items()}
+                for i in range(rows)
+            ]
+        return {key: from_columnar(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_columnar(item) for item in value]
+    return value
+
+
+def decode(data, content_encoding=None):
+    """保存した内容を JSON 文字列に戻す（列形式はそのまま）"""
+    if content_encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif content_encoding == 'br':
+        if brotli is None:
+            raise RuntimeError("brotli is not installed; run `pip install brotli` to read br-encoded JSON")
+        data = brotli.decompress(data)
+    return data.decode('utf-8')
+
+
+class PublishFormat:
+    """JSON のレイアウトと圧縮の組み合わせ"""
+
+    def __init__(self, layout='pretty', compression='none'):
+        if layout not in JSON_LAYOUTS:
+            raise ValueError(f"Unknown JSON layout: {layout} (expected one of {', '.join(JSON_LAYOUTS)})")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression} (expected one of {', '.join(COMPRESSIONS)})")
+        if compression == 'br' and brotli is None:
+            raise RuntimeError("brotli is not installed; run `pip install brotli` to publish br-encoded JSON")
+        self.layout = layout
+        self.compression = compression
+
+    @property
+    def label(self):
+        """形式の名前（pretty / compact+gzip など）。オブジェクトのメタデータにも保存する"""
+        return self.layout if self.compression == 'none' else f"{self.layout}+{self.compression}"
+
+    @property
+    def content_encoding(self):
+        return None if self.compression == 'none' else self.compression
+
+    def dumps(self, document):
+        """ドキュメントを JSON 文字列にする"""
+        if self.layout == 'pretty':
+            return json.dumps(document, ensure_ascii=False, indent=2)
+        if self.layout == 'columnar':
+            document = to_columnar(document)
+        return json.dumps(document, ensure_ascii=False, separators=(',', ':'))
+
+    def encode(self, data):
+        """JSON のバイト列を保存する内容に圧縮する（同じ入力なら毎回同じバイト列になる）"""
+        if self.compression == 'gzip':
+            return gzip.compress(data, compresslevel=9, mtime=0)
+        if self.compression == 'br':
+            return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+        return data
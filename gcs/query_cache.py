@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BigQuery クエリ結果のディスクキャッシュ
+
+--test / --jockey-id やデバッグスクリプトを繰り返し実行すると、同じクエリで毎回フルスキャンの
+料金と待ち時間がかかる。ここでは結果を Parquet でローカルに保存し、次回以降はディスクから返す。
+
+キャッシュキー:
+- 空白を正規化した SQL
+- クエリパラメータ（@jockey_id など）
+- SQL が参照するテーブルの最終更新時刻（last_modified）
+- CURRENT_DATE() を使うクエリは実行日
+
+テーブルが更新されればキーが変わるので古い結果は使われない。
+合計サイズが上限を超えたら、最近使われていないファイルから削除する（LRU）。
+pyarrow がない環境ではキャッシュせずにそのまま BigQuery に問い合わせる。
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from datetime import date
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# キャッシュの保存先と合計サイズの上限
+DEFAULT_CACHE_DIR = os.environ.get('BQ_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.bq_cache'))
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# SQL 中のテーブル参照（`project.dataset.table`）
+TABLE_REF_PATTERN = re.compile(r'`([\w-]+\.[\w-]+\.[\w$-]+)`')
+
+
+class CachedRow(dict):
+    """キャッシュから返す行（row['name'] と row.name の両方で参照できる）"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class _CachedJob:
+    """client.query() の戻り値の代わり（result() で行のイテレーターを返す）
+
+    source: 結果の取得元（disk_cache / bigquery / offline）
+    job:    BigQuery に問い合わせた場合は元のジョブ（クエリログでジョブ統計を読む）
+    """
+
+    def __init__(self, rows, source='disk_cache', job=None):
+        self._rows = rows
+        self.source = source
+        self.job = job
+
+    def result(self):
+        # BigQuery の RowIterator と同じく next(results) でも for でも読めるようにする
+        return iter(self._rows)
+
+
+def normalize_sql(query):
+    """空白の違いでキーが変わらないよう SQL を正規化する"""
+    return ' '.join(query.split())
+
+
+class CachedClient:
+    """ディスクキャッシュ付きの BigQuery クライアント
+
+    client.query(sql, job_config=...).result() の呼び方はそのままで、
+    それ以外の属性は元のクライアントに委譲する。
+    """
+
+    def __init__(self, client, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._table_versions = {}
+        self._lock = threading.Lock()
+        self.enabled = pq is not None
+        if not self.enabled:
+            print("   ⚠️  pyarrow is not installed; query cache disabled", file=sys.stderr)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _table_version(self, table_ref):
+        """テーブルの最終更新時刻（1回の実行中はメモしておく）"""
+        with self._lock:
+            if table_ref in self._table_versions:
+                return self._table_versions[table_ref]
+        modified = self.client.get_table(table_ref).modified
+        version = modified.isoformat() if modified else None
+        with self._lock:
+            self._table_versions[table_ref] = version
+        return version
+
+    def cache_key(self, query, job_config=None):
+        """SQL・パラメータ・参照テーブルの更新時刻からキーを作る"""
+        sql = normalize_sql(query)
+        params = [
+            (p.name, p.type_, p.value)
+            for p in (getattr(job_config, 'query_parameters', None) or [])
+        ]
+        tables = {ref: self._table_version(ref) for ref in sorted(set(TABLE_REF_PATTERN.findall(sql)))}
+        key = {
+            'sql': sql,
+            'params': params,
+            'tables': tables,
+            'date': date.today().isoformat() if 'CURRENT_DATE' in sql.upper() else None,
+        }
+        return hashlib.sha256(json.dumps(key, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def query(self, query, job_config=None):
+        if not self.enabled or not TABLE_REF_PATTERN.search(query):
+            return self.client.query(query, job_config=job_config)
+
+        path = os.path.join(self.cache_dir, f"{self.cache_key(query, job_config)}.parquet")
+        if os.path.exists(path):
+            try:
+                rows = [CachedRow(row) for row in pq.read_table(path).to_pylist()]
+                os.utime(path)  # LRU 用に最終利用時刻を更新
+                with self._lock:
+                    self.hits += 1
+                return _CachedJob(rows)
+            except Exception as e:
+                print(f"   ⚠️  Ignoring unreadable cache file {path}: {str(e)}", file=sys.stderr)
+
+        job = self.client.query(query, job_config=job_config)
+        table = job.result().to_arrow()
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.misses += 1
+        self.evict()
+        return _CachedJob([CachedRow(row) for row in table.to_pylist()], source='bigquery', job=job)
+
+    def evict(self):
+        """合計サイズが上限を超えていたら、最近使われていないファイルから削除する"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.parquet'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def report(self):
+        """キャッシュのヒット数を表示する"""
+        if self.enabled:
+            print(f"💾 Query cache: {self.hits} hits, {self.misses} misses ({self.cache_dir})")
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BigQuery のパラメータ付きクエリ
+
+SQL に処理中エンティティの値を f-string で埋め込まず @jockey_id / @father のように参照し、
+値は QueryJobConfig の query_parameters で渡す。
+- SQL 文字列がエンティティによらず同じになり、BigQuery 側のキャッシュ・プランを共有できる
+- 種牡馬名などに ' が含まれてもエスケープが不要
+- モジュールのグローバル変数を使わないので、1プロセス内のスレッドから安全に呼べる
+"""
+
+from datetime import date
+
+from google.cloud import bigquery
+
+
+def scalar_param(name, value):
+    """値の型から BigQuery のスカラーパラメータを作る"""
+    if isinstance(value, bool):
+        type_ = 'BOOL'
+    elif isinstance(value, int):
+        type_ = 'INT64'
+    elif isinstance(value, float):
+        type_ = 'FLOAT64'
+    elif isinstance(value, date):
+        type_ = 'DATE'
+    else:
+        type_ = 'STRING'
+    return bigquery.ScalarQueryParameter(name, type_, value)
+
+
+def query_config(params=None, **config):
+    """params（{name: value}）をクエリパラメータに持つ QueryJobConfig を作る
+
+    config は QueryJobConfig にそのまま渡す（use_query_cache=False など）。
+    """
+    query_parameters = [scalar_param(name, value) for name, value in (params or {}).items()]
+    return bigquery.QueryJobConfig(query_parameters=query_parameters, **config)
+
+
+def run_query(client, query, params=None, **config):
+    """パラメータ付きでクエリを実行して結果を返す"""
+    return client.query(query, job_config=query_config(params, **config)).result()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+クエリごとの計測
+
+InstrumentedClient は client.query(...).result() の1回ごとに
+- セクション名とエンティティ（fetch_sections / batch_stats が query_section() で設定する。
+  設定されていないクエリは呼び出し元の関数名）
+- 実行時間（query() から result() が返るまで）
+- total_bytes_processed / total_bytes_billed / slot_millis / cache_hit（BigQuery のジョブ統計）
+- source（bigquery / disk_cache / offline）
+を JSONL（1行1クエリ）に書き出す。どのセクションにコストがかかっているかを実測で確かめるために使う。
+
+client.query(sql, job_config=...).result() の呼び方はそのままで、それ以外の属性は元のクライアントに委譲する。
+
+集計（セクションごとの件数・合計バイト数・時間の p50 / p95 と上位セクション）:
+    python3 query_stats.py                       # 最新のログ
+    python3 query_stats.py .query_log/jockeys-20250101-120000.jsonl --top 20
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# ログの保存先
+DEFAULT_LOG_DIR = os.environ.get('QUERY_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.query_log'))
+
+# 呼び出し元の関数名を探すときに飛ばすモジュール（クライアントのラッパー・ヘルパー）
+WRAPPER_MODULES = ('query_stats', 'query_params', 'query_cache', 'offline_client', 'parallel', 'cost_estimate')
+
+# 集計で表示する上位セクション数
+DEFAULT_TOP = 10
+
+_context = threading.local()
+
+
+@contextmanager
+def query_section(section, entity=None):
+    """このスレッドで実行するクエリにセクション名とエンティティを付ける"""
+    previous = getattr(_context, 'value', None)
+    _context.value = (section, entity)
+    try:
+        yield
+    finally:
+        _context.value = previous
+
+
+def _entity_label(entity):
+    """ログに書くエンティティ（コースのような dict は値を | でつなぐ）"""
+    if isinstance(entity, dict):
+        return '|'.join('' if value is None else str(value) for value in entity.values())
+    return entity
+
+
+def _caller_name():
+    """クライアントのラッパーを除いた呼び出し元の関数名"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+        if module not in WRAPPER_MODULES:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return None
+
+
+def current_section():
+    """このスレッドで実行中のクエリの (セクション名, エンティティ)"""
+    return getattr(_context, 'value', None) or (_caller_name(), None)
+
+
+class _InstrumentedJob:
+    """client.query() の戻り値の代わり（result() が返るまでを計測して記録する）"""
+
+    def __init__(self, client, job, section, entity, started):
+        self._client = client
+        self._job = job
+        self._section = section
+        self._entity = entity
+        self._started = started
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def result(self, *args, **kwargs):
+        error = None
+        try:
+            return self._job.result(*args, **kwargs)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self._client.record(self._job, self._section, self._entity, time.monotonic() - self._started, error)
+
+
+class InstrumentedClient:
+    """クエリごとの計測を JSONL に書き出すクライアント"""
+
+    def __init__(self, client, kind, log_dir=DEFAULT_LOG_DIR):
+        self.client = client
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_path = os.path.join(log_dir, f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl")
+        self.records = []
+        self._lock = threading.Lock()
+        self._file = open(self.log_path, 'a', encoding='utf-8')
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def query(self, query, job_config=None):
+        section, entity = current_section()
+        started = time.monotonic()
+        job = self.client.query(query, job_config=job_config)
+        return _InstrumentedJob(self, job, section, entity, started)
+
+    def record(self, job, section, entity, seconds, error=None):
+        # ディスクキャッシュが BigQuery に問い合わせた場合は、元のジョブの統計を使う
+        stats_job = getattr(job, 'job', None) or job
+        source = getattr(job, 'source', 'bigquery')
+        record = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'section': section,
+            'entity': _entity_label(entity),
+            'seconds': round(seconds, 3),
+            'source': source,
+            'total_bytes_processed': getattr(stats_job, 'total_bytes_processed', None),
+            'total_bytes_billed': getattr(stats_job, 'total_bytes_billed', None),
+            'slot_millis': getattr(stats_job, 'slot_millis', None),
+            'cache_hit': True if source == 'disk_cache' else getattr(stats_job, 'cache_hit', None),
+            'job_id': getattr(stats_job, 'job_id', None),
+            'error': error,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self.records.append(record)
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def report(self, top=5):
+        """実行全体の合計と、処理バイト数の多いセクションを表示する（元のクライアントの report() も呼ぶ）"""
+        inner_report = getattr(self.client, 'report', None)
+        if callable(inner_report):
+            inner_report()
+        with self._lock:
+            records = list(self.records)
+            self._file.close()
+        print(f"📈 Query log: {len(records)} queries, "
+              f"{sum(r['total_bytes_processed'] or 0 for r in records) / 1024 ** 3:,.2f} GB processed, "
+              f"{sum(r['total_bytes_billed'] or 0 for r in records) / 1024 ** 3:,.2f} GB billed "
+              f"({self.log_path})")
+        for row in summarize(records)[:top]:
+            print(f"   {row['section']}: {row['queries']} queries, {row['bytes_processed'] / 1024 ** 3:,.2f} GB, "
+                  f"p50 {row['p50_seconds']:.2f}s, p95 {row['p95_seconds']:.2f}s")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(records, order_by='bytes_processed'):
+    """セクションごとに集計する（order_by の降順）"""
+    sections = {}
+    for record in records:
+        sections.setdefault(record['section'] or '(unknown)', []).append(record)
+
+    rows = []
+    for section, items in sections.items():
+        seconds = [item['seconds'] for item in items]
+        rows.append({
+            'section': section,
+            'queries': len(items),
+            'entities': len({item['entity'] for item in items if item['entity'] is not None}),
+            'bytes_processed': sum(item['total_bytes_processed'] or 0 for item in items),
+            'bytes_billed': sum(item['total_bytes_billed'] or 0 for item in items),
+            'slot_millis': sum(item['slot_millis'] or 0 for item in items),
+            'cache_hits': sum(1 for item in items if item['cache_hit']),
+            'errors': sum(1 for item in items if item['error']),
+            'total_seconds': sum(seconds),
+            'p50_seconds': percentile(seconds, 50),
+            'p95_seconds': percentile(seconds, 95),
+        })
+    return sorted(rows, key=lambda row: row[order_by], reverse=True)
+
+
+def load_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"{'section':<36}{'queries':>8}{'GB proc':>9}{'GB billed':>10}{'slot s':>9}"
+          f"{'cache':>7}{'total s':>9}{'p50 s':>8}{'p95 s':>8}")
+    for row in rows:
+        print(f"{row['section'][:35]:<36}{row['queries']:>8}{row['bytes_processed'] / 1024 ** 3:>9.2f}"
+              f"{row['bytes_billed'] / 1024 ** 3:>10.2f}{row['slot_millis'] / 1000:>9.1f}"
+              f"{row['cache_hits'] / row['queries']:>7.0%}{row['total_seconds']:>9.1f}"
+              f"{row['p50_seconds']:>8.2f}{row['p95_seconds']:>8.2f}")
+
+
+def main():
+    """メイン処理"""
+    parser = argparse.ArgumentParser(description='Summarise a per-query JSONL log written by a generator run')
+    parser.add_argument('log', nargs='?', help=f'JSONL log to summarise (default: the newest file in {DEFAULT_LOG_DIR})')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help=f'Number of sections to list (default: {DEFAULT_TOP})')
+    args = parser.parse_args()
+
+    try:
+        path = args.log
+        if not path:
+            logs = sorted(glob.glob(os.path.join(DEFAULT_LOG_DIR, '*.jsonl')), key=os.path.getmtime)
+            if not logs:
+                raise RuntimeError(f"No query logs found in {DEFAULT_LOG_DIR}")
+            path = logs[-1]
+
+        records = load_records(path)
+        seconds = sum(record['seconds'] for record in records)
+        print(f"📊 {path}: {len(records)} queries, "
+              f"{sum(r['total_bytes_processed'] or 0 for r in records) / 1024 ** 3:,.2f} GB processed, "
+              f"{sum(r['total_bytes_billed'] or 0 for r in records) / 1024 ** 3:,.2f} GB billed, "
+              f"{sum(r['slot_millis'] or 0 for r in records) / 1000:,.1f} slot-seconds, {seconds:,.1f} query-seconds")
+
+        print_table(f"Top {args.top} sections by bytes processed", summarize(records, 'bytes_processed')[:args.top])
+        print_table(f"Top {args.top} sections by total query time", summarize(records, 'total_seconds')[:args.top])
+
+    except Exception as e:
+        print(f"❌ Fatal error: {str(e)}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
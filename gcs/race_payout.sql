@@ -0,0 +1,64 @@
+-- 払戻金を1行1組み合わせに分解した派生テーブル
+-- race_master の win / place / umaren / umatan / wide / sanrenpuku / sanrentan は
+-- {"1-5-3": 12340} のような文字列で保存されているため、集計のたびに REGEXP で数値を取り出していた。
+-- ここで1回だけ分解して型付きの列にしておき、各クエリは数値列を集計するだけにする。
+--
+-- 列:
+-- - bet_type:     win / place / umaren / umatan / wide / sanrenpuku / sanrentan
+-- - payout_index: 同じ券種内での並び順（0 が先頭。複勝・ワイド・同着で複数行になる）
+-- - combination:  馬番の配列（'1-5-3' → [1, 5, 3]）
+-- - amount:       100円あたりの払戻金
+-- - popularity:   人気（値が [払戻金, 人気] の形で保存されている場合のみ。それ以外は NULL）
+
+CREATE OR REPLACE TABLE `umadata.keiba_data.race_payout`
+PARTITION BY DATE_TRUNC(race_date, MONTH)
+CLUSTER BY bet_type, race_id
+AS
+WITH payout_strings AS (
+  SELECT
+    rm.race_id,
+    rm.race_date,
+    p.bet_type,
+    p.payout
+  FROM
+    `umadata.keiba_data.race_master` rm,
+    UNNEST([
+      STRUCT('win' as bet_type, rm.win as payout),
+      ('place', rm.place),
+      ('umaren', rm.umaren),
+      ('umatan', rm.umatan),
+      ('wide', rm.wide),
+      ('sanrenpuku', rm.sanrenpuku),
+      ('sanrentan', rm.sanrentan)
+    ]) p
+  WHERE
+    p.payout IS NOT NULL
+),
+payout_entries AS (
+  SELECT
+    race_id,
+    race_date,
+    bet_type,
+    payout_index,
+    entry,
+    -- ':' より後ろ（払戻金、または [払戻金, 人気]）
+    REGEXP_EXTRACT_ALL(REGEXP_EXTRACT(entry, r':\s*(.*)$'), r'\d+') as value_numbers
+  FROM
+    payout_strings,
+    -- '"1-5-3": 12340' / '"1-5-3": [12340, 25]' を1件ずつ取り出す
+    UNNEST(REGEXP_EXTRACT_ALL(payout, r'[^,{}\[\]:]+:\s*(?:\[\s*\d+\s*,\s*\d+\s*\]|\d+)')) entry WITH OFFSET payout_index
+)
+SELECT
+  race_id,
+  race_date,
+  bet_type,
+  payout_index,
+  ARRAY(
+    SELECT CAST(number AS INT64)
+    FROM UNNEST(REGEXP_EXTRACT_ALL(REGEXP_EXTRACT(entry, r'^([^:]*)'), r'\d+')) number WITH OFFSET position
+    ORDER BY position
+  ) as combination,
+  CAST(value_numbers[SAFE_OFFSET(0)] AS INT64) as amount,
+  SAFE_CAST(value_numbers[SAFE_OFFSET(1)] AS INT64) as popularity
+FROM
+  payout_entries;
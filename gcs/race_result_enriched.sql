@@ -0,0 +1,95 @@
+-- 出走結果に脚質を付与した派生テーブル
+-- corner_positions（'3-3-2-1' のような文字列）の分解、上がり順位、脚質分類を1回だけ計算しておき、
+-- 各ジェネレーターの脚質別成績クエリはこのテーブルを集計するだけにする
+--
+-- 脚質の定義:
+-- - 逃げ(escape):   1〜3番目のコーナーのいずれかを1位で通過
+-- - 先行(lead):     最終コーナーが第1集団（1位〜出走頭数/3）
+-- - 差し(pursue):   最終コーナーが第2集団（出走頭数/3+1〜2*出走頭数/3）かつ上がりが上位
+-- - 追込(close):    最終コーナーが第3集団（2*出走頭数/3+1〜）かつ上がりが上位
+-- 上がりの条件は騎手・調教師・種牡馬ページが3位以内（running_style）、
+-- コースページが5位以内（running_style_top5）
+--
+-- 上がり順位はタイムのある馬の中で数える（取消・競走中止などでタイムがない馬は NULL で、上位に入らない）。
+-- BigQuery の ASC は NULL を先に並べるので、そのまま RANK() するとタイムのない馬が1位から順に埋めてしまう。
+-- 騎手・調教師・種牡馬ページはレースの全出走馬の中の順位（last_3f_rank）、
+-- コースページはこれまでどおり通過順のある馬の中の順位（running_style_top5 の判定だけに使う）
+
+CREATE OR REPLACE TABLE `umadata.keiba_data.race_result_enriched`
+PARTITION BY DATE_TRUNC(race_date, MONTH)  -- 日単位だとパーティション数の上限（4000）を超えるため月単位
+CLUSTER BY venue_name, surface, distance
+AS
+WITH base AS (
+  SELECT
+    rm.race_id,
+    rm.race_date,
+    rm.venue_name,
+    rm.surface,
+    rm.distance,
+    rm.track_variant,
+    rm.entry_count,
+    rr.horse_id,
+    rr.jockey_id,
+    rr.trainer_id,
+    rr.finish_position,
+    rr.popularity,
+    rr.win,
+    rr.place,
+    rr.last_3f_time,
+    -- 各コーナーの通過順位（数値に変換できないものは除く）
+    ARRAY(
+      SELECT SAFE_CAST(position AS INT64)
+      FROM UNNEST(SPLIT(rr.corner_positions, '-')) position WITH OFFSET corner
+      WHERE SAFE_CAST(position AS INT64) IS NOT NULL
+      ORDER BY corner
+    ) as corner_positions,
+    -- 各レース内での上がり（ラスト3ハロン）順位（タイムが短い順。タイムのない馬は NULL）
+    IF(rr.last_3f_time IS NULL, NULL,
+       RANK() OVER (PARTITION BY rm.race_id, rr.last_3f_time IS NULL ORDER BY rr.last_3f_time ASC)) as last_3f_rank,
+    -- コースページ用: 通過順のある馬の中での上がり順位
+    IF(rr.last_3f_time IS NULL OR rr.corner_positions IS NULL, NULL,
+       RANK() OVER (PARTITION BY rm.race_id, rr.last_3f_time IS NULL OR rr.corner_positions IS NULL
+                    ORDER BY rr.last_3f_time ASC)) as last_3f_rank_with_corners
+  FROM
+    `umadata.keiba_data.race_master` rm
+    JOIN `umadata.keiba_data.race_result` rr ON rm.race_id = rr.race_id
+),
+corner_parsed AS (
+  SELECT
+    *,
+    ARRAY_LENGTH(corner_positions) as corner_count,
+    corner_positions[SAFE_OFFSET(0)] as corner_1,
+    corner_positions[SAFE_OFFSET(1)] as corner_2,
+    corner_positions[SAFE_OFFSET(2)] as corner_3,
+    corner_positions[SAFE_OFFSET(ARRAY_LENGTH(corner_positions) - 1)] as final_corner,
+    CAST(CEIL(entry_count / 3.0) AS INT64) as first_group_limit,
+    CAST(CEIL(2 * entry_count / 3.0) AS INT64) as second_group_limit
+  FROM
+    base
+)
+SELECT
+  * EXCEPT (first_group_limit, second_group_limit, last_3f_rank_with_corners),
+  CASE
+    WHEN corner_count = 0 THEN NULL
+    WHEN COALESCE(corner_1, 0) = 1 OR COALESCE(corner_2, 0) = 1 OR COALESCE(corner_3, 0) = 1
+      THEN 'escape'
+    WHEN COALESCE(final_corner, 999) <= first_group_limit
+      THEN 'lead'
+    WHEN COALESCE(final_corner, 999) <= second_group_limit AND last_3f_rank <= 3
+      THEN 'pursue'
+    WHEN COALESCE(final_corner, 999) > second_group_limit AND last_3f_rank <= 3
+      THEN 'close'
+  END as running_style,
+  CASE
+    WHEN corner_count = 0 THEN NULL
+    WHEN COALESCE(corner_1, 0) = 1 OR COALESCE(corner_2, 0) = 1 OR COALESCE(corner_3, 0) = 1
+      THEN 'escape'
+    WHEN COALESCE(final_corner, 999) <= first_group_limit
+      THEN 'lead'
+    WHEN COALESCE(final_corner, 999) <= second_group_limit AND last_3f_rank_with_corners <= 5
+      THEN 'pursue'
+    WHEN COALESCE(final_corner, 999) > second_group_limit AND last_3f_rank_with_corners <= 5
+      THEN 'close'
+  END as running_style_top5
+FROM
+  corner_parsed;
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+公開する JSON の数値項目の型をそろえる
+
+BigQuery の ROUND / NUMERIC の結果は Decimal や文字列で返ることがあり、
+lib/get*DataFromGCS.ts が描画のたびに typeof x === 'string' ? parseFloat(x) : x で直していた。
+生成時にここで1回だけ型をそろえ、宣言した型に合わない値があればエラーにする。
+
+- INT_FIELDS:   整数（件数・順位・年・馬番など）。小数部のある値はエラー
+- FLOAT_FIELDS: 小数（率・回収率・平均）。NaN / Infinity は JSON にできないので null
+- どちらも null は null のまま
+- 宣言していない項目に Decimal や日付など JSON の型でない値が残っていてもエラー
+
+項目名はジェネレーター間で共通なので、ドキュメントのどの階層でも項目名で型を決める。
+"""
+
+import math
+from decimal import Decimal
+
+INT_FIELDS = frozenset([
+    'races', 'wins', 'places_2', 'places_3', 'total_races',
+    'median_popularity', 'median_rank',
+    'gate', 'gate_position', 'distance', 'year', 'debut_year', 'birth_year',
+    'rank', 'ranking', 'fav1_races', 'fav1_ranking', 'volatility',
+    'total_horses', 'total_jockeys', 'total_trainers', 'jockey_id', 'trainer_id',
+    'running_style_trend_position', 'distance_trend_position', 'surface_trend_position',
+])
+
+FLOAT_FIELDS = frozenset([
+    'win_rate', 'quinella_rate', 'place_rate', 'win_payback', 'place_payback',
+    'avg_popularity', 'avg_rank', 'fav1_place_rate', 'all_fav1_place_rate',
+])
+
+# JSON にそのまま書ける値の型
+JSON_SCALARS = (str, int, float, bool, type(None))
+
+
+class SchemaError(ValueError):
+    """宣言した型に合わない値"""
+
+
+def _to_number(value, path):
+    if isinstance(value, bool):
+        raise SchemaError(f"{path}: expected a number, got {value!r}")
+    if isinstance(value, (int, float, Decimal)):
+        return value
+    if isinstance(value, str):
+        try:
+            return Decimal(value.strip())
+        except ArithmeticError:
+            pass
+    raise SchemaError(f"{path}: expected a number, got {value!r}")
+
+
+def coerce_int(value, path):
+    if value is None:
+        return None
+    number = _to_number(value, path)
+    if isinstance(number, int):
+        return number
+    if not math.isfinite(number) or number != int(number):
+        raise SchemaError(f"{path}: expected an integer, got {value!r}")
+    return int(number)
+
+
+def coerce_float(value, path):
+    if value is None:
+        return None
+    number = float(_to_number(value, path))
+    return number if math.isfinite(number) else None
+
+
+def coerce(document, path='$'):
+    """ドキュメントの数値項目を宣言した型にそろえた新しいドキュメントを返す（合わなければ SchemaError）"""
+    if isinstance(document, dict):
+        result = {}
+        for key, value in document.items():
+            field_path = f"{path}.{key}"
+            if key in INT_FIELDS and not isinstance(value, (dict, list)):
+                result[key] = coerce_int(value, field_path)
+            elif key in FLOAT_FIELDS and not isinstance(value, (dict, list)):
+                result[key] = coerce_float(value, field_path)
+            else:
+                result[key] = coerce(value, field_path)
+        return result
+    if isinstance(document, list):
+        return [coerce(item, f"{path}[{i}]") for i, item in enumerate(document)]
+    if isinstance(document, float) and not math.isfinite(document):
+        return None
+    if not isinstance(document, JSON_SCALARS):
+        raise SchemaError(f"{path}: undeclared field has non-JSON value {document!r} ({type(document).__name__})")
+    return document
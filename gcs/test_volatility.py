@@ -7,6 +7,8 @@ volatility_stats のデバッグスクリプト
 
 from google.cloud import bigquery
 
+from query_cache import CachedClient
+
 PROJECT_ID = 'umadata'
 DATASET = 'umadata.keiba_data'
 
@@ -73,9 +75,10 @@ def test_volatility_data(client, venue, surface, distance, track_variant):
     # Step 2: 三連単の中央値を計算してみる
     median_query = f"""
     SELECT
-      APPROX_QUANTILES(CAST(REGEXP_EXTRACT(rm.sanrentan, r': (\\d+)') AS FLOAT64), 100)[OFFSET(50)] as median_payback
+      APPROX_QUANTILES(CAST(rp.amount AS FLOAT64), 100)[OFFSET(50)] as median_payback
     FROM
       `{DATASET}.race_master` rm
+      JOIN `{DATASET}.race_payout` rp ON rm.race_id = rp.race_id AND rp.bet_type = 'sanrentan' AND rp.payout_index = 0
     WHERE
       rm.venue_name = '{venue}'
       AND rm.surface = '{surface}'
@@ -109,9 +112,10 @@ def test_volatility_data(client, venue, surface, distance, track_variant):
         distance,
         track_variant,
         COUNT(*) as race_count,
-        APPROX_QUANTILES(CAST(REGEXP_EXTRACT(sanrentan, r': (\\d+)') AS FLOAT64), 100)[OFFSET(50)] as course_median
+        APPROX_QUANTILES(CAST(rp.amount AS FLOAT64), 100)[OFFSET(50)] as course_median
       FROM
         `{DATASET}.race_master` rm
+        JOIN `{DATASET}.race_payout` rp ON rm.race_id = rp.race_id AND rp.bet_type = 'sanrentan' AND rp.payout_index = 0
       WHERE
         rm.sanrentan IS NOT NULL
         AND rm.surface != '障害'
@@ -157,7 +161,7 @@ def main():
     print("🔍 Volatility Stats Debug Tool")
     print("="*60)
 
-    client = bigquery.Client(project=PROJECT_ID)
+    client = CachedClient(bigquery.Client(project=PROJECT_ID))
 
     for course in TEST_COURSES:
         test_volatility_data(
@@ -170,6 +174,7 @@ def main():
 
     print(f"\n{'='*60}")
     print("✅ Debug complete!")
+    client.report()
 
 
 if __name__ == "__main__":
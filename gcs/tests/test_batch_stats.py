@@ -0,0 +1,95 @@
+"""batch_stats のまとめ取得（FULL MODE）と種牡馬ごとのクエリ（--no-batch）が同じ結果になることを確かめる"""
+
+import json
+import os
+import random
+from datetime import date, timedelta
+
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+pytest.importorskip('google.cloud.bigquery')
+
+import generate_sires
+from offline_client import OfflineClient
+
+SNAPSHOT_DATE = date(2026, 10, 17)
+SIRES = ['ディープインパクト', 'ロードカナロア', "O'Reilly"]
+
+RACE_MASTER_COLUMNS = {
+    'race_id': 'BIGINT', 'race_date': 'DATE', 'venue_name': 'VARCHAR', 'surface': 'VARCHAR',
+    'distance': 'INTEGER', 'track_condition': 'VARCHAR', 'race_class': 'VARCHAR', 'grade': 'VARCHAR',
+}
+RACE_RESULT_COLUMNS = {
+    'race_id': 'BIGINT', 'horse_id': 'BIGINT', 'finish_position': 'INTEGER', 'bracket_number': 'INTEGER',
+    'sex': 'INTEGER', 'age': 'INTEGER', 'popularity': 'INTEGER', 'horse_weight': 'INTEGER',
+    'win': 'DOUBLE', 'place': 'DOUBLE',
+}
+HORSE_COLUMNS = {'horse_id': 'BIGINT', 'horse_name': 'VARCHAR', 'father': 'VARCHAR'}
+
+
+def write_table(conn, snapshot_dir, name, columns, rows):
+    conn.execute(f"CREATE TABLE {name} ({', '.join(f'{column} {type_}' for column, type_ in columns.items())})")
+    conn.executemany(f"INSERT INTO {name} VALUES ({', '.join('?' for _ in columns)})",
+                     [[row[column] for column in columns] for row in rows])
+    conn.execute(f"COPY {name} TO '{os.path.join(snapshot_dir, name + '.parquet')}' (FORMAT PARQUET)")
+
+
+@pytest.fixture(scope='module')
+def snapshot_dir(tmp_path_factory):
+    """6歳以上（6〜8歳）の出走を含む小さなスナップショット"""
+    rng = random.Random(1)
+    snapshot_dir = str(tmp_path_factory.mktemp('snapshot'))
+    horses = [{'horse_id': 2018100000 + i, 'horse_name': f'H{i}', 'father': SIRES[i % len(SIRES)]} for i in range(60)]
+
+    races, results = [], []
+    for race_id in range(1, 301):
+        races.append({
+            'race_id': race_id,
+            'race_date': SNAPSHOT_DATE - timedelta(days=rng.randint(1, 3 * 365 - 1)),
+            'venue_name': rng.choice(['東京', '中山', '京都', '小倉']),
+            'surface': rng.choice(['芝', 'ダート', '障害']),
+            'distance': rng.choice([1200, 1600, 2000, 2400]),
+            'track_condition': rng.choice(['良', '稍重', '重', '不良']),
+            'race_class': rng.choice(['未勝利', '１勝クラス', 'オープン']),
+            'grade': rng.choice([None, None, 'G1', 'G3']),
+        })
+        entries = rng.sample(horses, 10)
+        for position, horse in enumerate(entries, 1):
+            results.append({
+                'race_id': race_id, 'horse_id': horse['horse_id'], 'finish_position': position,
+                'bracket_number': rng.randint(1, 8), 'sex': rng.choice([1, 2, 3]), 'age': rng.randint(2, 8),
+                'popularity': rng.randint(1, 10), 'horse_weight': rng.randint(400, 540),
+                'win': float(rng.randint(110, 3000)) if position == 1 else 0.0,
+                'place': float(rng.randint(100, 800)) if position <= 3 else 0.0,
+            })
+
+    conn = duckdb.connect()
+    write_table(conn, snapshot_dir, 'race_master', RACE_MASTER_COLUMNS, races)
+    write_table(conn, snapshot_dir, 'race_result', RACE_RESULT_COLUMNS, results)
+    write_table(conn, snapshot_dir, 'horse', HORSE_COLUMNS, horses)
+    conn.close()
+    with open(os.path.join(snapshot_dir, 'snapshot.json'), 'w', encoding='utf-8') as f:
+        json.dump({'snapshot_date': SNAPSHOT_DATE.isoformat(), 'tables': ['race_master', 'race_result', 'horse']}, f)
+    return snapshot_dir
+
+
+@pytest.mark.parametrize('sire_name', SIRES)
+def test_batch_sections_match_per_sire_queries(snapshot_dir, sire_name):
+    client = OfflineClient(snapshot_dir)
+    getters = dict(generate_sires.entity_sections(rankings=None))
+    prefetched = generate_sires.prefetch_all_sires(client)(sire_name)
+
+    for section in generate_sires.BATCH_SECTIONS:
+        name = section['name']
+        if name not in prefetched:
+            # 出走がない種牡馬の総合成績は個別クエリに任せている
+            continue
+        assert prefetched[name] == getters[name](client, sire_name), name
+
+
+def test_age_stats_group_six_and_older(snapshot_dir):
+    client = OfflineClient(snapshot_dir)
+    age_stats = generate_sires.prefetch_all_sires(client)(SIRES[0])['age_stats']
+
+    assert [row['age'] for row in age_stats] == ['2歳', '3歳', '4歳', '5歳', '6歳-']
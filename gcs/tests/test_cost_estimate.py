@@ -0,0 +1,68 @@
+"""cost_estimate の dry run の集計と、dry run のクエリが失敗したときに見積もりを止めることを確かめる"""
+
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+
+import cost_estimate
+from query_stats import query_section
+
+
+class FakeJob:
+    def __init__(self, total_bytes_processed):
+        self.total_bytes_processed = total_bytes_processed
+
+
+class FakeBigQueryClient:
+    """dry run の結果（処理バイト数）を返す。fail を含むクエリは BigQuery のエラーの代わりに例外を投げる"""
+
+    def query(self, query, job_config=None):
+        assert job_config.dry_run
+        if 'fail' in query:
+            raise RuntimeError('400 Syntax error')
+        return FakeJob(len(query) * 1024 ** 3)
+
+
+def run_query_section(client, name):
+    return list(client.query(name).result())
+
+
+def swallowing_getter(client, name):
+    # エラーをログに出して空の結果を返す getter（get_fav1_place_rate など）
+    try:
+        return run_query_section(client, name)
+    except Exception:
+        return None
+
+
+def empty_result_getter(client, name):
+    # 空の結果を想定していない getter
+    return run_query_section(client, name)[0]
+
+
+def test_getter_errors_on_empty_results_are_ignored():
+    client = cost_estimate.DryRunClient(FakeBigQueryClient())
+    with client.per_entity(10):
+        cost_estimate.dry_run_sections(client, [('a', empty_result_getter), ('bb', run_query_section)], args=('bb',))
+
+    total = cost_estimate.print_estimate(client, 10, 'jockeys')
+
+    assert [(r['section'], r['count']) for r in client.records] == [('a', 10), ('bb', 10)]
+    assert total['queries'] == 20
+    assert total['bytes_processed'] == 20 * 2 * 1024 ** 3
+
+
+def test_failed_dry_run_stops_the_estimate():
+    client = cost_estimate.DryRunClient(FakeBigQueryClient())
+
+    with pytest.raises(cost_estimate.DryRunError):
+        cost_estimate.dry_run_sections(client, [('ok', run_query_section), ('fail', run_query_section)], args=('fail',))
+
+
+def test_failed_dry_run_swallowed_by_a_getter_still_stops_the_estimate():
+    client = cost_estimate.DryRunClient(FakeBigQueryClient())
+    with query_section('fail', None):
+        swallowing_getter(client, 'fail')
+
+    with pytest.raises(cost_estimate.DryRunError):
+        cost_estimate.print_estimate(client, 1, 'jockeys')
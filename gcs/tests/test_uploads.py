@@ -0,0 +1,47 @@
+"""UploadService が保存済みオブジェクトを最上位のディレクトリ単位（直下のオブジェクトは直下だけ）で list することを確かめる"""
+
+import json
+import os
+
+from uploads import LocalBackend, UploadService
+
+
+class RecordingBackend(LocalBackend):
+    """list の呼び出しと返したオブジェクトを記録する LocalBackend"""
+
+    def __init__(self, output_dir):
+        super().__init__(output_dir)
+        self.listed = []
+
+    def list(self, bucket_name, prefix, delimiter=None):
+        stored = super().list(bucket_name, prefix, delimiter)
+        self.listed.append((prefix, delimiter, sorted(stored)))
+        return stored
+
+
+def test_root_level_upload_lists_only_the_bucket_root(tmp_path):
+    seed = UploadService(LocalBackend(str(tmp_path)))
+    seed.submit('umadata', 'leading.json', '{"a": 1}', content_type='application/json')
+    seed.submit('umadata', 'jockey/00666.json', '{"b": 2}', content_type='application/json')
+    seed.close()
+
+    backend = RecordingBackend(str(tmp_path))
+    uploads = UploadService(backend)
+    uploads.submit('umadata', 'leading.json', '{"a": 1}', content_type='application/json')
+    uploads.close()
+
+    assert backend.listed == [('', '/', ['leading.json'])]
+    assert (uploads.uploaded, uploads.skipped) == (0, 1)
+
+
+def test_root_manifest_lists_only_root_level_objects(tmp_path):
+    backend = LocalBackend(str(tmp_path))
+    uploads = UploadService(backend, manifest=True)
+    uploads.bucket('umadata').blob('jockey/00666.json').upload_json({'b': 2})
+    uploads.bucket('umadata').blob('leading.json').upload_json({'a': 1})
+    uploads.close()
+
+    with open(os.path.join(str(tmp_path), 'umadata', 'manifest.json'), 'r', encoding='utf-8') as f:
+        assert list(json.load(f)['objects']) == ['leading.json']
+    with open(os.path.join(str(tmp_path), 'umadata', 'jockey', 'manifest.json'), 'r', encoding='utf-8') as f:
+        assert list(json.load(f)['objects']) == ['jockey/00666.json']
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成した JSON のアップロード
+
+UploadService はアップロードをキューに積み、スレッドプールで並列に送る。
+ジェネレーターは次のエンティティのクエリに進めるので、クエリの待ち時間と書き込みの待ち時間が重なる。
+キューに積める件数には上限があり、送信が追いつかないときは空きができるまで待つ。
+close() で残りを送り切る（ジェネレーターの main() は finally で呼ぶ。呼ばれなかった場合もプロセス終了時に自動で呼ばれる）。
+
+保存先はバックエンドで切り替える。
+- GCSBackend:   GCS（同時アップロード数に合わせて HTTP コネクションプールを広げる）
+- LocalBackend: ローカルディレクトリ（--offline やベンチマーク・テスト用）
+
+内容が変わっていないオブジェクトは送らない。
+- 保存済みオブジェクトの情報は、最初のアップロード時に最上位のディレクトリ（jockey/ など）単位で
+  1回だけ list してまとめて取得する（オブジェクトごとの get はしない）。
+  バケット直下のオブジェクト（leading.json など）は直下だけを list する（delimiter='/'。バケット全体は list しない）
+- JSON は実行日で変わる項目（last_updated / data_period）を除き、キー順をそろえた正規形の
+  SHA-256 をオブジェクトのメタデータ（content-sha256）に保存して比較する
+- メタデータがない古いオブジェクトは、送る内容そのものの MD5 と md5Hash で比較する
+内容が同じでスキップしたオブジェクトは last_updated も前回のまま残る。
+公開形式（publish_format.py）もメタデータ（publish-format）に保存し、形式を変えたときは内容が同じでも送り直す。
+
+storage_client.bucket(name).blob(path).upload_from_string(...) の呼び方はそのまま使える。
+ドキュメントは blob.upload_json(document) で渡すと、サービスの公開形式で JSON にして圧縮する。
+
+manifest=True のときは、upload_json で送ったオブジェクトの最上位のディレクトリごとに
+{ディレクトリ}/manifest.json（パス → 保存した内容の MD5 から作ったバージョン）を書き出す。
+サイトは {パス}?v={バージョン} で取得するので、オブジェクトは長期間 CDN にキャッシュさせ、
+内容が変わったオブジェクトだけが新しい URL で取り直される。マニフェスト自体のキャッシュは短くする。
+
+with storage_client.track() as uploads: の中でそのスレッドが積んだアップロードは uploads に集まり、
+settle(uploads) で完了を待って保存した内容のハッシュを受け取れる（checkpoint.py がエンティティの完了記録に使う）。
+"""
+
+import atexit
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from publish_format import PublishFormat
+
+# 同時アップロード数のデフォルトと、1スレッドあたりキューに積める件数
+DEFAULT_UPLOAD_WORKERS = 8
+MAX_PENDING_PER_WORKER = 4
+
+# 失敗したアップロードを再試行する回数と、再試行前の待機秒数（回数に比例して延ばす）
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_BACKOFF_SECONDS = 2
+
+# LocalBackend の保存先（バケット名の下に置く）
+DEFAULT_OUTPUT_DIR = os.environ.get('OFFLINE_OUTPUT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'offline_output'))
+
+# 実行日によって変わるため、内容の比較から除く JSON の項目
+VOLATILE_KEYS = ('last_updated', 'data_period')
+
+# オブジェクトのメタデータに保存する正規形 JSON のハッシュ
+CONTENT_HASH_KEY = 'content-sha256'
+
+# オブジェクトのメタデータに保存する公開形式（なければ従来の pretty とみなす）
+PUBLISH_FORMAT_KEY = 'publish-format'
+DEFAULT_PUBLISH_FORMAT = 'pretty'
+
+# バージョン付きで取得するオブジェクトとマニフェストの Cache-Control
+MANIFEST_NAME = 'manifest.json'
+VERSIONED_CACHE_CONTROL = 'public, max-age=31536000'
+MANIFEST_CACHE_CONTROL = 'public, max-age=60'
+
+
+def content_hash(data, content_type=None):
+    """内容のハッシュ（JSON は実行日の項目を除いた正規形から計算する）"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if content_type == 'application/json':
+        document = json.loads(data)
+        if isinstance(document, dict):
+            document = {key: value for key, value in document.items() if key not in VOLATILE_KEYS}
+        data = json.dumps(document, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def md5_base64(data):
+    """GCS の md5Hash と同じ形式（base64）の MD5"""
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+class GCSBackend:
+    """GCS に保存するバックエンド"""
+
+    def __init__(self, client, pool_size=DEFAULT_UPLOAD_WORKERS):
+        self.client = client
+        # 既定のコネクションプール（10本）では同時アップロード数が多いと接続を作り直すため広げる
+        http = getattr(client, '_http', None)
+        if hasattr(http, 'mount'):
+            from requests.adapters import HTTPAdapter
+            http.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    def describe(self, bucket_name, path):
+        return f"gs://{bucket_name}/{path}"
+
+    def list(self, bucket_name, prefix, delimiter=None):
+        """prefix 以下の保存済みオブジェクトを {name: {'md5', 'content_hash', 'format'}} で返す
+
+        delimiter='/' なら prefix の直下のオブジェクトだけ（サブディレクトリの中は含めない）
+        """
+        blobs = self.client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter,
+                                       fields='items(name,md5Hash,metadata),prefixes,nextPageToken')
+        return {
+            blob.name: {
+                'md5': blob.md5_hash,
+                'content_hash': (blob.metadata or {}).get(CONTENT_HASH_KEY),
+                'format': (blob.metadata or {}).get(PUBLISH_FORMAT_KEY, DEFAULT_PUBLISH_FORMAT),
+            }
+            for blob in blobs
+        }
+
+    def put(self, bucket_name, path, data, content_type, metadata, content_encoding=None, cache_control=None):
+        blob = self.client.bucket(bucket_name).blob(path)
+        blob.metadata = metadata
+        blob.content_encoding = content_encoding
+        blob.cache_control = cache_control
+        blob.upload_from_string(data, content_type=content_type)
+
+
+class LocalBackend:
+    """ローカルディレクトリに保存するバックエンド（output_dir/バケット名/パス）
+
+    GCS のメタデータ・Content-Encoding・Cache-Control は output_dir/.metadata/バケット名/パス.json に保存する。
+    """
+
+    def __init__(self, output_dir=DEFAULT_OUTPUT_DIR):
+        self.output_dir = output_dir
+
+    def describe(self, bucket_name, path):
+        return os.path.join(self.output_dir, bucket_name, path)
+
+    def _metadata_path(self, bucket_name, path):
+        return os.path.join(self.output_dir, '.metadata', bucket_name, f"{path}.json")
+
+    def metadata(self, bucket_name, path):
+        """保存時のメタデータ（{'metadata': {...}, 'content_encoding': ...}。なければ None）"""
+        metadata_path = self._metadata_path(bucket_name, path)
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def list(self, bucket_name, prefix, delimiter=None):
+        """prefix 以下の保存済みファイルを {name: {'md5', 'content_hash', 'format'}} で返す
+
+        delimiter='/' なら prefix の直下のファイルだけ（サブディレクトリの中は含めない）
+        """
+        root = os.path.join(self.output_dir, bucket_name)
+        stored = {}
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, prefix)):
+            if delimiter:
+                dirnames.clear()
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                metadata = (self.metadata(bucket_name, name) or {}).get('metadata', {})
+                stored[name] = {
+                    'md5': md5_base64(data),
+                    'content_hash': metadata.get(CONTENT_HASH_KEY),
+                    'format': metadata.get(PUBLISH_FORMAT_KEY, DEFAULT_PUBLISH_FORMAT),
+                }
+        return stored
+
+    def put(self, bucket_name, path, data, content_type, metadata, content_encoding=None, cache_control=None):
+        tmp_suffix = f".{threading.get_ident()}.tmp"
+        local_path = self.describe(bucket_name, path)
+        metadata_path = self._metadata_path(bucket_name, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with open(local_path + tmp_suffix, 'wb') as f:
+            f.write(data)
+        with open(metadata_path + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump({'content_type': content_type, 'content_encoding': content_encoding, 'cache_control': cache_control,
+                       'metadata': metadata}, f, ensure_ascii=False)
+        os.replace(local_path + tmp_suffix, local_path)
+        os.replace(metadata_path + tmp_suffix, metadata_path)
+
+
+class UploadService:
+    """アップロードのキューとスレッドプール
+
+    backend:        GCSBackend / LocalBackend
+    workers:        同時アップロード数
+    skip_unchanged: 内容が変わっていないオブジェクトを送らない
+    publish_format: upload_json で送るドキュメントの形式（PublishFormat。既定は pretty・圧縮なし）
+    manifest:       upload_json で送ったディレクトリごとに manifest.json を書き出す
+    """
+
+    def __init__(self, backend, workers=DEFAULT_UPLOAD_WORKERS, skip_unchanged=True, publish_format=None, manifest=False):
+        self.backend = backend
+        self.skip_unchanged = skip_unchanged
+        self.publish_format = publish_format or PublishFormat()
+        self.manifest = manifest
+        self._manifest_prefixes = set()   # マニフェストを書き出す (bucket, prefix)
+        self.uploaded = 0
+        self.skipped = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+        self.failed = []
+        self._index = {}       # (bucket, path) -> {'md5': ..., 'content_hash': ..., 'format': ...}
+        self._listed = set()   # list 済みの (bucket, prefix)
+        self._lock = threading.Lock()
+        self._list_lock = threading.Lock()
+        self._futures = set()
+        self._tracking = threading.local()
+        self._slots = threading.BoundedSemaphore(workers * MAX_PENDING_PER_WORKER)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self._closed = False
+        atexit.register(self.close)
+
+    def bucket(self, name):
+        return _UploadBucket(self, name)
+
+    def submit(self, bucket_name, path, data, content_type=None, publish_format=None, cache_control=None):
+        """アップロードをキューに積む（キューが一杯なら空くまで待つ）
+
+        publish_format を渡すと、その圧縮で保存する（data はそのまま送る。既定は圧縮なしの pretty 扱い）
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, bucket_name, path, data, content_type,
+                                           publish_format or PublishFormat(), cache_control)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures.add(future)
+        tracked = getattr(self._tracking, 'uploads', None)
+        if tracked is not None:
+            tracked.append((bucket_name, path, future))
+        return future
+
+    @contextmanager
+    def track(self):
+        """この中でこのスレッドが積んだアップロードを [(bucket, path, future)] に集める"""
+        previous = getattr(self._tracking, 'uploads', None)
+        tracked = []
+        self._tracking.uploads = tracked
+        try:
+            yield tracked
+        finally:
+            self._tracking.uploads = previous
+
+    def settle(self, tracked):
+        """track() で集めたアップロードの完了を待ち、{path: 保存した内容のハッシュ} を返す（失敗したパスは None）"""
+        wait([future for _, _, future in tracked])
+        hashes = {}
+        with self._lock:
+            for bucket_name, path, future in tracked:
+                info = self._index.get((bucket_name, path))
+                if future.exception() is not None or path in self.failed or not info:
+                    hashes[path] = None
+                else:
+                    # メタデータのない古いオブジェクトを内容が同じでスキップした場合は MD5
+                    hashes[path] = info['content_hash'] or info['md5']
+        return hashes
+
+    def submit_json(self, bucket_name, path, document):
+        """ドキュメントを公開形式の JSON にしてキューに積む（圧縮はアップロード時に行う）"""
+        cache_control = None
+        if self.manifest:
+            cache_control = VERSIONED_CACHE_CONTROL
+            with self._lock:
+                self._manifest_prefixes.add((bucket_name, _top_prefix(path)))
+        return self.submit(bucket_name, path, self.publish_format.dumps(document), content_type='application/json',
+                           publish_format=self.publish_format, cache_control=cache_control)
+
+    def _list_once(self, bucket_name, prefix):
+        """prefix 以下の保存済みオブジェクトを、まだなら list して索引に入れる（prefix が '' ならバケット直下だけ）"""
+        with self._list_lock:
+            if (bucket_name, prefix) not in self._listed:
+                stored = self.backend.list(bucket_name, prefix, delimiter=None if prefix else '/')
+                with self._lock:
+                    self._index.update({(bucket_name, name): info for name, info in stored.items()})
+                self._listed.add((bucket_name, prefix))
+
+    def _stored(self, bucket_name, path):
+        """保存済みオブジェクトの情報（最上位のディレクトリ単位で初回に1回だけ list する）"""
+        self._list_once(bucket_name, _top_prefix(path))
+        with self._lock:
+            return self._index.get((bucket_name, path))
+
+    def _upload(self, bucket_name, path, data, content_type, publish_format, cache_control):
+        # 比較用のハッシュは圧縮前の内容から計算する
+        digest = content_hash(data, content_type)
+        data = publish_format.encode(data)
+        md5 = md5_base64(data)
+        if self.skip_unchanged:
+            stored = self._stored(bucket_name, path)
+            if stored and ((stored['content_hash'] == digest and stored['format'] == publish_format.label) or stored['md5'] == md5):
+                with self._lock:
+                    self.skipped += 1
+                    self.bytes_saved += len(data)
+                return False
+
+        metadata = {CONTENT_HASH_KEY: digest, PUBLISH_FORMAT_KEY: publish_format.label}
+        for attempt in range(UPLOAD_RETRIES + 1):
+            try:
+                self.backend.put(bucket_name, path, data, content_type, metadata, publish_format.content_encoding, cache_control)
+                break
+            except Exception as e:
+                if attempt == UPLOAD_RETRIES:
+                    print(f"   ⚠️  Error uploading {self.backend.describe(bucket_name, path)}: {str(e)}", file=sys.stderr)
+                    with self._lock:
+                        self.failed.append(path)
+                    return False
+                time.sleep(UPLOAD_RETRY_BACKOFF_SECONDS * (attempt + 1))
+
+        with self._lock:
+            self._index[(bucket_name, path)] = {'md5': md5, 'content_hash': digest, 'format': publish_format.label}
+            self.uploaded += 1
+            self.bytes_uploaded += len(data)
+        return True
+
+    def flush(self):
+        """キューに積んだアップロードがすべて終わるまで待つ"""
+        while True:
+            with self._lock:
+                futures, self._futures = self._futures, set()
+            if not futures:
+                return
+            wait(futures)
+
+    def write_manifests(self):
+        """upload_json で送ったディレクトリごとに manifest.json を書き出す
+
+        バージョンは保存されているオブジェクトの MD5 から作る。内容が同じでスキップしたオブジェクトや、
+        今回送らなかった（差分更新で対象外の）オブジェクトも、保存済みのバージョンで載せる。
+        キューに積んだアップロードが終わるのを待ってから、マニフェストは呼び出したスレッドで直接書き込む。
+        """
+        self.flush()
+        with self._lock:
+            prefixes, self._manifest_prefixes = sorted(self._manifest_prefixes), set()
+        for bucket_name, prefix in prefixes:
+            manifest_path = f"{prefix}{MANIFEST_NAME}"
+            self._list_once(bucket_name, prefix)
+            with self._lock:
+                objects = {
+                    name: base64.b64decode(info['md5']).hex()[:16]
+                    for (bucket, name), info in self._index.items()
+                    if bucket == bucket_name and _in_prefix(name, prefix) and name != manifest_path and info['md5']
+                }
+            manifest = {
+                'last_updated': datetime.now().isoformat(timespec='seconds'),
+                'objects': dict(sorted(objects.items())),
+            }
+            manifest_format = PublishFormat('compact')
+            # スレッドプールを通さずにこのスレッドで送る（プロセス終了時はプールが新しい仕事を受け付けない）
+            self._upload(bucket_name, manifest_path, manifest_format.dumps(manifest).encode('utf-8'), 'application/json',
+                         manifest_format, MANIFEST_CACHE_CONTROL)
+            print(f"🧾 Manifest: {self.backend.describe(bucket_name, manifest_path)} ({len(objects)} objects)")
+
+    def close(self):
+        """残りのアップロードとマニフェストを送り切ってからスレッドプールを止める（プロセス終了時にも呼ばれる）"""
+        if self._closed:
+            return
+        self.flush()
+        self.write_manifests()
+        self._executor.shutdown(wait=True)
+        self._closed = True
+        atexit.unregister(self.close)
+
+    def report(self):
+        """アップロード・スキップ件数と節約できた転送量を表示する"""
+        print(f"📤 Uploads: {self.uploaded} uploaded ({self.bytes_uploaded / 1024 ** 2:,.1f} MB), "
+              f"{self.skipped} unchanged skipped ({self.bytes_saved / 1024 ** 2:,.1f} MB saved)")
+        if self.failed:
+            print(f"   ❌ {len(self.failed)} uploads failed:")
+            for path in self.failed:
+                print(f"     - {path}")
+
+
+def _top_prefix(path):
+    """パスの最上位のディレクトリ（'jockey/00666.json' → 'jockey/'。直下なら ''）"""
+    return path.split('/', 1)[0] + '/' if '/' in path else ''
+
+
+def _in_prefix(name, prefix):
+    """name が _top_prefix で prefix になるオブジェクトか（'' はバケット直下だけ）"""
+    return name.startswith(prefix) if prefix else '/' not in name
+
+
+class _UploadBucket:
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+    def blob(self, path):
+        return _UploadBlob(self.service, self.name, path)
+
+
+class _UploadBlob:
+    def __init__(self, service, bucket_name, path):
+        self.service = service
+        self.bucket_name = bucket_name
+        self.name = path
+
+    def upload_from_string(self, data, content_type=None):
+        self.service.submit(self.bucket_name, self.name, data, content_type)
+
+    def upload_json(self, document):
+        self.service.submit_json(self.bucket_name, self.name, document)
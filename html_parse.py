@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+スクレイピングしたページの HTML パース
+
+これまでは BeautifulSoup(content, 'html.parser') でページ全体の木を作ってから、find_all で全テーブルを探していた。
+血統ページで使うのは兄弟馬の表、JRA の開催カレンダーで使うのは table.basic だけなので、
+parse_tables では
+- SoupStrainer で指定したテーブル（とその中身）だけを木にする（ヘッダー・広告・スクリプトなどは木にしない）
+- lxml がインストールされていれば lxml でパースする（なければ html.parser）
+ようにする。テーブルの中身は全体をパースした場合と同じなので、呼び出し側の find / find_all はそのまま使える。
+
+fast=False ではこれまでと同じく html.parser でページ全体をパースする。
+両方の結果が同じこと、1秒あたりのページ数と1ページあたりのメモリは compare_html_parsers.py で確かめる。
+記録済みのページ（tests/fixtures）で結果が同じことは tests/test_html_parse.py でも確かめる。
+"""
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+# 速いほうのパーサー
+FAST_BACKEND = 'lxml' if lxml is not None else 'html.parser'
+
+# ページ全体をパースするときのパーサー（これまでの実装）
+FULL_BACKEND = 'html.parser'
+
+
+def has_classes(*names):
+    """class にすべての names を含む要素に当たる SoupStrainer 用の条件
+
+    パース中の SoupStrainer には class 属性が空白区切りの文字列のまま渡されるので、
+    class_='basic' では class="basic narrow-xy" のテーブルに当たらない（パース後の find_all では当たる）。
+    ここでは空白で区切って比べ、パース後の find_all が探すテーブルをすべて残す。
+    """
+    def match(value):
+        if value is None:
+            return False
+        classes = value.split() if isinstance(value, str) else value
+        return all(name in classes for name in names)
+    return match
+
+
+# 血統ページの兄弟馬の表（scrape_siblings.parse_siblings / scraper.scrape_oldest_sibling）
+SIBLING_TABLES = SoupStrainer('table', class_=has_classes('nk_tb_common', 'race_table_01'))
+
+# JRA の開催カレンダーの競馬場ごとの表（generate_race_schedule.parse_race_schedule）
+SCHEDULE_TABLES = SoupStrainer('table', class_=has_classes('basic'))
+
+
+def parse_tables(markup, tables, fast=True):
+    """
+    HTML をパースする
+
+    Args:
+        markup: ページの HTML（bytes / str）
+        tables: 残すテーブルの SoupStrainer（SIBLING_TABLES / SCHEDULE_TABLES）
+        fast:   False ならページ全体を html.parser でパースする
+
+    Returns:
+        BeautifulSoup: fast なら tables に当たる要素だけを含む木
+    """
+    if not fast:
+        return BeautifulSoup(markup, FULL_BACKEND)
+    return BeautifulSoup(markup, FAST_BACKEND, parse_only=tables)
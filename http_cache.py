@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+netkeiba / JRA のページ取得用のディスクキャッシュ
+
+スクレイピングを解析やパーサーの修正のためにやり直すと、毎回同じページを全部ダウンロードし直していた。
+CachedSession は requests.Session の get() の代わりに使い、取得したページをディスクに保存する。
+
+- 本文は内容の SHA-256 をファイル名にして保存する（objects/ab/abcd...。同じ内容のページは1つだけ）
+- URL ごとの索引（urls/{URL の SHA-256}.json）に、本文のハッシュ・ステータス・ヘッダー・取得時刻を置く
+- 取得から TTL 以内ならネットワークに出ずにディスクから返す。TTL は URL のパターンごとに決める（TTL_RULES）
+- TTL を過ぎたら ETag / Last-Modified で条件付きリクエストを送り、304 なら保存済みの本文を返す
+- 200 以外（304 を除く）の応答は保存しない
+
+offline=True（環境変数 HTTP_CACHE_OFFLINE=1）ではネットワークに出ず、保存済みのページだけを返す。
+保存済みのページは、パーサーを確かめるときの記録済みページとしてそのまま使える。
+
+    session = CachedSession(requests.Session())
+    response = session.get(url, headers=headers, timeout=30)   # requests.Response と同じように使える
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# キャッシュの保存先
+DEFAULT_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.http_cache'))
+
+# URL のパターンごとの TTL（秒）。最初にマッチしたものを使い、どれにもマッチしなければ DEFAULT_TTL
+TTL_RULES = [
+    # 血統ページ（兄弟馬の表）はほとんど変わらない
+    (r'^https?://db\.netkeiba\.com/horse/ped/', 30 * 24 * 3600),
+    (r'^https?://db\.netkeiba\.com/', 24 * 3600),
+    # JRA の開催カレンダーは出走表の確定まで更新されるので、毎回条件付きリクエストで確かめる
+    (r'^https?://www\.jra\.go\.jp/', 0),
+]
+DEFAULT_TTL = 0
+
+# 索引に残す応答ヘッダー
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+class CacheMiss(LookupError):
+    """offline でキャッシュにないページを取得しようとした"""
+
+
+def _atomic_write(path, data):
+    """一時ファイルに書いてから置き換える（並行して読まれても途中の内容は見えない）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _build_response(url, status_code, headers, content):
+    """保存済みの内容から requests.Response を作る（text / apparent_encoding / raise_for_status がそのまま使える）"""
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    return response
+
+
+class CachedSession:
+    """get() の結果をディスクにキャッシュする requests.Session のラッパー（それ以外の属性は元のセッションに委譲する）"""
+
+    def __init__(self, session=None, cache_dir=DEFAULT_CACHE_DIR, ttl_rules=None, default_ttl=DEFAULT_TTL,
+                 offline=None):
+        self.session = session or requests.Session()
+        self.cache_dir = cache_dir
+        self.ttl_rules = [(re.compile(pattern), ttl) for pattern, ttl in (TTL_RULES if ttl_rules is None else ttl_rules)]
+        self.default_ttl = default_ttl
+        self.offline = os.environ.get('HTTP_CACHE_OFFLINE') == '1' if offline is None else offline
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def ttl_for(self, url):
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def _index_path(self, url):
+        return os.path.join(self.cache_dir, 'urls', f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json")
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def _load(self, url):
+        """保存済みの (索引, 本文)。なければ (None, None)"""
+        try:
+            with open(self._index_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                return entry, f.read()
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def _store(self, url, response, fetched_at):
+        digest = hashlib.sha256(response.content).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            _atomic_write(object_path, response.content)
+        entry = {
+            'url': url,
+            'status_code': response.status_code,
+            'headers': {name: response.headers[name] for name in STORED_HEADERS if name in response.headers},
+            'sha256': digest,
+            'fetched_at': fetched_at,
+        }
+        _atomic_write(self._index_path(url), json.dumps(entry, ensure_ascii=False, indent=2).encode('utf-8'))
+        return entry
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def is_fresh(self, url):
+        """ネットワークに出ずにディスクから返せるか（レート制限の待ちを飛ばすのに使う）"""
+        if self.offline:
+            return True
+        try:
+            with open(self._index_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return time.time() - entry['fetched_at'] < self.ttl_for(url)
+
+    def get(self, url, headers=None, **kwargs):
+        """Session.get と同じ呼び方で、キャッシュから、または条件付きリクエストで取得する"""
+        entry, content = self._load(url)
+        now = time.time()
+
+        if entry and (self.offline or now - entry['fetched_at'] < self.ttl_for(url)):
+            self._count('hits')
+            return _build_response(url, entry['status_code'], entry['headers'], content)
+        if self.offline:
+            raise CacheMiss(f"{url} is not in the HTTP cache ({self.cache_dir})")
+
+        request_headers = dict(headers or {})
+        if entry:
+            if entry['headers'].get('ETag'):
+                request_headers['If-None-Match'] = entry['headers']['ETag']
+            if entry['headers'].get('Last-Modified'):
+                request_headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        response = self.session.get(url, headers=request_headers, **kwargs)
+
+        if response.status_code == 304 and entry:
+            # 変わっていない: 取得時刻だけ更新して保存済みの本文を返す
+            entry['fetched_at'] = now
+            _atomic_write(self._index_path(url), json.dumps(entry, ensure_ascii=False, indent=2).encode('utf-8'))
+            self._count('revalidated')
+            return _build_response(url, entry['status_code'], entry['headers'], content)
+
+        self._count('downloads')
+        if response.status_code == 200:
+            self._store(url, response, now)
+        return response
+
+    def report(self):
+        """キャッシュのヒット数を表示する"""
+        print(f"💾 HTTP cache: {self.hits} hits, {self.revalidated} revalidated (304), "
+              f"{self.downloads} downloads ({self.cache_dir})")
@@ -0,0 +1,41 @@
+/**
+ * 列形式（columnar）で公開された JSON を元の形に戻す
+ *
+ * gcs/publish_format.py の columnar レイアウトでは、同じキーのオブジェクトが並ぶ配列を
+ * { "$cols": { "gate": [1, 2], "races": [10, 12] } } の形で保存している。
+ * これを [{ gate: 1, races: 10 }, { gate: 2, races: 12 }] に戻す。
+ * 列形式でない JSON はそのまま返すので、どの形式で公開されていても通してよい。
+ */
+
+const COLUMNAR_KEY = '$cols';
+
+export function expandColumnar<T = any>(value: any): T {
+  if (Array.isArray(value)) {
+    return value.map((item) => expandColumnar(item)) as T;
+  }
+  if (value === null || typeof value !== 'object') {
+    return value;
+  }
+
+  const keys = Object.keys(value);
+  if (keys.length === 1 && keys[0] === COLUMNAR_KEY) {
+    const columns: Record<string, any[]> = value[COLUMNAR_KEY];
+    const columnNames = Object.keys(columns);
+    const rowCount = columnNames.length > 0 ? columns[columnNames[0]].length : 0;
+    const rows = [];
+    for (let i = 0; i < rowCount; i++) {
+      const row: Record<string, any> = {};
+      for (const name of columnNames) {
+        row[name] = expandColumnar(columns[name][i]);
+      }
+      rows.push(row);
+    }
+    return rows as T;
+  }
+
+  const result: Record<string, any> = {};
+  for (const key of keys) {
+    result[key] = expandColumnar(value[key]);
+  }
+  return result as T;
+}
@@ -0,0 +1,52 @@
+/**
+ * GCS の JSON をマニフェストのバージョン付き URL で取得する
+ *
+ * gcs/ のジェネレーターは最上位のディレクトリごとに manifest.json（パス → 内容のバージョン）を書き出す。
+ * オブジェクトは {パス}?v={バージョン} で取得するので、内容が変わらない限り同じ URL になり、
+ * CDN と Next.js のキャッシュをそのまま使える。内容が変わったオブジェクトだけ新しい URL で取り直す。
+ * マニフェストは短い間隔で再検証する（GCS 側の Cache-Control も60秒）。
+ * マニフェストにないオブジェクトは、これまでどおりキャッシュを使わずに取得する。
+ */
+
+const BASE_URL = 'https://storage.googleapis.com/umadata';
+
+// マニフェストを再検証する間隔（秒）
+const MANIFEST_REVALIDATE_SECONDS = 60;
+
+interface GCSManifest {
+  last_updated: string;
+  objects: Record<string, string>;
+}
+
+async function getManifestVersion(path: string): Promise<string | null> {
+  const prefix = path.includes('/') ? `${path.split('/')[0]}/` : '';
+  try {
+    const response = await fetch(`${BASE_URL}/${prefix}manifest.json`, {
+      next: { revalidate: MANIFEST_REVALIDATE_SECONDS },
+    });
+    if (!response.ok) {
+      return null;
+    }
+    const manifest: GCSManifest = await response.json();
+    return manifest.objects?.[path] ?? null;
+  } catch (error) {
+    console.warn(`⚠️ Failed to fetch manifest for ${path}:`, error);
+    return null;
+  }
+}
+
+export async function fetchVersionedFromGCS(path: string): Promise<Response> {
+  const version = await getManifestVersion(path);
+
+  if (version) {
+    const url = `${BASE_URL}/${path}?v=${version}`;
+    console.log('🔍 Fetching from GCS:', url);
+    // 内容が変わると URL も変わるので、キャッシュは期限なしでよい
+    return fetch(url, { cache: 'force-cache' });
+  }
+
+  // マニフェストにない場合はキャッシュバスターを付けて最新を取得する
+  const url = `${BASE_URL}/${path}?v=${Math.floor(Date.now() / 1000)}`;
+  console.log('🔍 Fetching from GCS (unversioned):', url);
+  return fetch(url, { cache: 'no-store' });
+}
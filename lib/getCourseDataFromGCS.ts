@@ -1,4 +1,5 @@
-const BASE_URL = 'https://storage.googleapis.com/umadata';
+import { expandColumnar } from './expandColumnar';
+import { fetchVersionedFromGCS } from './fetchVersionedFromGCS';
 
 // 枠番ごとの色を定義
 const GATE_COLORS: Record<number, string> = {
@@ -31,16 +32,11 @@ export async function getCourseDataFromGCS(
     filePath = `${distance}.json`;
   }
 
-  // キャッシュバスターを付けてCDNキャッシュを回避
-  const timestamp = Math.floor(Date.now() / 3600000); // 1時間単位
-  const url = `${BASE_URL}/course/${racecourse}/${surface}/${filePath}?v=${timestamp}`;
-
-  console.log('🔍 Fetching course data from GCS:', url);
+  // manifest.json のバージョン付き URL で取得する（内容が変わらない限りキャッシュを使う）
+  const path = `course/${racecourse}/${surface}/${filePath}`;
 
   try {
-    const response = await fetch(url, {
-      next: { revalidate: false }, // ビルド時のみ取得、自動リバリデートなし
-    });
+    const response = await fetchVersionedFromGCS(path);
 
     if (!response.ok) {
       throw new Error(`HTTP ${response.status}: ${response.statusText}`);
@@ -53,8 +49,8 @@ export async function getCourseDataFromGCS(
     // 統合JSON形式を優先して試す（複数行でもOK）
     try {
       if (text.trim().startsWith('{') && text.trim().endsWith('}')) {
-        // 統合JSON形式（1つのJSONオブジェクト）
-        data = JSON.parse(text);
+        // 統合JSON形式（1つのJSONオブジェクト）。列形式（columnar）の統計配列は元の形に戻す
+        data = expandColumnar(JSON.parse(text));
       } else if (text.trim().startsWith('[') && text.trim().endsWith(']')) {
         // JSON配列形式
         data.gate_stats = JSON.parse(text);
@@ -1,4 +1,5 @@
-const BASE_URL = 'https://storage.googleapis.com/umadata';
+import { expandColumnar } from './expandColumnar';
+import { fetchVersionedFromGCS } from './fetchVersionedFromGCS';
 
 // 枠番ごとの色を定義
 const GATE_COLORS: Record<number, string> = {
@@ -16,22 +17,18 @@ export async function getJockeyDataFromGCS(jockeyId: string | number) {
   // 騎手IDを5桁にゼロパディング（例: 666 → 00666）
   const paddedId = String(jockeyId).padStart(5, '0');
 
-  // キャッシュバスターを付けてCDNキャッシュを回避
-  const timestamp = Math.floor(Date.now() / 1000); // 秒単位（開発用）
-  const url = `${BASE_URL}/jockey/${paddedId}.json?v=${timestamp}`;
-
-  console.log('🔍 Fetching jockey data from GCS:', url);
+  // manifest.json のバージョン付き URL で取得する（内容が変わらない限りキャッシュを使う）
+  const path = `jockey/${paddedId}.json`;
 
   try {
-    const response = await fetch(url, {
-      cache: 'no-store', // 開発用：キャッシュを使用しない
-    });
+    const response = await fetchVersionedFromGCS(path);
 
     if (!response.ok) {
       throw new Error(`HTTP ${response.status}: ${response.statusText}`);
     }
 
-    const data = await response.json();
+    // 列形式（columnar）で公開された統計配列を元の形に戻す
+    const data = expandColumnar(await response.json());
 
     // gate_stats に color フィールドを追加
     if (data.gate_stats && Array.isArray(data.gate_stats)) {
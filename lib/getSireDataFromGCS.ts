@@ -1,6 +1,6 @@
 import { ALL_SIRES } from './sires';
-
-const BASE_URL = 'https://storage.googleapis.com/umadata';
+import { expandColumnar } from './expandColumnar';
+import { fetchVersionedFromGCS } from './fetchVersionedFromGCS';
 
 export async function getSireDataFromGCS(sireId: string | number) {
   // IDから種牡馬情報を取得
@@ -12,22 +12,18 @@ export async function getSireDataFromGCS(sireId: string | number) {
   // ID番号を5桁のゼロパディング形式に変換（調教師・騎手と同じ形式）
   const paddedId = String(sireId).padStart(5, '0');
 
-  // キャッシュバスターを付けてCDNキャッシュを回避
-  const timestamp = Math.floor(Date.now() / 1000);
-  const url = `${BASE_URL}/sires/${paddedId}.json?v=${timestamp}`;
-
-  console.log('🔍 Fetching sire data from GCS:', url);
+  // manifest.json のバージョン付き URL で取得する（内容が変わらない限りキャッシュを使う）
+  const path = `sires/${paddedId}.json`;
 
   try {
-    const response = await fetch(url, {
-      cache: 'no-store',
-    });
+    const response = await fetchVersionedFromGCS(path);
 
     if (!response.ok) {
       throw new Error(`Failed to fetch sire data: ${response.status} ${response.statusText}`);
     }
 
-    const data = await response.json();
+    // 列形式（columnar）で公開された統計配列を元の形に戻す
+    const data = expandColumnar(await response.json());
 
     // 各統計データの処理（avg_popularity、avg_rank、median_popularity、median_rankを含める）
     const processStatsArray = (statsArray: any[]) => {
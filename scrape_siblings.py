@@ -1,5 +1,41 @@
+"""
+兄弟馬スクレイピング
+
+対象馬ごとに netkeiba の血統ページ（/horse/ped/{horse_id}/）を取得し、最年長の兄弟を horse_siblings.csv に書き出す。
+兄弟馬の表は同じ母の馬で共通なので、対象馬を母ごとにまとめ、代表1頭のページから全員分の結果を作る（group_by_dam）。
+
+これまでは1頭ずつ取得して毎回2〜5秒待っていたため、処理時間が「応答時間 + 待ち時間」× 頭数になっていた。
+いまは asyncio で
+- 取得: 同時 --concurrency 件まで。ホストごとのトークンバケット（毎秒 --rate 件、最大 --burst 件まで連続）で間隔を空ける
+- 解析: 取得済みのページを別スレッドでパースする
+- 書き出し: 解析が終わった行から CSV に追記する
+を並行して進めるので、処理時間は許可したリクエストレートでほぼ決まる。
+requests.Session は1つを使い回し、接続プールを同時取得数に合わせて広げる（keep-alive で接続を再利用する）。
+429 が返ったときは、そのホストのバケットを空にして全体で待つ。
+
+再実行したときは、出力済みの horse_id（horse_siblings.csv）を飛ばして残りだけを取得する。
+結果は一定件数ごとに1回の write で追記して fsync するので、途中で止まっても書き終えた分は残る
+（最後の行が切れていたら次の実行の最初に切り詰める）。
+スクレイピングの前に、horse テーブルの産駒がそろっている母の馬は DB から最年長兄弟を決める
+（resolve_oldest_siblings。--no-db-resolve で無効）。
+取得に失敗した horse_id は horse_siblings_failed.txt に記録し、--retry-failed でそれだけを取り直せる。
+最初からやり直すときは --fresh。
+
+取得したページは http_cache.CachedSession でディスクにキャッシュする（血統ページは30日。--no-http-cache で無効）。
+キャッシュから返すページはサイトにリクエストしないので、レート制限の待ちもない。
+
+--base-url で取得先を差し替えられる（記録したページを返すローカルの HTTP サーバーに向けて動作を確かめる用）。
+tests/test_scrape_siblings.py は tests/fixtures/pedigree の記録したページを返すローカルの HTTP サーバーで、
+レート制限・429・取得パイプライン・再開（--retry-failed）を確かめる。
+"""
+
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import argparse
+import asyncio
+import codecs
+import csv
+import io
 import time
 import pandas as pd
 from google.cloud import bigquery
@@ -8,6 +44,33 @@ import random
 import datetime
 import logging
 import os
+from urllib.parse import urlsplit
+
+from html_parse import SIBLING_TABLES, parse_tables
+from http_cache import CacheMiss, CachedSession
+
+# 血統ページの取得先
+DEFAULT_BASE_URL = "https://db.netkeiba.com"
+
+# ホストごとのリクエストレート（件/秒）と連続して送れる件数、同時に取得する件数
+DEFAULT_RATE = 0.5
+DEFAULT_BURST = 2
+DEFAULT_CONCURRENCY = 4
+
+# 取得済み・解析済みのページを溜めておける件数（書き出しが遅れたときに取得を止める）
+QUEUE_SIZE = 32
+
+OUTPUT_COLUMNS = ['horse_id', 'oldest_sibling_id', 'oldest_sibling_name', 'oldest_sibling_birth_year']
+
+# DB の産駒で最年長兄弟を決めるときの条件（resolve_oldest_siblings）
+# 母はこの年齢より前には出産しない（最終出走年が分からない母の、最初の産駒の生年の下限に使う）
+MIN_DAM_AGE_AT_FOALING = 3
+# 最初にありうる産駒の生年から、知っている最年長の産駒の生年までの許容年数
+# （0 より大きくすると、その間に出走しなかった最年長の産駒がいても見落とす。スクレイピングは減る）
+FIRST_FOAL_SLACK_YEARS = 0
+
+# 結果をまとめて書き出す件数（書き出し待ちがなくなったときも書き出す）
+WRITE_BATCH_SIZE = 20
 
 # ログ設定
 def setup_logger():
@@ -89,112 +152,193 @@ def retry_request(url: str, session, max_retries: int = 3, retry_delay: int = 5,
     return None
 
 
-def wait_random_time(min_sec: float, max_sec: float):
-    """ランダムな時間だけ待機"""
-    time.sleep(random.uniform(min_sec, max_sec))
+def pedigree_url(horse_id, base_url=DEFAULT_BASE_URL):
+    """血統ページの URL"""
+    return f"{base_url.rstrip('/')}/horse/ped/{horse_id}/"
 
 
-def scrape_oldest_sibling(horse_id, session, logger=None):
+def parse_siblings(content, fast=True):
     """
-    指定されたhorse_idの最年長兄弟を取得
+    血統ページの HTML から兄弟馬の表を取り出す
 
     Args:
-        horse_id: 馬のID
-        session: requests.Session オブジェクト
-        logger: ロガーオブジェクト
+        content: ページの HTML（bytes / str）
+        fast: 兄弟馬の表だけを lxml でパースする（False ならページ全体を html.parser でパースする。html_parse.py）
+
+    Returns:
+        list: [{'sibling_horse_id': int or None, 'name': str, 'birth_year': int}]
+    """
+    # HTMLをパース（兄弟馬の表の候補だけ）
+    soup = parse_tables(content, SIBLING_TABLES, fast=fast)
+
+    # 兄弟馬の表を取得（captionまたはsummaryに「兄弟」を含むテーブル）
+    table = None
+    all_tables = soup.find_all('table', class_='nk_tb_common race_table_01')
+
+    for t in all_tables:
+        caption = t.find('caption')
+        summary = t.get('summary', '')
+        caption_text = caption.text.strip() if caption else ''
+
+        # 「兄弟」「全兄弟」などを含むテーブルを探す
+        if '兄弟' in caption_text or '兄弟' in summary:
+            table = t
+            break
+
+    if not table:
+        # 兄弟がいない場合
+        return []
+
+    siblings = []
+    tbody = table.find('tbody')
+    if tbody:
+        rows = tbody.find_all('tr')
+    else:
+        rows = table.find_all('tr')
+
+    for row in rows:
+        # ヘッダー行をスキップ
+        if row.find('th'):
+            continue
+
+        cols = row.find_all('td')
+        if len(cols) >= 3:
+            # 馬名を取得
+            name_link = cols[0].find('a')
+            name = name_link.text.strip() if name_link else ""
+
+            # horse_idを取得（URLから抽出）
+            sibling_horse_id = None
+            if name_link and 'href' in name_link.attrs:
+                match = re.search(r'/horse/(\d+)/', name_link['href'])
+                if match:
+                    sibling_horse_id = int(match.group(1))
+
+            # 生年を取得
+            birth_year_link = cols[2].find('a')
+            birth_year = birth_year_link.text.strip() if birth_year_link else cols[2].text.strip()
+
+            if birth_year.isdigit():
+                siblings.append({
+                    'sibling_horse_id': sibling_horse_id,
+                    'name': name,
+                    'birth_year': int(birth_year)
+                })
+
+    return siblings
+
+
+def oldest_sibling(siblings, exclude_id=None):
+    """
+    兄弟の中から最年長（birth_year が最小）を選ぶ（exclude_id の馬自身は除く）
 
     Returns:
-        dict or None: {
+        dict: {
             'oldest_sibling_id': int or None,
             'oldest_sibling_name': str or None,
             'oldest_sibling_birth_year': int or None
         }
     """
-    url = f"https://db.netkeiba.com/horse/ped/{horse_id}/"
+    siblings = [sibling for sibling in siblings if exclude_id is None or sibling['sibling_horse_id'] != exclude_id]
 
-    try:
-        response = retry_request(url, session, logger=logger)
+    # 兄弟がいない場合
+    if not siblings:
+        return {
+            'oldest_sibling_id': None,
+            'oldest_sibling_name': None,
+            'oldest_sibling_birth_year': None
+        }
 
-        if not response:
-            return None
+    # 最年長の兄弟を取得（birth_yearが最小のもの）
+    oldest = min(siblings, key=lambda x: x['birth_year'])
 
-        # HTMLをパース
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # 兄弟馬の表を取得（captionまたはsummaryに「兄弟」を含むテーブル）
-        table = None
-        all_tables = soup.find_all('table', class_='nk_tb_common race_table_01')
-
-        for t in all_tables:
-            caption = t.find('caption')
-            summary = t.get('summary', '')
-            caption_text = caption.text.strip() if caption else ''
-
-            # 「兄弟」「全兄弟」などを含むテーブルを探す
-            if '兄弟' in caption_text or '兄弟' in summary:
-                table = t
-                break
-
-        if not table:
-            # 兄弟がいない場合
-            return {
-                'oldest_sibling_id': None,
-                'oldest_sibling_name': None,
-                'oldest_sibling_birth_year': None
-            }
-
-        siblings = []
-        tbody = table.find('tbody')
-        if tbody:
-            rows = tbody.find_all('tr')
-        else:
-            rows = table.find_all('tr')
+    return {
+        'oldest_sibling_id': oldest['sibling_horse_id'],
+        'oldest_sibling_name': oldest['name'],
+        'oldest_sibling_birth_year': oldest['birth_year']
+    }
 
-        for row in rows:
-            # ヘッダー行をスキップ
-            if row.find('th'):
-                continue
 
-            cols = row.find_all('td')
-            if len(cols) >= 3:
-                # 馬名を取得
-                name_link = cols[0].find('a')
-                name = name_link.text.strip() if name_link else ""
-
-                # horse_idを取得（URLから抽出）
-                sibling_horse_id = None
-                if name_link and 'href' in name_link.attrs:
-                    match = re.search(r'/horse/(\d+)/', name_link['href'])
-                    if match:
-                        sibling_horse_id = int(match.group(1))
-
-                # 生年を取得
-                birth_year_link = cols[2].find('a')
-                birth_year = birth_year_link.text.strip() if birth_year_link else cols[2].text.strip()
-
-                if birth_year.isdigit():
-                    siblings.append({
-                        'sibling_horse_id': sibling_horse_id,
-                        'name': name,
-                        'birth_year': int(birth_year)
-                    })
+def parse_oldest_sibling(content):
+    """血統ページの HTML から最年長兄弟を取り出す（oldest_sibling と同じ形の dict）"""
+    return oldest_sibling(parse_siblings(content))
 
-        # 兄弟がいない場合
-        if not siblings:
-            return {
-                'oldest_sibling_id': None,
-                'oldest_sibling_name': None,
-                'oldest_sibling_birth_year': None
-            }
 
-        # 最年長の兄弟を取得（birth_yearが最小のもの）
-        oldest = min(siblings, key=lambda x: x['birth_year'])
+def group_by_dam(target_df, horse_ids):
+    """
+    対象馬を母（horse.mother）ごとにまとめる
 
-        return {
-            'oldest_sibling_id': oldest['sibling_horse_id'],
-            'oldest_sibling_name': oldest['name'],
-            'oldest_sibling_birth_year': oldest['birth_year']
+    同じ母の馬は血統ページの兄弟馬の表が共通なので、グループの代表1頭のページだけを取得して
+    fan_out_siblings で全員分の結果を作る。target_df に mother の列がない場合（horse_id だけの
+    target_horses.csv など）は1頭ずつのグループにする。
+
+    Args:
+        target_df: 対象馬（horse_id と、あれば mother / horse_name / birth_year）
+        horse_ids: 今回取得する horse_id
+
+    Returns:
+        list: [[{'horse_id', 'name', 'birth_year'}, ...]]（各グループの先頭が代表）
+    """
+    info = {int(row['horse_id']): row for row in target_df.to_dict('records')}
+    groups = {}
+    for horse_id in horse_ids:
+        row = info.get(horse_id, {})
+        birth_year = row.get('birth_year')
+        member = {
+            'horse_id': horse_id,
+            'name': row.get('horse_name') if pd.notna(row.get('horse_name')) else None,
+            # netkeiba の horse_id は先頭4桁が生年
+            'birth_year': int(birth_year) if pd.notna(birth_year) else int(str(horse_id)[:4]),
         }
+        mother = row.get('mother')
+        key = mother if isinstance(mother, str) and mother else ('horse', horse_id)
+        groups.setdefault(key, []).append(member)
+    return list(groups.values())
+
+
+def fan_out_siblings(group, siblings):
+    """
+    代表のページの兄弟馬の表から、グループ全員の最年長兄弟を求める
+
+    代表のページの表には代表自身が載らないので、代表を加えた母の産駒全体から、
+    それぞれの馬自身を除いて最年長を選ぶ。
+
+    Returns:
+        list: [(horse_id, oldest_sibling の結果)]
+    """
+    representative = group[0]
+    family = list(siblings)
+    if not any(sibling['sibling_horse_id'] == representative['horse_id'] for sibling in family):
+        family.append({
+            'sibling_horse_id': representative['horse_id'],
+            'name': representative['name'],
+            'birth_year': representative['birth_year'],
+        })
+    return [(member['horse_id'], oldest_sibling(family, exclude_id=member['horse_id'])) for member in group]
+
+
+def scrape_oldest_sibling(horse_id, session, logger=None, base_url=DEFAULT_BASE_URL):
+    """
+    指定されたhorse_idの最年長兄弟を取得（1頭ずつ同期で取得する場合）
+
+    Args:
+        horse_id: 馬のID
+        session: requests.Session オブジェクト
+        logger: ロガーオブジェクト
+        base_url: 取得先
+
+    Returns:
+        dict or None: parse_oldest_sibling の結果。取得・解析に失敗した場合は None
+    """
+    url = pedigree_url(horse_id, base_url)
+
+    try:
+        response = retry_request(url, session, logger=logger)
+
+        if not response:
+            return None
+
+        return parse_oldest_sibling(response.content)
 
     except Exception as e:
         if logger:
@@ -202,6 +346,316 @@ def scrape_oldest_sibling(horse_id, session, logger=None):
         return None
 
 
+class TokenBucket:
+    """トークンバケット（毎秒 rate 個ずつ、最大 burst 個まで溜まる。1リクエストで1個使う）"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """トークンが溜まるまで待って1個使う（待っているリクエストは到着順に通す）"""
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def drain(self):
+        """429 を受けたときにバケットを空にして、次のリクエストまで 1/rate 秒以上空ける"""
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+
+class HostRateLimiter:
+    """ホストごとのトークンバケット"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+
+def create_session(concurrency=DEFAULT_CONCURRENCY, http_cache=True):
+    """
+    接続プールを同時取得数に合わせて広げた requests.Session（keep-alive で接続を再利用する）
+
+    http_cache=True のときは取得したページをディスクにキャッシュする（http_cache.CachedSession）
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if http_cache:
+        return CachedSession(session)
+    return session
+
+
+def load_done_ids(output_path):
+    """出力済みの horse_id の集合（ファイルがなければ空）"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', newline='', encoding='utf-8-sig') as f:
+        for row in csv.reader(f):
+            if len(row) == len(OUTPUT_COLUMNS) and row[0].isdigit():
+                done.add(int(row[0]))
+    return done
+
+
+def load_failed_ids(failed_path):
+    """前回までに失敗した horse_id（1行1件）"""
+    if not os.path.exists(failed_path):
+        return []
+    with open(failed_path, 'r', encoding='utf-8') as f:
+        return [int(line) for line in f if line.strip().isdigit()]
+
+
+def save_failed_ids(failed_path, horse_ids):
+    """失敗した horse_id を書き出す（一時ファイルから置き換える）"""
+    tmp_path = f"{failed_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(f"{horse_id}\n" for horse_id in horse_ids)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, failed_path)
+
+
+def pending_horse_ids(target_ids, output_path, failed_path, retry_failed=False):
+    """
+    今回取得する horse_id（出力済みの馬を除いた target_ids。retry_failed なら前回失敗した馬だけ）
+
+    出力・失敗のファイルの最後の行が切れていたら先に切り詰める（repair_append_log）。
+    切り詰めた行の馬は出力済みに数えないので、今回の取得対象に残る。
+    """
+    repair_append_log(output_path)
+    repair_append_log(failed_path)
+    done_ids = load_done_ids(output_path)
+    candidates = load_failed_ids(failed_path) if retry_failed else target_ids
+    return [horse_id for horse_id in dict.fromkeys(candidates) if horse_id not in done_ids]
+
+
+def prune_failed_ids(output_path, failed_path):
+    """失敗した馬の一覧から、取得できた馬を除いて書き直す（次の --retry-failed の対象を返す）"""
+    done_ids = load_done_ids(output_path)
+    still_failed = [horse_id for horse_id in dict.fromkeys(load_failed_ids(failed_path)) if horse_id not in done_ids]
+    save_failed_ids(failed_path, still_failed)
+    return still_failed
+
+
+def repair_append_log(path):
+    """
+    途中で止まって最後の行が切れていたら、最後の改行まで切り詰める
+
+    切れた行でも列数がそろっていることがある（"333,444,Bar,20" など）ので、
+    load_done_ids で出力済みを数える前に呼ぶ（切り詰めた行の馬は次の取得対象に残る）。
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content and not content.endswith(b'\n'):
+        with open(path, 'r+b') as f:
+            f.truncate(content.rfind(b'\n') + 1)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def open_append_log(path, header=None):
+    """
+    追記用に開く（O_APPEND）
+
+    最後の行が切れていたら切り詰めてから追記する（repair_append_log）。ファイルが空なら header を書く。
+    """
+    repair_append_log(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if os.fstat(fd).st_size == 0 and header:
+        append_lines(fd, header)
+    return fd
+
+
+def append_lines(fd, data):
+    """まとめて1回で書き込み、fsync してから返す"""
+    os.write(fd, data)
+    os.fsync(fd)
+
+
+def format_rows(rows):
+    """[[値, ...]] を CSV の bytes にする（None は空欄）"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+async def retry_request_async(url, session, limiter, max_retries=3, retry_delay=5, logger=None):
+    """リトライ機能付きリクエスト（ホストのレート制限を守る。本文の bytes を返し、失敗したら None）"""
+    bucket = limiter.bucket(url)
+    # ディスクキャッシュから返せるページはサイトにリクエストしないので待たない
+    is_fresh = getattr(session, 'is_fresh', None)
+    for attempt in range(max_retries):
+        if not (is_fresh and is_fresh(url)):
+            await bucket.acquire()
+        try:
+            response = await asyncio.to_thread(session.get, url, headers=get_random_headers(), timeout=30)
+        except CacheMiss as e:
+            # HTTP_CACHE_OFFLINE=1 で保存されていないページ（取り直しても変わらないので失敗として記録する）
+            if logger:
+                logger.error(f"キャッシュにないページ: {url} - {e}")
+            return None
+        except requests.exceptions.RequestException as e:
+            if attempt < max_retries - 1:
+                if logger:
+                    logger.warning(f"リクエストエラー (試行 {attempt + 1}/{max_retries}): {e}")
+                await asyncio.sleep(retry_delay)
+                continue
+            if logger:
+                logger.error(f"リクエスト失敗: {url} - {e}")
+            return None
+
+        if response.status_code == 200:
+            return response.content
+        if response.status_code == 429:  # Too Many Requests
+            wait_time = retry_delay * (attempt + 1) * 2
+            if logger:
+                logger.warning(f"レート制限検出 (429) - {wait_time}秒待機します")
+            # 同じホストへの他のリクエストもまとめて止める
+            async with bucket.lock:
+                await asyncio.sleep(wait_time)
+                bucket.drain()
+        else:
+            if logger:
+                logger.warning(f"HTTPエラー {response.status_code}: {url}")
+
+    return None
+
+
+async def scrape_all(groups, output_path, failed_path, session, limiter, concurrency=DEFAULT_CONCURRENCY,
+                     base_url=DEFAULT_BASE_URL, logger=None):
+    """
+    取得・解析・書き出しを並行して進める
+
+    groups は group_by_dam の結果。グループごとに代表1頭のページだけを取得し、全員分の結果を書き出す。
+    取得は concurrency 個のタスクで行い、取得したページは解析キューへ、解析結果は書き出しキューへ流す。
+    キューが一杯になると前の段が待つので、メモリに溜まるページは QUEUE_SIZE 件まで。
+    結果は WRITE_BATCH_SIZE 件ごと（書き出し待ちがなくなったときはその時点まで）に
+    output_path へ1回の write で追記して fsync する。失敗した horse_id は failed_path に追記する。
+
+    Returns:
+        dict: {'success': 件数, 'error': 件数, 'failed': [horse_id], 'pages': 取得したページ数}
+    """
+    logger = logger or logging.getLogger('siblings_scraper')
+    total = sum(len(group) for group in groups)
+    fetch_queue = asyncio.Queue()
+    parse_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    write_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    for group in groups:
+        fetch_queue.put_nowait(group)
+
+    stats = {'success': 0, 'error': 0, 'failed': [], 'pages': 0}
+    start_time = time.time()
+
+    async def fetcher():
+        while True:
+            try:
+                group = fetch_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            content = await retry_request_async(pedigree_url(group[0]['horse_id'], base_url), session, limiter, logger=logger)
+            stats['pages'] += 1
+            await parse_queue.put((group, content))
+
+    async def parser():
+        while True:
+            item = await parse_queue.get()
+            if item is None:
+                await write_queue.put(None)
+                return
+            group, content = item
+            results = [(member['horse_id'], None) for member in group]
+            if content is not None:
+                try:
+                    siblings = await asyncio.to_thread(parse_siblings, content)
+                    results = fan_out_siblings(group, siblings)
+                except Exception as e:
+                    if logger:
+                        logger.error(f"スクレイピングエラー: {group[0]['horse_id']} - {e}")
+            for result in results:
+                await write_queue.put(result)
+
+    async def writer():
+        done = 0
+        rows = []
+        failed = []
+        output_fd = open_append_log(output_path, header=codecs.BOM_UTF8 + format_rows([OUTPUT_COLUMNS]))
+        failed_fd = open_append_log(failed_path)
+
+        def flush():
+            if rows:
+                append_lines(output_fd, format_rows(rows))
+                rows.clear()
+            if failed:
+                append_lines(failed_fd, ''.join(f"{horse_id}\n" for horse_id in failed).encode('utf-8'))
+                failed.clear()
+
+        try:
+            while True:
+                item = await write_queue.get()
+                if item is None:
+                    return
+                horse_id, sibling_data = item
+                done += 1
+
+                if sibling_data:
+                    rows.append([horse_id] + [sibling_data[column] for column in OUTPUT_COLUMNS[1:]])
+                    stats['success'] += 1
+
+                    if sibling_data['oldest_sibling_id']:
+                        logger.info(f"[{done}/{total}] ✓ {horse_id}: 最年長兄弟 {sibling_data['oldest_sibling_name']} ({sibling_data['oldest_sibling_birth_year']}年)")
+                    else:
+                        logger.info(f"[{done}/{total}] ✓ {horse_id}: 兄弟なし")
+                else:
+                    failed.append(horse_id)
+                    stats['error'] += 1
+                    stats['failed'].append(horse_id)
+                    logger.error(f"[{done}/{total}] ✗ エラー: {horse_id}")
+
+                if len(rows) + len(failed) >= WRITE_BATCH_SIZE or write_queue.empty():
+                    flush()
+
+                # 進捗表示（10件ごと）
+                if done % 10 == 0:
+                    elapsed = time.time() - start_time
+                    remaining = (total - done) * elapsed / done
+                    logger.info(f"  進捗: {done}/{total} | 成功: {stats['success']} | エラー: {stats['error']} | "
+                                f"{done / elapsed:.2f}件/秒 | 予想残り時間: {remaining/60:.1f}分")
+        finally:
+            flush()
+            os.close(output_fd)
+            os.close(failed_fd)
+
+    parse_task = asyncio.create_task(parser())
+    write_task = asyncio.create_task(writer())
+    await asyncio.gather(*(fetcher() for _ in range(concurrency)))
+    await parse_queue.put(None)
+    await asyncio.gather(parse_task, write_task)
+    return stats
+
+
 def get_target_horses_from_csv(csv_path='target_horses.csv'):
     """CSVファイルから対象馬のリストを取得"""
     df = pd.read_csv(csv_path)
@@ -209,18 +663,21 @@ def get_target_horses_from_csv(csv_path='target_horses.csv'):
 
 
 def get_target_horses_from_bigquery():
-    """BigQueryから対象馬のリストを取得 (2022-2024年デビュー)"""
+    """BigQueryから対象馬のリストを取得 (2022-2024年デビュー。母ごとにまとめるため母・馬名・生年も取得)"""
     client = bigquery.Client()
 
     query = """
-    SELECT DISTINCT
-      h.horse_id
+    SELECT
+      h.horse_id,
+      h.horse_name,
+      h.mother,
+      EXTRACT(YEAR FROM h.birth_date) AS birth_year
     FROM `umadata.keiba_data.horse` h
     JOIN `umadata.keiba_data.race_result` rr ON h.horse_id = rr.horse_id
     JOIN `umadata.keiba_data.race_master` rm ON rr.race_id = rm.race_id
     WHERE h.mother IS NOT NULL
       AND h.mother != ""
-    GROUP BY h.horse_id
+    GROUP BY h.horse_id, h.horse_name, h.mother, h.birth_date
     HAVING MIN(rm.race_date) BETWEEN "2022-01-01" AND "2024-12-31"
     ORDER BY h.horse_id
     """
@@ -229,7 +686,139 @@ def get_target_horses_from_bigquery():
     return df
 
 
+def get_dam_families_from_bigquery(horse_ids):
+    """
+    対象馬の母ごとに、horse テーブルにいる産駒全員と母自身の情報を取得する
+
+    Returns:
+        tuple: (families, dams)
+            families: 産駒（horse_id / horse_name / mother / birth_year）。対象馬自身も含む
+            dams:     母（mother / dam_horse_id / dam_birth_year / dam_last_race_year）。horse テーブルにいる母だけ。
+                      同じ名前の馬が複数いる母名は、馬ごとに1行ずつ（resolve_oldest_siblings で DB では決めない）
+    """
+    client = bigquery.Client()
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('horse_ids', 'INT64', [int(horse_id) for horse_id in horse_ids]),
+    ])
+
+    target_dams = """
+    target_dams AS (
+      SELECT DISTINCT h.mother
+      FROM `umadata.keiba_data.horse` h
+      WHERE h.horse_id IN UNNEST(@horse_ids)
+        AND h.mother IS NOT NULL
+        AND h.mother != ""
+    )
+    """
+
+    families_query = f"""
+    WITH {target_dams}
+    SELECT
+      h.horse_id,
+      h.horse_name,
+      h.mother,
+      EXTRACT(YEAR FROM h.birth_date) AS birth_year
+    FROM `umadata.keiba_data.horse` h
+    JOIN target_dams d ON h.mother = d.mother
+    """
+
+    # 現役のうちは出産しないので、母の最終出走年の翌年より前に産駒はいない
+    # 産駒とは母の名前でつながるので、同じ名前の別の馬（時代の違う同名馬）をまとめないよう馬ごとに集計する
+    dams_query = f"""
+    WITH {target_dams}
+    SELECT
+      dam.horse_name AS mother,
+      dam.horse_id AS dam_horse_id,
+      EXTRACT(YEAR FROM MIN(dam.birth_date)) AS dam_birth_year,
+      EXTRACT(YEAR FROM MAX(rm.race_date)) AS dam_last_race_year
+    FROM `umadata.keiba_data.horse` dam
+    JOIN target_dams d ON dam.horse_name = d.mother
+    LEFT JOIN `umadata.keiba_data.race_result` rr ON dam.horse_id = rr.horse_id
+    LEFT JOIN `umadata.keiba_data.race_master` rm ON rr.race_id = rm.race_id
+    GROUP BY dam.horse_name, dam.horse_id
+    """
+
+    families = client.query(families_query, job_config=job_config).to_dataframe()
+    dams = client.query(dams_query, job_config=job_config).to_dataframe()
+    return families, dams
+
+
+def resolve_oldest_siblings(horse_ids, families, dams, slack=FIRST_FOAL_SLACK_YEARS):
+    """
+    DB の産駒から最年長兄弟を求める（産駒がそろっている母の馬だけ）
+
+    母ごとに生年の早い順に並べた先頭を取り、対象馬より年上の先頭を最年長兄弟とする。
+    出走しなかった産駒は horse テーブルにいないので、次の場合だけ産駒がそろっているとみなす。
+    - 最初にありうる産駒の生年（母の最終出走年の翌年。分からなければ母の生年 + MIN_DAM_AGE_AT_FOALING）から
+      slack 年以内に、知っている最年長の産駒が生まれている
+    母が horse テーブルにいない場合や、それより後にしか産駒を知らない場合はスクレイピングに回す。
+    産駒と母は母の名前でつながるので、同じ名前の馬が horse テーブルに複数いる母もスクレイピングに回す。
+    最初にありうる生年より前に生まれた産駒がいる母も、horse テーブルにいない同名の別の馬の産駒が
+    混ざっているとみなしてスクレイピングに回す。
+    対象馬自身が先頭（最初の産駒）の場合もスクレイピングに回す。最年長兄弟は対象馬より年下の産駒になるが、
+    まだ出走していない年下の産駒は horse テーブルにいないので、DB の2頭目が最年長とは限らない
+    （兄弟がいないとも言えない）。
+
+    Returns:
+        tuple: (rows, unresolved)
+            rows:       出力する行（[horse_id, oldest_sibling_id, oldest_sibling_name, oldest_sibling_birth_year]）
+            unresolved: DB では決められなかった horse_id
+    """
+    known = families.dropna(subset=['mother', 'birth_year'])
+    known = known[known['mother'] != ''].drop_duplicates('horse_id')
+    ranked = known.sort_values(['mother', 'birth_year', 'horse_id'])
+    ranked = ranked.assign(order=ranked.groupby('mother').cumcount())
+    columns = ['horse_id', 'horse_name', 'birth_year']
+    first = ranked[ranked['order'] == 0].set_index('mother')[columns]
+
+    # 産駒がそろっている母
+    dams = dams[~dams['mother'].duplicated(keep=False)].set_index('mother')
+    earliest = (dams['dam_last_race_year'] + 1).fillna(dams['dam_birth_year'] + MIN_DAM_AGE_AT_FOALING)
+    earliest = earliest.reindex(first.index)
+    complete = ((first['birth_year'] >= earliest) & (first['birth_year'] <= earliest + slack)).rename('complete')
+
+    targets = known[known['horse_id'].isin(horse_ids)][['horse_id', 'mother']]
+    targets = (targets
+               .join(first.add_prefix('first_'), on='mother')
+               .join(complete, on='mother'))
+    targets = targets[targets['complete'].fillna(False).astype(bool)]
+
+    # 対象馬自身が最初の産駒なら DB では決めない
+    targets = targets[targets['horse_id'] != targets['first_horse_id']]
+    oldest = pd.DataFrame({
+        'horse_id': targets['horse_id'],
+        'oldest_sibling_id': targets['first_horse_id'],
+        'oldest_sibling_name': targets['first_horse_name'],
+        'oldest_sibling_birth_year': targets['first_birth_year'],
+    })
+
+    rows = [
+        [int(horse_id),
+         int(sibling_id) if pd.notna(sibling_id) else None,
+         name if pd.notna(name) else None,
+         int(birth_year) if pd.notna(birth_year) else None]
+        for horse_id, sibling_id, name, birth_year in oldest.itertuples(index=False)
+    ]
+    resolved = {row[0] for row in rows}
+    unresolved = [horse_id for horse_id in horse_ids if horse_id not in resolved]
+    return rows, unresolved
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Scrape the oldest sibling of each target horse from netkeiba pedigree pages')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help=f'Requests per second per host (default: {DEFAULT_RATE})')
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST, help=f'Requests allowed back to back before the rate applies (default: {DEFAULT_BURST})')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help=f'Pages fetched at the same time (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL, help=f'Site to fetch pedigree pages from, e.g. a local server replaying recorded pages (default: {DEFAULT_BASE_URL})')
+    parser.add_argument('--output', default='horse_siblings.csv', help='Output CSV (default: horse_siblings.csv)')
+    parser.add_argument('--failed-output', default='horse_siblings_failed.txt', help='Horse IDs that failed, one per line (default: horse_siblings_failed.txt)')
+    parser.add_argument('--retry-failed', action='store_true', help='Fetch only the horse IDs listed in --failed-output')
+    parser.add_argument('--fresh', action='store_true', help='Discard the existing output and scrape every target again')
+    parser.add_argument('--no-http-cache', action='store_true', help='Always download pages instead of reusing the on-disk HTTP cache (http_cache.py)')
+    parser.add_argument('--no-db-resolve', action='store_true', help='Scrape every target instead of resolving complete dam families from the horse table first')
+    parser.add_argument('--first-foal-slack', type=int, default=FIRST_FOAL_SLACK_YEARS, help=f'Years after the earliest possible first foal within which the oldest known foal must fall for a family to count as complete; above 0, an unraced oldest foal in that gap is missed (default: {FIRST_FOAL_SLACK_YEARS})')
+    args = parser.parse_args()
+
     # ロガーを初期化
     logger = setup_logger()
 
@@ -247,65 +836,68 @@ def main():
         target_df = get_target_horses_from_bigquery()
         logger.info(f"BigQueryから{len(target_df)}頭を取得しました")
 
-    # セッションを使い回す（接続の再利用）
-    session = requests.Session()
+    output_path = args.output
+    failed_path = args.failed_output
+
+    if args.fresh:
+        # 出力を作り直す（ヘッダーは書き出し開始時に書く）
+        for path in (output_path, failed_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # 出力済みの馬は取り直さない（切れた最後の行は先に切り詰め、その馬は出力済みに数えない）
+    target_ids = target_df['horse_id'].tolist()
+    horse_ids = pending_horse_ids(target_ids, output_path, failed_path, retry_failed=args.retry_failed)
+    if args.retry_failed:
+        previous_failed = load_failed_ids(failed_path)
+        logger.info(f"前回失敗した{len(previous_failed)}頭のうち、未取得の{len(horse_ids)}頭を取り直します")
+    else:
+        logger.info(f"出力済み{len(target_ids) - len(horse_ids)}頭をスキップし、残り{len(horse_ids)}頭を取得します")
+
+    # 産駒がそろっている母の馬は、DB の産駒から最年長兄弟を決めてスクレイピングしない
+    if not args.no_db_resolve and horse_ids:
+        resolve_start = time.time()
+        families, dams = get_dam_families_from_bigquery(horse_ids)
+        rows, horse_ids = resolve_oldest_siblings(horse_ids, families, dams, slack=args.first_foal_slack)
+        output_fd = open_append_log(output_path, header=codecs.BOM_UTF8 + format_rows([OUTPUT_COLUMNS]))
+        try:
+            append_lines(output_fd, format_rows(rows))
+        finally:
+            os.close(output_fd)
+        logger.info(f"DB の産駒から{len(rows)}頭の最年長兄弟を決めました（{time.time() - resolve_start:.1f}秒）。"
+                    f"残り{len(horse_ids)}頭をスクレイピングします")
+        # 母ごとにまとめるための母・馬名・生年
+        target_df = families
+    total = len(horse_ids)
+
+    # 同じ母の馬は代表1頭のページだけを取得する
+    groups = group_by_dam(target_df, horse_ids)
+    logger.info(f"母ごとにまとめて{len(groups)}ページを取得します（1ページあたり平均{total / max(len(groups), 1):.2f}頭）")
 
-    total = len(target_df)
-    success_count = 0
-    error_count = 0
-    output_path = 'horse_siblings.csv'
+    # セッションを使い回す（接続の再利用）
+    session = create_session(args.concurrency, http_cache=not args.no_http_cache)
+    limiter = HostRateLimiter(args.rate, args.burst)
 
-    # CSVファイルを初期化（ヘッダーのみ書き込み）
-    pd.DataFrame(columns=['horse_id', 'oldest_sibling_id', 'oldest_sibling_name', 'oldest_sibling_birth_year']).to_csv(
-        output_path, index=False, encoding='utf-8-sig'
-    )
-    logger.info(f"出力ファイル: {output_path}")
+    logger.info(f"出力ファイル: {output_path}（失敗した馬: {failed_path}）")
 
     logger.info(f"開始時刻: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info(f"取得先: {args.base_url} | レート: {args.rate}件/秒 (バースト {args.burst}) | 同時取得数: {args.concurrency}")
+    logger.info(f"予想処理時間: {len(groups) / args.rate / 60:.1f}分以上（レート上限）")
     logger.info("="*60)
 
     start_time = time.time()
 
-    for idx, row in target_df.iterrows():
-        horse_id = row['horse_id']
-
-        # ランダムな待機時間（2〜5秒）
-        wait_random_time(2, 5)
-
-        logger.info(f"[{idx + 1}/{total}] horse_id: {horse_id} を処理中...")
-
-        # スクレイピング実行
-        sibling_data = scrape_oldest_sibling(horse_id, session, logger)
-
-        if sibling_data:
-            # リアルタイムでCSVに追記
-            result_row = pd.DataFrame([{
-                'horse_id': horse_id,
-                'oldest_sibling_id': sibling_data['oldest_sibling_id'],
-                'oldest_sibling_name': sibling_data['oldest_sibling_name'],
-                'oldest_sibling_birth_year': sibling_data['oldest_sibling_birth_year']
-            }])
-            result_row.to_csv(output_path, mode='a', header=False, index=False, encoding='utf-8-sig')
-
-            success_count += 1
-
-            if sibling_data['oldest_sibling_id']:
-                logger.info(f"✓ 成功: 最年長兄弟 {sibling_data['oldest_sibling_name']} ({sibling_data['oldest_sibling_birth_year']}年)")
-            else:
-                logger.info(f"✓ 成功: 兄弟なし")
-        else:
-            error_count += 1
-            logger.error(f"✗ エラー: {horse_id}")
-
-        # 進捗表示（10件ごと）
-        if (idx + 1) % 10 == 0:
-            elapsed = time.time() - start_time
-            avg_time = elapsed / (idx + 1)
-            remaining = (total - (idx + 1)) * avg_time
-            logger.info(f"  進捗: {idx + 1}/{total} | 成功: {success_count} | エラー: {error_count} | 予想残り時間: {remaining/60:.1f}分")
+    stats = asyncio.run(scrape_all(groups, output_path, failed_path, session, limiter, concurrency=args.concurrency,
+                                   base_url=args.base_url, logger=logger))
 
     # セッションを閉じる
     session.close()
+    if not args.no_http_cache:
+        logger.info(f"HTTPキャッシュ: {session.hits}件ヒット, {session.revalidated}件再検証 (304), "
+                    f"{session.downloads}件ダウンロード ({session.cache_dir})")
+
+    # 失敗した馬の一覧から、取得できた馬を除いて書き直す（次の --retry-failed の対象）
+    still_failed = prune_failed_ids(output_path, failed_path)
 
     total_elapsed = time.time() - start_time
 
@@ -317,8 +909,10 @@ def main():
     logger.info(f"総処理時間: {total_elapsed/3600:.2f}時間 ({total_elapsed/60:.1f}分)")
     logger.info(f"処理結果:")
     logger.info(f"  - 総数: {total}")
-    logger.info(f"  - 成功: {success_count}")
-    logger.info(f"  - エラー: {error_count}")
+    logger.info(f"  - 取得ページ数: {stats['pages']}")
+    logger.info(f"  - 成功: {stats['success']}")
+    logger.info(f"  - エラー: {stats['error']}")
+    logger.info(f"  - 未取得（--retry-failed の対象）: {len(still_failed)}")
     logger.info(f"出力ファイル: {output_path}")
     logger.info("="*60)
 
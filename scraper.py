@@ -1,7 +1,11 @@
-import requests
-from bs4 import BeautifulSoup
 import re
 
+from html_parse import SIBLING_TABLES, parse_tables
+from http_cache import CachedSession
+
+# 取得したページはディスクにキャッシュする（http_cache.py）
+session = CachedSession()
+
 def scrape_oldest_sibling(horse_id):
     """
     指定されたhorse_idの最年長兄弟を取得
@@ -20,11 +24,11 @@ def scrape_oldest_sibling(horse_id):
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        response = requests.get(url, headers=headers, timeout=10)
+        response = session.get(url, headers=headers, timeout=10)
         response.raise_for_status()
 
-        # HTMLをパース
-        soup = BeautifulSoup(response.content, 'html.parser')
+        # HTMLをパース（兄弟馬の表の候補だけ。html_parse.py）
+        soup = parse_tables(response.content, SIBLING_TABLES)
 
         # 兄弟馬の表を取得
         table = soup.find('table', class_='nk_tb_common race_table_01')
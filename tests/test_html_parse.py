@@ -0,0 +1,40 @@
+"""記録済みのページ（tests/fixtures）で、html_parse の速いパース（fast=True）とページ全体のパースの結果が同じことを確かめる"""
+
+import os
+
+import pytest
+
+pytest.importorskip('bs4')
+pytest.importorskip('pandas')
+pytest.importorskip('requests')
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('google.cloud.storage')
+
+from compare_html_parsers import PAGE_KINDS, load_fixture_pages
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+PAGES = load_fixture_pages(FIXTURES_DIR)
+PARSERS = {name: parse for name, _, parse, _ in PAGE_KINDS}
+
+
+@pytest.mark.parametrize('kind, url, content', [
+    pytest.param(kind, url, content, id=url) for kind, pages in PAGES.items() for url, content in pages
+])
+def test_fast_parse_matches_full_page_parse(kind, url, content):
+    parse = PARSERS[kind]
+
+    assert parse(url, content, True) == parse(url, content, False)
+
+
+def test_fixtures_cover_every_page_kind():
+    assert all(PAGES[name] for name in PARSERS)
+
+
+def test_schedule_tables_with_extra_classes_are_kept():
+    # class="basic narrow-xy striped" の表も SCHEDULE_TABLES に残る
+    url, content = PAGES['schedule'][0]
+    schedule = PARSERS['schedule'](url, content, True)
+
+    assert schedule['date'] == '2026-02-14'
+    assert list(schedule['venues']) == ['tokyo', 'kyoto', 'kokura']
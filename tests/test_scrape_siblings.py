@@ -0,0 +1,385 @@
+"""scrape_siblings のレート制限・429・取得パイプライン・再開を、記録したページを返すローカルの HTTP サーバーで確かめる
+
+DB の産駒から最年長兄弟を決める条件（resolve_oldest_siblings）もここで確かめる。
+"""
+
+import asyncio
+import codecs
+import csv
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import pytest
+
+requests = pytest.importorskip('requests')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('bs4')
+pytest.importorskip('google.cloud.bigquery')
+
+import scrape_siblings
+from scrape_siblings import (
+    OUTPUT_COLUMNS, HostRateLimiter, TokenBucket, group_by_dam, pedigree_url, pending_horse_ids,
+    prune_failed_ids, resolve_oldest_siblings, retry_request_async, scrape_all,
+)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'pedigree')
+
+# 対象馬（母ごとに1ページ。2021104003 は 2019105219 と同じ母なのでページを取得しない）
+TARGETS = pd.DataFrame([
+    {'horse_id': 2019105219, 'horse_name': 'サンプルブライト', 'mother': 'サンプルマザー', 'birth_year': 2019},
+    {'horse_id': 2021104003, 'horse_name': 'サンプルフォース', 'mother': 'サンプルマザー', 'birth_year': 2021},
+    {'horse_id': 2020102345, 'horse_name': 'サンプルウインド', 'mother': 'サンプルレディ', 'birth_year': 2020},
+    {'horse_id': 2021100001, 'horse_name': 'サンプルスター', 'mother': 'サンプルプリンセス', 'birth_year': 2021},
+])
+
+# 記録したページから求まる行（CSV の空欄は ''）
+EXPECTED_ROWS = [
+    ['2019105219', '2015104001', 'サンプルファースト', '2015'],
+    ['2021104003', '2015104001', 'サンプルファースト', '2015'],
+    ['2020102345', '2016102001', 'サンプルブリーズ', '2016'],
+    ['2021100001', '', '', ''],
+]
+
+# 429 の待ち（retry_delay × 2）を短くする
+RETRY_DELAY = 0.1
+
+
+def load_fixture(horse_id):
+    with open(os.path.join(FIXTURES_DIR, f"{horse_id}.html"), 'rb') as f:
+        return f.read()
+
+
+class StandInServer:
+    """記録したページを返すローカルの HTTP サーバー（パスごとに最初の何回かは 429 を返せる）"""
+
+    def __init__(self, pages):
+        self.pages = dict(pages)
+        self.throttle = {}
+        self.throttled = threading.Event()
+        self.requests = []
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = stand_in.respond(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=EUC-JP')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def respond(self, path):
+        with self.lock:
+            if self.throttle.get(path, 0) > 0:
+                self.throttle[path] -= 1
+                status, body = 429, b''
+            elif path in self.pages:
+                status, body = 200, self.pages[path]
+            else:
+                status, body = 404, b''
+            self.requests.append((time.monotonic(), path, status))
+        if status == 429:
+            self.throttled.set()
+        return status, body
+
+    def add_page(self, horse_id, content):
+        self.pages[urlsplit(pedigree_url(horse_id)).path] = content
+
+    def served(self, horse_id):
+        """horse_id のページのリクエスト（(時刻, ステータス) のリスト）"""
+        path = urlsplit(pedigree_url(horse_id)).path
+        return [(at, status) for at, request_path, status in self.requests if request_path == path]
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer({})
+    for filename in sorted(os.listdir(FIXTURES_DIR)):
+        horse_id = int(filename.split('.')[0])
+        stand_in.add_page(horse_id, load_fixture(horse_id))
+    stand_in.thread.start()
+    yield stand_in
+    stand_in.httpd.shutdown()
+    stand_in.httpd.server_close()
+
+
+def run_scrape(groups, tmp_path, server, concurrency=2):
+    output_path, failed_path = str(tmp_path / 'horse_siblings.csv'), str(tmp_path / 'failed.txt')
+    stats = asyncio.run(scrape_all(groups, output_path, failed_path, requests.Session(),
+                                   HostRateLimiter(rate=1000, burst=100), concurrency=concurrency,
+                                   base_url=server.url))
+    return stats, output_path, failed_path
+
+
+def read_rows(output_path):
+    with open(output_path, 'r', newline='', encoding='utf-8-sig') as f:
+        return list(csv.reader(f))
+
+
+def test_token_bucket_allows_burst_then_spaces_by_rate():
+    async def run():
+        bucket = TokenBucket(rate=20, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        burst_elapsed = time.monotonic() - start
+        for _ in range(4):
+            await bucket.acquire()
+        return burst_elapsed, time.monotonic() - start
+
+    burst_elapsed, elapsed = asyncio.run(run())
+
+    assert burst_elapsed < 0.05
+    # バーストの後は 1/20 秒ごとに1個
+    assert 0.18 <= elapsed < 0.5
+
+
+def test_token_bucket_drain_waits_one_interval():
+    async def run():
+        bucket = TokenBucket(rate=10, burst=5)
+        bucket.drain()
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+
+    assert 0.09 <= asyncio.run(run()) < 0.3
+
+
+def test_host_rate_limiter_keeps_one_bucket_per_host():
+    limiter = HostRateLimiter(rate=1, burst=1)
+
+    assert limiter.bucket('https://db.netkeiba.com/horse/ped/1/') is limiter.bucket('https://db.netkeiba.com/horse/ped/2/')
+    assert limiter.bucket('https://db.netkeiba.com/') is not limiter.bucket('https://www.jra.go.jp/')
+
+
+def test_429_holds_every_request_to_the_host(server):
+    server.throttle[urlsplit(pedigree_url(2019105219)).path] = 1
+    limiter = HostRateLimiter(rate=100, burst=1)
+    session = requests.Session()
+
+    async def run():
+        throttled = asyncio.create_task(retry_request_async(pedigree_url(2019105219, server.url), session, limiter,
+                                                            retry_delay=RETRY_DELAY))
+        # 429 を受けたリクエストが待ちに入ってから（待ちの半分の時点で）、同じホストの別のページを取りにいく
+        await asyncio.to_thread(server.throttled.wait, 5)
+        await asyncio.sleep(RETRY_DELAY)
+        other = await retry_request_async(pedigree_url(2020102345, server.url), session, limiter,
+                                          retry_delay=RETRY_DELAY)
+        return await throttled, other
+
+    throttled, other = asyncio.run(run())
+
+    assert throttled == load_fixture(2019105219)
+    assert other == load_fixture(2020102345)
+    (throttled_at, status), (retried_at, retried_status) = server.served(2019105219)
+    [(other_at, other_status)] = server.served(2020102345)
+    assert (status, retried_status, other_status) == (429, 200, 200)
+    # 待ち（retry_delay × 2）が明けるまでは、どちらのリクエストも出ない
+    assert retried_at - throttled_at >= RETRY_DELAY * 2
+    assert other_at - throttled_at >= RETRY_DELAY * 2
+
+
+def test_scrape_all_writes_every_target_in_group_order(server, tmp_path):
+    groups = group_by_dam(TARGETS, TARGETS['horse_id'].tolist())
+
+    stats, output_path, failed_path = run_scrape(groups, tmp_path, server, concurrency=1)
+
+    assert read_rows(output_path) == [OUTPUT_COLUMNS] + EXPECTED_ROWS
+    assert (stats['success'], stats['error'], stats['failed'], stats['pages']) == (4, 0, [], 3)
+    # 同じ母の2頭目のページは取得しない
+    assert server.served(2021104003) == []
+    with open(failed_path, 'rb') as f:
+        assert f.read() == b''
+
+
+def test_scrape_all_keeps_each_family_together(server, tmp_path):
+    groups = group_by_dam(TARGETS, TARGETS['horse_id'].tolist())
+
+    _, output_path, _ = run_scrape(groups, tmp_path, server, concurrency=3)
+
+    header, *rows = read_rows(output_path)
+    assert header == OUTPUT_COLUMNS
+    assert sorted(rows) == sorted(EXPECTED_ROWS)
+    # 同じページから作った行は続けて書く
+    horse_ids = [row[0] for row in rows]
+    assert horse_ids.index('2021104003') == horse_ids.index('2019105219') + 1
+
+
+def test_scrape_all_bounds_pages_waiting_to_be_parsed(server, tmp_path, monkeypatch):
+    queue_size, concurrency = 2, 2
+    monkeypatch.setattr(scrape_siblings, 'QUEUE_SIZE', queue_size)
+    horse_ids = [2022100000 + i for i in range(16)]
+    for horse_id in horse_ids:
+        server.add_page(horse_id, load_fixture(2021100001))
+
+    parse_siblings = scrape_siblings.parse_siblings
+    parsed = []
+    ahead = []
+
+    def slow_parse(content):
+        # 取得が解析より先に進んでいるページ数
+        parsed.append(content)
+        ahead.append(len(server.requests) - len(parsed))
+        time.sleep(0.05)
+        return parse_siblings(content)
+
+    monkeypatch.setattr(scrape_siblings, 'parse_siblings', slow_parse)
+    groups = [[{'horse_id': horse_id, 'name': None, 'birth_year': 2022}] for horse_id in horse_ids]
+
+    stats, output_path, _ = run_scrape(groups, tmp_path, server, concurrency=concurrency)
+
+    assert stats['success'] == len(horse_ids)
+    assert len(read_rows(output_path)) == len(horse_ids) + 1
+    # キューが一杯なら取得が待つ（解析キューと、put で待っている取得タスクの分まで）
+    assert max(ahead) <= queue_size + concurrency
+
+
+def test_pending_horse_ids_skips_done_and_refetches_torn_row(tmp_path):
+    output_path, failed_path = str(tmp_path / 'horse_siblings.csv'), str(tmp_path / 'failed.txt')
+    with open(output_path, 'wb') as f:
+        f.write(codecs.BOM_UTF8 + b'horse_id,oldest_sibling_id,oldest_sibling_name,oldest_sibling_birth_year\n')
+        f.write('2019105219,2015104001,サンプルファースト,2015\n'.encode('utf-8'))
+        # 書き込みの途中で止まった行（列数はそろっている）
+        f.write('2020102345,2016102001,サンプル,20'.encode('utf-8'))
+
+    horse_ids = pending_horse_ids([2019105219, 2020102345, 2021100001], output_path, failed_path)
+
+    assert horse_ids == [2020102345, 2021100001]
+    with open(output_path, 'rb') as f:
+        assert f.read().endswith('サンプルファースト,2015\n'.encode('utf-8'))
+
+
+def test_retry_failed_fetches_only_failed_horses_not_yet_done(tmp_path):
+    output_path, failed_path = str(tmp_path / 'horse_siblings.csv'), str(tmp_path / 'failed.txt')
+    with open(output_path, 'w', encoding='utf-8-sig') as f:
+        f.write('horse_id,oldest_sibling_id,oldest_sibling_name,oldest_sibling_birth_year\n')
+        f.write('2020102345,2016102001,サンプルブリーズ,2016\n')
+    with open(failed_path, 'w', encoding='utf-8') as f:
+        f.write('2021109999\n2020102345\n2021109999\n')
+
+    horse_ids = pending_horse_ids([2019105219], output_path, failed_path, retry_failed=True)
+
+    assert horse_ids == [2021109999]
+
+
+def test_resume_and_retry_failed_fetch_every_horse_once(server, tmp_path):
+    targets = pd.concat([TARGETS, pd.DataFrame([
+        {'horse_id': 2021109999, 'horse_name': 'サンプルミッシング', 'mother': 'サンプルロスト', 'birth_year': 2021},
+    ])], ignore_index=True)
+    target_ids = targets['horse_id'].tolist()
+    output_path, failed_path = str(tmp_path / 'horse_siblings.csv'), str(tmp_path / 'failed.txt')
+
+    # 1回目: 2021109999 のページがない（404）
+    stats, _, _ = run_scrape(group_by_dam(targets, pending_horse_ids(target_ids, output_path, failed_path)),
+                             tmp_path, server)
+    assert stats['failed'] == [2021109999]
+    assert prune_failed_ids(output_path, failed_path) == [2021109999]
+
+    # 再開しても、出力済みの馬は取り直さない
+    assert pending_horse_ids(target_ids, output_path, failed_path) == [2021109999]
+
+    # --retry-failed: ページが取れるようになった馬だけを取り直す
+    server.add_page(2021109999, load_fixture(2021100001))
+    retry_ids = pending_horse_ids(target_ids, output_path, failed_path, retry_failed=True)
+    assert retry_ids == [2021109999]
+    requests_before = len(server.requests)
+    stats, _, _ = run_scrape(group_by_dam(targets, retry_ids), tmp_path, server)
+
+    assert (stats['success'], stats['pages']) == (1, 1)
+    assert len(server.requests) == requests_before + 1
+    assert prune_failed_ids(output_path, failed_path) == []
+    header, *rows = read_rows(output_path)
+    assert header == OUTPUT_COLUMNS
+    assert sorted(rows) == sorted(EXPECTED_ROWS + [['2021109999', '', '', '']])
+
+
+def family(mother, *foals):
+    return [{'horse_id': horse_id, 'horse_name': f"{mother}の{birth_year}", 'mother': mother, 'birth_year': birth_year}
+            for horse_id, birth_year in foals]
+
+
+def dam(mother, dam_horse_id, dam_birth_year, dam_last_race_year=None):
+    return {'mother': mother, 'dam_horse_id': dam_horse_id, 'dam_birth_year': dam_birth_year,
+            'dam_last_race_year': dam_last_race_year}
+
+
+def resolve(horse_ids, families, dams):
+    rows, unresolved = resolve_oldest_siblings(horse_ids, pd.DataFrame(families), pd.DataFrame(dams))
+    return {row[0]: row[1:] for row in rows}, unresolved
+
+
+def test_resolve_complete_family_from_the_db():
+    # 2012年まで出走した母の最初の産駒は2013年生まれ
+    families = family('サンプルマザー', (2013100001, 2013), (2015100002, 2015), (2019100003, 2019))
+    rows, unresolved = resolve([2015100002, 2019100003], families, [dam('サンプルマザー', 2008100000, 2008, 2012)])
+
+    assert rows == {
+        2015100002: [2013100001, 'サンプルマザーの2013', 2013],
+        2019100003: [2013100001, 'サンプルマザーの2013', 2013],
+    }
+    assert unresolved == []
+
+
+def test_resolve_leaves_gaps_and_first_foals_to_the_scraper():
+    families = (
+        # 最初にありうる生年（2013年）に産駒がいない（出走しなかった年上の産駒がいるかもしれない）
+        family('サンプルレディ', (2015100012, 2015), (2017100013, 2017))
+        # 対象馬自身が最初の産駒（DB の2頭目が最年長の兄弟とは限らない）
+        + family('サンプルプリンセス', (2013100021, 2013), (2016100022, 2016))
+    )
+    dams = [dam('サンプルレディ', 2008100010, 2008, 2012), dam('サンプルプリンセス', 2008100020, 2008, 2012)]
+
+    rows, unresolved = resolve([2017100013, 2013100021], families, dams)
+
+    assert rows == {}
+    assert unresolved == [2017100013, 2013100021]
+
+
+def test_resolve_leaves_dams_missing_from_the_horse_table_to_the_scraper():
+    families = family('サンプルロスト', (2013100031, 2013), (2016100032, 2016))
+
+    rows, unresolved = resolve([2016100032], families, [dam('サンプルマザー', 2008100000, 2008, 2012)])
+
+    assert rows == {}
+    assert unresolved == [2016100032]
+
+
+def test_resolve_leaves_ambiguous_dam_names_to_the_scraper():
+    # 時代の違う同名の母が2頭いる（産駒がどちらの母の子か名前では分からない）
+    families = family('サンプルネーム', (2013100042, 2013), (2016100043, 2016))
+    dams = [dam('サンプルネーム', 1990100040, 1990, 1994), dam('サンプルネーム', 2008100044, 2008, 2012)]
+
+    rows, unresolved = resolve([2016100043], families, dams)
+
+    assert rows == {}
+    assert unresolved == [2016100043]
+
+
+def test_resolve_leaves_foals_older_than_the_dam_allows_to_the_scraper():
+    # 1996年生まれの産駒は、2012年まで出走した母の子ではない（horse テーブルにいない同名の母の子）
+    families = family('サンプルネーム', (1996100041, 1996), (2013100042, 2013), (2016100043, 2016))
+
+    rows, unresolved = resolve([2016100043], families, [dam('サンプルネーム', 2008100044, 2008, 2012)])
+
+    assert rows == {}
+    assert unresolved == [2016100043]
+
+
+def test_resolve_uses_the_dam_birth_year_when_she_never_raced():
+    families = family('サンプルマザー', (2011100051, 2011), (2014100052, 2014))
+
+    rows, unresolved = resolve([2014100052], families, [dam('サンプルマザー', 2008100050, 2008)])
+
+    assert rows == {2014100052: [2011100051, 'サンプルマザーの2011', 2011]}
+    assert unresolved == []